@@ -0,0 +1,525 @@
+# coding=utf-8
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+# Benchmarks for the performance critical parts of the server. Run them from the repository's root via
+#
+#     python benchmarks/benchmark.py [--baseline <revision>] <benchmark> [options]
+#
+# and see "--help" for the available benchmarks and their options. They measure the working tree. With --baseline
+# the same benchmark is run against the given git revision first, exported into a temporary folder, so any change
+# can be compared against the code as it was before. Revisions that don't have the measured code yet are reported
+# as such. All benchmarks run against a throwaway settings folder and never touch the regular configuration.
+
+import os
+import sys
+import math
+import hashlib
+import time
+import shutil
+import tempfile
+import threading
+import resource
+import subprocess
+import importlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class NotAvailable(Exception):
+	pass
+
+def _require(moduleName, *names):
+	"""
+	Imports the given module of the tree under test, raising NotAvailable if it or one of the given names in it
+	doesn't exist there.
+	"""
+	try:
+		module = importlib.import_module(moduleName)
+	except (ImportError, SyntaxError), e:
+		raise NotAvailable("%s can't be imported: %s" % (moduleName, str(e)))
+	for name in names:
+		if not hasattr(module, name):
+			raise NotAvailable("%s.%s doesn't exist" % (moduleName, name))
+	return module
+
+def _initSettings():
+	from octoprint.settings import settings
+	basedir = tempfile.mkdtemp(prefix="octoprint-benchmark-")
+	settings(init=True, basedir=basedir)
+	return basedir
+
+def _best(function, repeat):
+	"""
+	Returns the shortest of repeat runs of function in seconds.
+	"""
+	best = None
+	for _ in range(repeat):
+		start = time.time()
+		function()
+		duration = time.time() - start
+		if best is None or duration < best:
+			best = duration
+	return best
+
+def _writeSprayRaster(path, lines):
+	with open(path, "w") as f:
+		f.write(";benchmark raster\n")
+		for i in range(lines):
+			x = 60.0 if i % 2 == 0 else -60.0
+			f.write("G1 X%.1f Y%.1f P-0.0123 F180.0\n" % (x, -80.0 + (i // 2) * 0.5))
+
+#~~ send window
+
+def benchmarkSendWindow(lines=2000, latency=0.002, windowLines=4, rxBufferSize=127):
+	"""
+	Prints a raster file against the virtual printer once in single line mode and, if the tree has a send window,
+	once with the send window enabled and reports the achieved throughput in lines per second.
+	"""
+	comm = _require("octoprint.util.comm", "MachineCom", "MachineComPrintCallback")
+	from octoprint.settings import settings
+
+	class BenchmarkCallback(comm.MachineComPrintCallback):
+		def __init__(self):
+			self.operational = threading.Event()
+			self.done = threading.Event()
+
+		def mcStateChange(self, state):
+			if state == comm.MachineCom.STATE_OPERATIONAL:
+				self.operational.set()
+
+		def mcPrintjobDone(self):
+			self.done.set()
+
+	basedir = _initSettings()
+	try:
+		settings().setFloat(["devel", "virtualPrinter", "latency"], latency)
+		settings().setInt(["serial", "sendWindow", "lines"], windowLines)
+		settings().setInt(["serial", "sendWindow", "rxBufferSize"], rxBufferSize)
+
+		path = os.path.join(basedir, "raster.gcode")
+		_writeSprayRaster(path, lines)
+
+		modes = ["single", "windowed"] if hasattr(comm, "SendWindow") else ["single"]
+		for mode in modes:
+			settings().setBoolean(["serial", "sendWindow", "enabled"], mode == "windowed")
+
+			callback = BenchmarkCallback()
+			machineCom = comm.MachineCom("VIRTUAL", 115200, callbackObject=callback)
+			if not callback.operational.wait(30):
+				raise RuntimeError("Virtual printer did not become operational")
+
+			machineCom.selectFile(path, False)
+			start = time.time()
+			machineCom.startPrint()
+			callback.done.wait()
+			duration = time.time() - start
+			machineCom.close()
+
+			print("%-8s %8.1f lines/s (%d lines in %.2fs)" % (mode, lines / duration, lines, duration))
+	finally:
+		shutil.rmtree(basedir, ignore_errors=True)
+
+#~~ response parsing
+
+def _synthesizeSerialLog(lines):
+	"""
+	Creates the responses of a deltaSpray run: mostly plain acknowledgements of the raster moves, interspersed with
+	temperature reports for the periodic M105, "wait" while idling in dwells, position reports and the odd resend.
+	"""
+	result = ["start\n", "echo:Marlin 1.0.0\n", "echo: Last Updated: deltaSpray\n", "SD init fail\n"]
+	for i in range(lines):
+		if i % 25 == 0:
+			result.append("ok T:21.3 /0.0 B:20.9 /0.0 @:0 B@:0\n")
+		elif i % 97 == 0:
+			result.append("wait\n")
+		elif i % 250 == 0:
+			result.append("ok C: X:60.00 Y:-55.50 Z:-44.00 E:0.00\n")
+		elif i % 1000 == 0:
+			result.append("Error:Line Number is not Last Line Number+1, Last Line: %d\n" % (i - 1))
+			result.append("Resend: %d\n" % i)
+			result.append("ok\n")
+		else:
+			result.append("ok\n")
+	return result
+
+def _loadSerialLog(path):
+	"""
+	Extracts the received lines from a serial.log as written by the SERIAL logger.
+	"""
+	lines = []
+	with open(path, "r") as f:
+		for logLine in f:
+			if "Recv: " in logLine:
+				lines.append(logLine[logLine.index("Recv: ") + len("Recv: "):].rstrip() + "\n")
+	return lines
+
+def benchmarkResponseParsing(lines=100000, log=None, repeat=3):
+	"""
+	Runs the lines of a recorded or synthesized serial log through the response classification and temperature
+	parsing of the receive loop and reports the number of lines parsed per second.
+	"""
+	comm = _require("octoprint.util.comm", "classifyResponse", "parseTemperatureResponse")
+
+	if log is not None:
+		responses = _loadSerialLog(log)
+	else:
+		responses = _synthesizeSerialLog(lines)
+
+	def parse():
+		for response in responses:
+			if comm.classifyResponse(response) == comm.RESPONSE_TEMPERATURE:
+				try:
+					comm.parseTemperatureResponse(response)
+				except ValueError:
+					pass
+
+	basedir = _initSettings()
+	try:
+		best = _best(parse, repeat)
+		print("parsing  %10.0f lines/s (%d lines in %.3fs)" % (len(responses) / best, len(responses), best))
+	finally:
+		shutil.rmtree(basedir, ignore_errors=True)
+
+#~~ spray method generation
+
+def benchmarkSprayGenerator(distance=0.5, cycles=30, repeat=3):
+	"""
+	Generates a spray method in full and streams it line by line, reporting the time each took and a digest of the
+	generated gcode to compare the output of different revisions by.
+	"""
+	sprayPath = _require("octoprint.util.sprayPath", "generateSprayMethod", "SprayPlan")
+
+	parameters = (distance, 120.0, 1000.0, 0.3, cycles, 5.0, "3")
+	cleanTemplate = ";clean\nG1 V2 F200\nG4 S1\n"
+
+	def generate():
+		sprayPath.generateSprayMethod(*parameters, cleanTemplate=cleanTemplate)
+
+	def stream():
+		for line in sprayPath.SprayPlan(*parameters, cleanTemplate=cleanTemplate).iterLines():
+			pass
+
+	basedir = _initSettings()
+	try:
+		gcode = sprayPath.generateSprayMethod(*parameters, cleanTemplate=cleanTemplate).gcode
+		for (name, function) in [("generate", generate), ("stream", stream)]:
+			print("%-10s %8.1f ms" % (name, _best(function, repeat) * 1000))
+		print("output     %d lines, sha1 %s" % (gcode.count("\n"), hashlib.sha1(gcode).hexdigest()))
+	finally:
+		shutil.rmtree(basedir, ignore_errors=True)
+
+#~~ gcode analysis
+
+def _writeAnalysisGcode(path, size):
+	"""
+	Writes a sliced looking gcode file of roughly the given size in bytes: layers of perimeters and infill with
+	retractions, travel moves and the odd G92/M106 in between.
+	"""
+	with open(path, "w") as f:
+		f.write(";FLAVOR:RepRap\n;Layer count: n\nM190 S60\nM109 S210\nG21\nG90\nM82\nG28 X0 Y0\nG28 Z0\nG92 E0\n")
+		e = 0.0
+		layer = 0
+		while f.tell() < size:
+			z = 0.2 + layer * 0.2
+			f.write(";LAYER:%d\nM106 S255\nG0 F9000 X10.000 Y10.000 Z%.3f\n;TYPE:WALL-OUTER\n" % (layer, z))
+			for i in range(400):
+				angle = i * math.pi / 200
+				e += 0.04321
+				f.write("G1 F1800 X%.3f Y%.3f E%.5f\n" % (100 + 40 * math.cos(angle), 100 + 40 * math.sin(angle), e))
+			f.write("G1 F2400 E%.5f\nG0 F9000 X60.000 Y60.000\nG1 F2400 E%.5f\n;TYPE:FILL\n" % (e - 4.5, e))
+			for i in range(200):
+				e += 0.08765
+				f.write("G1 X%.3f Y%.3f E%.5f\n" % (60.0 if i % 2 == 0 else 140.0, 60.0 + i * 0.4, e))
+			f.write("G92 E0\n")
+			e = 0.0
+			layer += 1
+		f.write("M104 S0\nM140 S0\nG91\nG1 E-1 F300\nG1 Z+0.5 E-5 X-20 Y-20 F9000\nG28 X0 Y0\nM84\nG90\n")
+
+def _getLayerListDigest(layerList):
+	digest = hashlib.sha1()
+	for layer in layerList:
+		digest.update("L")
+		for path in layer:
+			digest.update(repr((path.type, path.pathType, path.layerThickness)))
+			digest.update(repr([(point.x, point.y, point.z, point.e, point.extrudeAmountMultiply) for point in path.list]))
+	return digest.hexdigest()
+
+def benchmarkGcodeAnalysis(size=50, file=None):
+	"""
+	Analyses a sliced gcode file of the given size in MB and reports the throughput along with the results and a
+	digest of the layer list to compare the output of different revisions by.
+	"""
+	gcodeInterpreter = _require("octoprint.util.gcodeInterpreter", "gcode")
+
+	basedir = _initSettings()
+	try:
+		if file is None:
+			file = os.path.join(basedir, "analysis.gcode")
+			_writeAnalysisGcode(file, size * 1024 * 1024)
+		filesize = os.stat(file).st_size
+
+		gcode = gcodeInterpreter.gcode()
+		start = time.time()
+		gcode.load(file)
+		duration = time.time() - start
+
+		print("analysis   %8.2f MB/s (%.1f MB in %.2fs)" % (filesize / duration / 1024 / 1024, filesize / 1024.0 / 1024.0, duration))
+		print("results    %r, layers %s" % ((gcode.totalMoveTimeMinute, gcode.extrusionAmount, gcode.extrusionVolume), _getLayerListDigest(gcode.layerList)))
+	finally:
+		shutil.rmtree(basedir, ignore_errors=True)
+
+#~~ gcode analysis memory
+
+def _measureAnalysisMemory(file):
+	"""
+	Analyses the given file and prints the peak RSS in kB before and after and the layer list digest, meant to be
+	run in a process of its own.
+	"""
+	gcodeInterpreter = _require("octoprint.util.gcodeInterpreter", "gcode")
+	gcode = gcodeInterpreter.gcode()
+	before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	gcode.load(file)
+	after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	print("%d %d %s" % (before, after, _getLayerListDigest(gcode.layerList)))
+
+def benchmarkAnalysisMemory(tree, lines=200000, file=None):
+	"""
+	Analyses a spray raster with the given number of lines in a fresh process and reports the peak RSS and how much
+	of it the analysis took.
+	"""
+	_require("octoprint.util.gcodeInterpreter", "gcode")
+
+	basedir = tempfile.mkdtemp(prefix="octoprint-benchmark-")
+	try:
+		if file is None:
+			file = os.path.join(basedir, "spray.gcode")
+			_writeSprayRaster(file, lines)
+
+		output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--tree", tree, "analysisMemory", "--measure", "--file", file])
+		(before, after, digest) = output.split()
+		print("analysis   peak RSS %8d kB, %8d kB for the analysis, layers %s" % (int(after), int(after) - int(before), digest))
+	finally:
+		shutil.rmtree(basedir, ignore_errors=True)
+
+#~~ state broadcast
+
+class _BenchmarkConnection(object):
+	"""
+	Stands in for a PrinterStateConnection attached to a StateBroadcaster. A slow connection reports itself as
+	backlogged on three out of four updates.
+	"""
+
+	endpoint = None
+
+	def __init__(self, slow=False):
+		self._slow = slow
+		self._checks = 0
+		self.snapshotPending = False
+		self.messages = 0
+		self.snapshots = 0
+		self.sentBytes = 0
+
+	def isBacklogged(self):
+		self._checks += 1
+		return self._slow and self._checks % 4 != 0
+
+	def addMissed(self, temperatures, logs, messages):
+		pass
+
+	def drainMissed(self):
+		return {}
+
+	def sendEncoded(self, message):
+		self.messages += 1
+		self.sentBytes += len(message)
+		if '"name": "snapshot"' in message:
+			self.snapshots += 1
+
+	def sendHistoryData(self, data):
+		pass
+
+class _TimedCallback(object):
+	"""
+	Registered with the printer in place of the given callback, measures the time spent in it.
+	"""
+
+	def __init__(self, target):
+		self._target = target
+		self.duration = 0.0
+		self.pushes = 0
+
+	def sendCurrentData(self, sequence, changes):
+		self.pushes += 1
+		self._timed("sendCurrentData", sequence, changes)
+
+	def __getattr__(self, name):
+		return lambda *args: self._timed(name, *args)
+
+	def _timed(self, name, *args):
+		start = time.time()
+		try:
+			getattr(self._target, name)(*args)
+		finally:
+			self.duration += time.time() - start
+
+def benchmarkStateBroadcast(clients=20, slowClients=2, seconds=10.0, lines=20000):
+	"""
+	Prints a raster file against the virtual printer with the given number of simulated clients attached to the
+	StateBroadcaster and reports the time spent pushing the state updates to them.
+	"""
+	server = _require("octoprint.server", "StateBroadcaster")
+	from octoprint.printer import Printer
+	from octoprint.settings import settings
+	import octoprint.gcodefiles as gcodefiles
+	import octoprint.events as events
+
+	basedir = _initSettings()
+	try:
+		settings().setInt(["analysis", "processes"], 0)
+		path = os.path.join(basedir, "raster.gcode")
+		_writeSprayRaster(path, lines)
+
+		gcodeManager = gcodefiles.GcodeManager()
+		printer = Printer(gcodeManager)
+
+		broadcaster = server.StateBroadcaster(printer, gcodeManager, events.eventManager())
+		printer.unregisterCallback(broadcaster)
+		broadcast = _TimedCallback(broadcaster)
+		printer.registerCallback(broadcast)
+		connections = [_BenchmarkConnection(slow=i < slowClients) for i in range(clients)]
+		for connection in connections:
+			broadcaster.addConnection(connection)
+			broadcaster.subscribeLog(connection)
+
+		printer.connect("VIRTUAL", 115200)
+		timeout = time.time() + 30
+		while not printer.isOperational():
+			if time.time() > timeout:
+				raise RuntimeError("Virtual printer did not become operational")
+			time.sleep(0.1)
+
+		printer.selectFile(path, False, True)
+		time.sleep(seconds)
+		printer.cancelPrint()
+		printer.disconnect()
+
+		print("broadcast  %8.2f ms per update, %5.1f ms total per second (%d updates, %d messages, %.1f kB sent)" % (
+			broadcast.duration / max(1, broadcast.pushes) * 1000,
+			broadcast.duration / seconds * 1000,
+			broadcast.pushes,
+			sum([connection.messages for connection in connections]),
+			sum([connection.sentBytes for connection in connections]) / 1024.0
+		))
+		print("snapshots  %d slow clients got %d snapshots" % (slowClients, sum([connection.snapshots for connection in connections])))
+	finally:
+		shutil.rmtree(basedir, ignore_errors=True)
+
+#~~ command line interface
+
+def _runBaseline(revision, argv):
+	"""
+	Exports the octoprint package of the given git revision into a temporary folder and runs this script with the
+	given arguments against it.
+	"""
+	tree = tempfile.mkdtemp(prefix="octoprint-baseline-")
+	try:
+		archive = subprocess.Popen(["git", "archive", revision, "octoprint"], cwd=ROOT, stdout=subprocess.PIPE)
+		subprocess.check_call(["tar", "-x", "-C", tree], stdin=archive.stdout)
+		archive.stdout.close()
+		if archive.wait() != 0:
+			raise RuntimeError("Could not export revision %s" % revision)
+
+		print("== %s" % revision)
+		sys.stdout.flush()
+		subprocess.call([sys.executable, os.path.abspath(__file__), "--tree", tree] + argv)
+	finally:
+		shutil.rmtree(tree, ignore_errors=True)
+	print("== working tree")
+	sys.stdout.flush()
+
+def main():
+	import argparse
+
+	parser = argparse.ArgumentParser(prog="benchmarks/benchmark.py")
+	parser.add_argument("--baseline", action="store", type=str, dest="baseline",
+		help="Run the benchmark against this git revision first, for comparison")
+	parser.add_argument("--tree", action="store", type=str, dest="tree", default=ROOT,
+		help=argparse.SUPPRESS)
+	subparsers = parser.add_subparsers(dest="benchmark")
+
+	sendWindowParser = subparsers.add_parser("sendWindow", help="Throughput of single line vs windowed sending against the virtual printer")
+	sendWindowParser.add_argument("--lines", action="store", type=int, default=2000,
+		help="Number of lines to send, defaults to 2000")
+	sendWindowParser.add_argument("--latency", action="store", type=float, default=0.002,
+		help="Simulated one way latency of the serial line in seconds, defaults to 0.002")
+	sendWindowParser.add_argument("--window", action="store", type=int, default=4,
+		help="Maximum number of lines in flight in windowed mode, defaults to 4")
+	sendWindowParser.add_argument("--rxbuffer", action="store", type=int, default=127,
+		help="Size of the firmware's receive buffer in bytes, defaults to 127")
+
+	responseParsingParser = subparsers.add_parser("responseParsing", help="Lines per second parsed by the receive loop")
+	responseParsingParser.add_argument("--lines", action="store", type=int, default=100000,
+		help="Number of lines of the synthesized serial log, defaults to 100000")
+	responseParsingParser.add_argument("--log", action="store", type=str, dest="log",
+		help="Use the received lines from this serial.log instead of a synthesized one")
+
+	sprayGeneratorParser = subparsers.add_parser("sprayGenerator", help="Time needed to generate a spray method")
+	sprayGeneratorParser.add_argument("--distance", action="store", type=float, default=0.5,
+		help="Distance between the raster lines in mm, defaults to 0.5")
+	sprayGeneratorParser.add_argument("--cycles", action="store", type=int, default=30,
+		help="Number of spray cycles, defaults to 30")
+
+	gcodeAnalysisParser = subparsers.add_parser("gcodeAnalysis", help="Throughput of the gcode analysis")
+	gcodeAnalysisParser.add_argument("--size", action="store", type=int, default=50,
+		help="Size of the synthesized gcode file in MB, defaults to 50")
+	gcodeAnalysisParser.add_argument("--file", action="store", type=str, dest="file",
+		help="Analyse this gcode file instead of a synthesized one")
+
+	analysisMemoryParser = subparsers.add_parser("analysisMemory", help="Peak memory usage of the gcode analysis")
+	analysisMemoryParser.add_argument("--lines", action="store", type=int, default=200000,
+		help="Number of lines of the generated spray raster, defaults to 200000")
+	analysisMemoryParser.add_argument("--file", action="store", type=str, dest="file",
+		help="Analyse this gcode file instead of a generated spray raster")
+	analysisMemoryParser.add_argument("--measure", action="store_true",
+		help=argparse.SUPPRESS)
+
+	stateBroadcastParser = subparsers.add_parser("stateBroadcast", help="Time spent pushing state updates to connected clients")
+	stateBroadcastParser.add_argument("--clients", action="store", type=int, default=20,
+		help="Number of simulated clients, defaults to 20")
+	stateBroadcastParser.add_argument("--slow", action="store", type=int, default=2,
+		help="Number of those clients that can only keep up with every fourth update, defaults to 2")
+	stateBroadcastParser.add_argument("--seconds", action="store", type=float, default=10.0,
+		help="Duration of the print in seconds, defaults to 10")
+
+	args = parser.parse_args()
+
+	if args.baseline is not None:
+		argv = list(sys.argv[1:])
+		index = argv.index("--baseline")
+		del argv[index:index + 2]
+		_runBaseline(args.baseline, argv)
+
+	# everything from here on is imported from the tree under test
+	sys.path.insert(0, os.path.abspath(args.tree))
+
+	try:
+		if args.benchmark == "sendWindow":
+			benchmarkSendWindow(lines=args.lines, latency=args.latency, windowLines=args.window, rxBufferSize=args.rxbuffer)
+		elif args.benchmark == "responseParsing":
+			benchmarkResponseParsing(lines=args.lines, log=args.log)
+		elif args.benchmark == "sprayGenerator":
+			benchmarkSprayGenerator(distance=args.distance, cycles=args.cycles)
+		elif args.benchmark == "gcodeAnalysis":
+			benchmarkGcodeAnalysis(size=args.size, file=args.file)
+		elif args.benchmark == "analysisMemory":
+			if args.measure:
+				_measureAnalysisMemory(args.file)
+			else:
+				benchmarkAnalysisMemory(args.tree, lines=args.lines, file=args.file)
+		elif args.benchmark == "stateBroadcast":
+			benchmarkStateBroadcast(clients=args.clients, slowClients=args.slow, seconds=args.seconds)
+	except NotAvailable, e:
+		print("not available: %s" % str(e))
+
+if __name__ == "__main__":
+	main()
@@ -4,19 +4,43 @@ __license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agp
 
 import os
 import Queue
+import signal
 import threading
+import multiprocessing
 import datetime
 import yaml
 import time
+import hashlib
 import logging
+import json
+import atexit
+import sqlite3
+import uuid
 import octoprint.util as util
 import octoprint.util.gcodeInterpreter as gcodeInterpreter
+import octoprint.util.gcodeCompiler as gcodeCompiler
 from octoprint.settings import settings
 
 from werkzeug.utils import secure_filename
 
 SUPPORTED_EXTENSIONS=["gcode", "gco"]
 
+FILE_SORT_KEYS = {
+	"name": lambda entry: entry[0]["name"].lower(),
+	"size": lambda entry: entry[0]["bytes"],
+	"date": lambda entry: entry[1]
+}
+
+# seconds the free space of the upload folder is cached for
+FREE_BYTES_MAX_AGE = 10
+
+# temporary files of uploads in progress in the upload folder, see UploadStream
+UPLOAD_PREFIX = ".upload-"
+UPLOAD_SUFFIX = ".tmp"
+
+# number of received bytes the analysis of an upload may lag behind before it is given up on
+UPLOAD_ANALYSIS_BACKLOG = 16 * 1024 * 1024
+
 class GcodeManager:
 	def __init__(self):
 		self._logger = logging.getLogger(__name__)
@@ -25,16 +49,45 @@ class GcodeManager:
 
 		self._callbacks = []
 
-		self._metadata = {}
-		self._metadataDirty = False
-		self._metadataFile = os.path.join(self._uploadFolder, "metadata.yaml")
-		self._metadataFileAccessMutex = threading.Lock()
+		# filename => (file data, ctime) of all files in the upload folder, rebuilt whenever the gcode files change
+		# behind our back and updated in place on changes made through this manager
+		self._fileIndex = None
+		self._fileIndexSignature = None
+		self._fileIndexSorted = {}
+		self._fileIndexMutex = threading.RLock()
 
-		self._metadataAnalyzer = MetadataAnalyzer(getPathCallback=self.getAbsolutePath, loadedCallback=self._onMetadataAnalysisFinished)
+		self._freeBytes = None
+		self._freeBytesTimestamp = None
 
-		self._loadMetadata()
+		metadataStoreName = settings().get(["metadata", "store"])
+		try:
+			self._metadataStore = util.getClass(metadataStoreName)(self._uploadFolder)
+		except:
+			self._logger.exception("Could not instantiate metadata store %s, falling back to metadata.yaml" % metadataStoreName)
+			self._metadataStore = YamlMetadataStore(self._uploadFolder)
+
+		self._analysisCache = AnalysisCache(os.path.join(self._uploadFolder, "analysisCache.db"), settings().getInt(["analysis", "cacheSize"]))
+		self._metadataAnalyzer = MetadataAnalyzer(getPathCallback=self.getAbsolutePath, loadedCallback=self._onMetadataAnalysisFinished, cache=self._analysisCache)
+
+		# jobs are compiled for sending (see octoprint.util.gcodeCompiler) one after the other in the background
+		self._compileQueue = Queue.Queue()
+		compileThread = threading.Thread(target=self._compileWorker)
+		compileThread.daemon = True
+		compileThread.start()
+
+		self._removeStaleUploads()
 		self._processAnalysisBacklog()
 
+	def _removeStaleUploads(self):
+		compiledSuffixes = tuple(gcodeCompiler.COMPILED_EXTENSION + suffix for suffix in ("", ".tmp", ".data.tmp"))
+		for osFile in os.listdir(self._uploadFolder):
+			# compiled jobs used to be stored next to the uploads, they live in their own folder now
+			if (osFile.startswith(UPLOAD_PREFIX) and osFile.endswith(UPLOAD_SUFFIX)) or osFile.endswith(compiledSuffixes):
+				try:
+					os.remove(os.path.join(self._uploadFolder, osFile))
+				except:
+					self._logger.exception("Could not remove stale upload %s" % osFile)
+
 	def _processAnalysisBacklog(self):
 		for osFile in os.listdir(self._uploadFolder):
 			filename = self._getBasicFilename(osFile)
@@ -48,8 +101,8 @@ class GcodeManager:
 
 			self._metadataAnalyzer.addFileToBacklog(filename)
 
-	def _onMetadataAnalysisFinished(self, filename, gcode):
-		if filename is None or gcode is None:
+	def _onMetadataAnalysisFinished(self, filename, analysis):
+		if filename is None or analysis is None:
 			return
 
 		basename = os.path.basename(filename)
@@ -60,39 +113,95 @@ class GcodeManager:
 
 		analysisResult = {}
 		dirty = False
-		if gcode.totalMoveTimeMinute:
-			analysisResult["estimatedPrintTime"] = util.getFormattedTimeDelta(datetime.timedelta(minutes=gcode.totalMoveTimeMinute))
+		if analysis["totalMoveTimeMinute"]:
+			analysisResult["estimatedPrintTime"] = util.getFormattedTimeDelta(datetime.timedelta(minutes=analysis["totalMoveTimeMinute"]))
 			dirty = True
-		if gcode.extrusionAmount:
-			analysisResult["filament"] = "%.2fm" % (gcode.extrusionAmount / 1000)
-			if gcode.extrusionVolume:
-				 analysisResult["filament"] += " / %.2fcm³" % gcode.extrusionVolume
+		if analysis["extrusionAmount"]:
+			analysisResult["filament"] = "%.2fm" % (analysis["extrusionAmount"] / 1000)
+			if analysis["extrusionVolume"]:
+				 analysisResult["filament"] += " / %.2fcm³" % analysis["extrusionVolume"]
 			dirty = True
 
 		if dirty:
 			metadata = self.getFileMetadata(basename)
 			metadata["gcodeAnalysis"] = analysisResult
-			self._metadata[basename] = metadata
-			self._metadataDirty = True
+			self.setFileMetadata(basename, metadata)
 			self._saveMetadata()
 
-	def _loadMetadata(self):
-		if os.path.exists(self._metadataFile) and os.path.isfile(self._metadataFile):
-			with self._metadataFileAccessMutex:
-				with open(self._metadataFile, "r") as f:
-					self._metadata = yaml.safe_load(f)
-		if self._metadata is None:
-			self._metadata = {}
+	#~~ file index
+
+	def _getFileIndex(self):
+		with self._fileIndexMutex:
+			# the folder's mtime also changes with temporary uploads and the databases, so the gcode files themselves
+			# are compared instead, which also catches files modified in place
+			signature = self._getFolderSignature()
+			if self._fileIndex is None:
+				self._fileIndex = {}
+				self._fileIndexSignature = {}
+			if signature == self._fileIndexSignature:
+				return self._fileIndex
+
+			# only the entries of files added, removed or modified behind our back are recreated
+			for filename in self._fileIndexSignature.keys():
+				if not filename in signature:
+					self._fileIndex.pop(filename, None)
+			for (filename, fileSignature) in signature.items():
+				if self._fileIndexSignature.get(filename) == fileSignature and filename in self._fileIndex:
+					continue
+				entry = self._createFileIndexEntry(filename)
+				if entry is None:
+					self._fileIndex.pop(filename, None)
+				else:
+					self._fileIndex[filename] = entry
+			self._fileIndexSignature = signature
+			self._fileIndexSorted = {}
+			return self._fileIndex
 
-	def _saveMetadata(self, force=False):
-		if not self._metadataDirty and not force:
-			return
+	def _getFolderSignature(self):
+		"""
+		Returns filename => (mtime, size) of all gcode files in the upload folder.
+		"""
+		signature = {}
+		for osFile in os.listdir(self._uploadFolder):
+			fileSignature = self._getFileSignature(osFile)
+			if fileSignature is not None:
+				signature[osFile] = fileSignature
+		return signature
 
-		with self._metadataFileAccessMutex:
-			with open(self._metadataFile, "wb") as f:
-				yaml.safe_dump(self._metadata, f, default_flow_style=False, indent="    ", allow_unicode=True)
-				self._metadataDirty = False
-		self._loadMetadata()
+	def _getFileSignature(self, filename):
+		absolutePath = self.getAbsolutePath(filename, mustExist=False)
+		if absolutePath is None:
+			return None
+		try:
+			statResult = os.stat(absolutePath)
+		except OSError:
+			return None
+		return (statResult.st_mtime, statResult.st_size)
+
+	def _updateFileIndex(self, filename):
+		with self._fileIndexMutex:
+			if self._fileIndex is None:
+				return
+
+			entry = self._createFileIndexEntry(filename)
+			fileSignature = self._getFileSignature(filename)
+			if entry is None or fileSignature is None:
+				self._fileIndex.pop(filename, None)
+				self._fileIndexSignature.pop(filename, None)
+			else:
+				self._fileIndex[filename] = entry
+				self._fileIndexSignature[filename] = fileSignature
+			self._fileIndexSorted = {}
+			self._freeBytes = None
+
+	def _createFileIndexEntry(self, filename):
+		fileData = self.getFileData(filename)
+		if fileData is None:
+			return None
+		return (fileData, os.stat(self.getAbsolutePath(filename)).st_ctime)
+
+	def _saveMetadata(self):
+		self._metadataStore.commit()
 		self._sendUpdateTrigger("gcodeFiles")
 
 	def _getBasicFilename(self, filename):
@@ -126,15 +235,68 @@ class GcodeManager:
 			return None
 
 		basename = self._getBasicFilename(absolutePath)
-		if basename in self._metadata.keys():
+		if self._metadataStore.get(basename) is not None:
 			# delete existing metadata entry, since the file is going to get overwritten
-			del self._metadata[basename]
-			self._metadataDirty = True
+			self._metadataStore.remove(basename)
 			self._saveMetadata()
-		file.save(absolutePath)
-		self._metadataAnalyzer.addFileToQueue(basename)
+
+		upload = file.stream if isinstance(file.stream, UploadStream) else None
+		if upload is not None:
+			upload.commit(absolutePath)
+		else:
+			file.save(absolutePath)
+
+		gcodeCompiler.removeCompiled(absolutePath)
+		if settings().getBoolean(["feature", "precompileJobs"]):
+			self.scheduleCompilation(basename)
+		self._updateFileIndex(basename)
+
+		if upload is not None:
+			cachedResult = self._analysisCache.get(upload.fileHash)
+			if cachedResult is not None:
+				upload.abortAnalysis()
+				self._onMetadataAnalysisFinished(basename, cachedResult)
+			else:
+				upload.whenAnalysed(lambda result: self._onUploadAnalysed(basename, upload.fileHash, result))
+		else:
+			self._metadataAnalyzer.addFileToQueue(basename)
 		return basename
 
+	def scheduleCompilation(self, filename):
+		"""
+		Compiles the given file for sending in the background unless an up to date compiled version already exists.
+		Until then the file is sent as is.
+		"""
+		self._compileQueue.put(filename)
+
+	def _compileWorker(self):
+		while True:
+			filename = self._compileQueue.get()
+			absolutePath = self.getAbsolutePath(filename)
+			if absolutePath is None or gcodeCompiler.isCompiled(absolutePath):
+				continue
+			try:
+				gcodeCompiler.compileGcode(absolutePath)
+			except:
+				self._logger.exception("Could not compile %s, it will be sent as is" % filename)
+
+	def createUploadStream(self, filename):
+		"""
+		Returns an UploadStream to receive the upload of the given file into, or None if the file can't be added to
+		the upload folder anyway. The analysis of the file runs along with the upload unless the analyzer is paused.
+		"""
+		if not filename or not util.isAllowedFile(filename.lower(), set(SUPPORTED_EXTENSIONS)):
+			return None
+		return UploadStream(self._uploadFolder, analyse=self._metadataAnalyzer.isActive())
+
+	def _onUploadAnalysed(self, filename, fileHash, result):
+		if result is None:
+			self._metadataAnalyzer.addFileToQueue(filename)
+			return
+
+		self._analysisCache.set(fileHash, result)
+		self._onMetadataAnalysisFinished(filename, result)
+
 	def getFutureFilename(self, file):
 		if not file:
 			return None
@@ -152,10 +314,11 @@ class GcodeManager:
 			return
 
 		os.remove(absolutePath)
-		if filename in self._metadata.keys():
-			del self._metadata[filename]
-			self._metadataDirty = True
+		gcodeCompiler.removeCompiled(absolutePath)
+		if self._metadataStore.get(filename) is not None:
+			self._metadataStore.remove(filename)
 			self._saveMetadata()
+		self._updateFileIndex(filename)
 
 	def getAbsolutePath(self, filename, mustExist=True):
 		"""
@@ -182,13 +345,38 @@ class GcodeManager:
 
 		return secure
 
-	def getAllFileData(self):
-		files = []
-		for osFile in os.listdir(self._uploadFolder):
-			fileData = self.getFileData(osFile)
-			if fileData is not None:
-				files.append(fileData)
-		return files
+	def getAllFileData(self, sortBy="name", reverse=False, offset=0, limit=None):
+		"""
+		Returns the data of the files in the upload folder, sorted by the given key (one of FILE_SORT_KEYS) and
+		optionally restricted to the page starting at offset with at most limit entries.
+
+		The listing is served from an index that is only rebuilt if the gcode files in the upload folder were changed
+		by something else than this manager, the returned file data must not be modified.
+		"""
+		if not sortBy in FILE_SORT_KEYS:
+			sortBy = "name"
+
+		with self._fileIndexMutex:
+			index = self._getFileIndex()
+			sortKey = (sortBy, reverse)
+			if not sortKey in self._fileIndexSorted:
+				self._fileIndexSorted[sortKey] = [entry[0] for entry in sorted(index.values(), key=FILE_SORT_KEYS[sortBy], reverse=reverse)]
+			files = self._fileIndexSorted[sortKey]
+
+		if limit is None:
+			return files[offset:]
+		return files[offset:offset + limit]
+
+	def getFileCount(self):
+		with self._fileIndexMutex:
+			return len(self._getFileIndex())
+
+	def getFreeBytes(self):
+		now = time.time()
+		if self._freeBytes is None or now - self._freeBytesTimestamp > FREE_BYTES_MAX_AGE:
+			self._freeBytes = util.getFreeBytes(self._uploadFolder)
+			self._freeBytesTimestamp = now
+		return self._freeBytes
 
 	def getFileData(self, filename):
 		filename = self._getBasicFilename(filename)
@@ -205,10 +393,11 @@ class GcodeManager:
 		}
 
 		# enrich with additional metadata from analysis if available
-		if filename in self._metadata.keys():
-			for key in self._metadata[filename].keys():
+		metadata = self._metadataStore.get(filename)
+		if metadata is not None:
+			for key in metadata.keys():
 				if key == "prints":
-					val = self._metadata[filename][key]
+					val = metadata[key]
 					formattedLast = None
 					if val["last"] is not None:
 						formattedLast = {
@@ -222,14 +411,15 @@ class GcodeManager:
 					}
 					fileData["prints"] = formattedPrints
 				else:
-					fileData[key] = self._metadata[filename][key]
+					fileData[key] = metadata[key]
 
 		return fileData
 
 	def getFileMetadata(self, filename):
 		filename = self._getBasicFilename(filename)
-		if filename in self._metadata.keys():
-			return self._metadata[filename]
+		metadata = self._metadataStore.get(filename)
+		if metadata is not None:
+			return metadata
 		else:
 			return {
 				"prints": {
@@ -241,8 +431,8 @@ class GcodeManager:
 
 	def setFileMetadata(self, filename, metadata):
 		filename = self._getBasicFilename(filename)
-		self._metadata[filename] = metadata
-		self._metadataDirty = True
+		self._metadataStore.set(filename, metadata)
+		self._updateFileIndex(filename)
 
 	#~~ print job data
 
@@ -311,21 +501,46 @@ class GcodeManager:
 		self._metadataAnalyzer.resume()
 
 class MetadataAnalyzer:
-	def __init__(self, getPathCallback, loadedCallback):
+	"""
+	Analyses gcode files in the background, files added via addFileToQueue before those added via addFileToBacklog.
+
+	Depending on the setting analysis.processes, the analysis either runs in a thread of its own (0) or in a pool of
+	that many worker processes, which only get the path of the file to analyse and send back the result as a small
+	dict. The pool is forked right away, so create the analyzer before any other threads (serial connection, web
+	server) are started. Each job in the pool is waited for by a thread of its own for at most analysis.timeout
+	seconds, so a worker process that gets killed (e.g. running out of memory) doesn't block its slot forever.
+	Either way pausing the analyzer aborts all running analyses, they are restarted first thing on resume.
+
+	If a cache is given, files whose contents have been analysed before are answered from it without parsing them.
+	"""
+
+	def __init__(self, getPathCallback, loadedCallback, cache=None):
 		self._logger = logging.getLogger(__name__)
 
 		self._getPathCallback = getPathCallback
 		self._loadedCallback = loadedCallback
+		self._cache = cache
 
 		self._active = threading.Event()
 		self._active.set()
 
-		self._currentFile = None
+		self._currentFiles = set()
 		self._currentProgress = None
+		self._currentFilesMutex = threading.Lock()
 
 		self._queue = Queue.PriorityQueue()
 		self._gcode = None
 
+		self._processes = settings().getInt(["analysis", "processes"])
+		self._timeout = settings().getFloat(["analysis", "timeout"])
+		self._pool = None
+		self._abortEvent = None
+		if self._processes > 0:
+			self._logger.debug("Starting %d analysis worker processes" % self._processes)
+			self._abortEvent = multiprocessing.Event()
+			self._pool = multiprocessing.Pool(self._processes, initializer=_initAnalysisProcess, initargs=(self._abortEvent,))
+		self._slots = threading.Semaphore(max(1, self._processes))
+
 		self._worker = threading.Thread(target=self._work)
 		self._worker.daemon = True
 		self._worker.start()
@@ -339,61 +554,647 @@ class MetadataAnalyzer:
 		self._queue.put((100, filename))
 
 	def working(self):
-		return self.isActive() and not (self._queue.empty() and self._currentFile is None)
+		return self.isActive() and not (self._queue.empty() and len(self._currentFiles) == 0)
 
 	def isActive(self):
 		return self._active.is_set()
 
 	def pause(self):
 		self._logger.debug("Pausing Gcode analyzer")
-		self._active.clear()
-		if self._gcode is not None:
+		# under the lock, so no job can be submitted after the check for being active but before pausing
+		with self._currentFilesMutex:
+			self._active.clear()
+			if self._abortEvent is not None:
+				self._logger.debug("Aborting running analyses, will restart when Gcode analyzer is resumed")
+				self._abortEvent.set()
+		gcode = self._gcode
+		if gcode is not None:
 			self._logger.debug("Aborting running analysis, will restart when Gcode analyzer is resumed")
-			self._gcode.abort()
+			gcode.abort()
 
 	def resume(self):
 		self._logger.debug("Resuming Gcode analyzer")
+		if self._abortEvent is not None:
+			self._abortEvent.clear()
 		self._active.set()
 
 	def _work(self):
-		aborted = None
 		while True:
 			self._active.wait()
+			self._slots.acquire()
 
-			if aborted is not None:
-				filename = aborted
-				aborted = None
-				self._logger.debug("Got an aborted analysis job for file %s, processing this instead of first item in queue" % filename)
+			(priority, filename) = self._queue.get()
+			if not self._active.is_set():
+				# got paused while waiting, put the file back and wait for resume
+				self._queue.put((priority, filename))
+				self._queue.task_done()
+				self._slots.release()
+				continue
+
+			if priority < 0:
+				self._logger.debug("Got an aborted analysis job for file %s, processing this before the rest of the queue" % filename)
 			else:
-				(priority, filename) = self._queue.get()
 				self._logger.debug("Processing file %s from queue (priority %d)" % (filename, priority))
 
-			try:
-				self._analyzeGcode(filename)
+			path = self._getPathCallback(filename)
+			if path is None:
 				self._queue.task_done()
-			except gcodeInterpreter.AnalysisAborted:
-				aborted = filename
-				self._logger.debug("Running analysis of file %s aborted" % filename)
+				self._slots.release()
+				continue
 
-	def _analyzeGcode(self, filename):
-		path = self._getPathCallback(filename)
-		if path is None:
-			return
+			fileHash = None
+			if self._cache is not None:
+				try:
+					fileHash = getFileHash(path)
+				except:
+					self._logger.exception("Could not hash file %s, analysing it without cache" % filename)
+
+				result = self._cache.get(fileHash) if fileHash is not None else None
+				if result is not None:
+					self._logger.debug("Found cached analysis for file %s" % filename)
+					self._onAnalysisDone(filename, result)
+					continue
+
+			with self._currentFilesMutex:
+				if not self._active.is_set():
+					# got paused in the meantime, restart with the highest priority on resume
+					self._queue.put((-1, filename))
+					self._queue.task_done()
+					self._slots.release()
+					continue
+
+				self._currentFiles.add(filename)
+				if self._pool is not None:
+					self._logger.debug("Starting analysis of file %s in worker process" % filename)
+					asyncResult = self._pool.apply_async(_analyzeInProcess, (path,))
+					waiter = threading.Thread(target=self._waitForAnalysis, args=(filename, fileHash, asyncResult))
+					waiter.daemon = True
+					waiter.start()
+					continue
+
+			self._onAnalysisDone(filename, self._analyzeGcode(filename, path), fileHash)
+
+	def _waitForAnalysis(self, filename, fileHash, asyncResult):
+		result = None
+		try:
+			result = asyncResult.get(self._timeout)
+		except multiprocessing.TimeoutError:
+			# the pool of Python 2.7 silently loses the jobs of worker processes that die
+			self._logger.error("Analysis of file %s didn't finish within %.0fs, giving up on it" % (filename, self._timeout))
+		except:
+			self._logger.exception("Error while waiting for the analysis of file %s" % filename)
+		finally:
+			self._onAnalysisDone(filename, result, fileHash)
 
-		self._currentFile = filename
+	def _analyzeGcode(self, filename, path):
 		self._currentProgress = 0
 
 		try:
 			self._logger.debug("Starting analysis of file %s" % filename)
 			self._gcode = gcodeInterpreter.gcode()
 			self._gcode.progressCallback = self._onParsingProgress
+			if not self._active.is_set():
+				# paused before pause could see this analysis
+				self._gcode.abort()
 			self._gcode.load(path)
-			self._logger.debug("Analysis of file %s finished, notifying callback" % filename)
-			self._loadedCallback(self._currentFile, self._gcode)
+			return _getAnalysisResult(self._gcode)
+		except gcodeInterpreter.AnalysisAborted:
+			return {"aborted": True}
+		except:
+			self._logger.exception("Error while analysing file %s" % filename)
+			return None
 		finally:
 			self._gcode = None
 			self._currentProgress = None
-			self._currentFile = None
+
+	def _onAnalysisDone(self, filename, result, fileHash=None):
+		try:
+			if result is not None and result.get("aborted", False):
+				# restart with the highest priority on resume
+				self._logger.debug("Running analysis of file %s aborted" % filename)
+				self._queue.put((-1, filename))
+			elif result is not None and "error" in result:
+				self._logger.error("Error while analysing file %s: %s" % (filename, result["error"]))
+			elif result is not None:
+				self._logger.debug("Analysis of file %s finished, notifying callback" % filename)
+				if self._cache is not None and fileHash is not None:
+					self._cache.set(fileHash, result)
+				self._loadedCallback(filename, result)
+		finally:
+			with self._currentFilesMutex:
+				self._currentFiles.discard(filename)
+			self._queue.task_done()
+			self._slots.release()
 
 	def _onParsingProgress(self, progress):
 		self._currentProgress = progress
+
+#~~ streaming uploads
+
+class UploadStream(object):
+	"""
+	File-like object an uploaded file is written into while it arrives (see GcodeManager.createUploadStream and
+	server.UploadHTTPConnection). The data goes straight into a temporary file in the upload folder, is hashed on the
+	way and, if analyse is set, parsed by a gcodeInterpreter in a thread of its own, so the upload is never held in
+	memory as a whole nor read again for hashing and analysis once it's complete. Call finish once all data is
+	written.
+
+	If the analysis falls behind the upload by more than UPLOAD_ANALYSIS_BACKLOG bytes it is given up on instead of
+	buffering or slowing down the upload, the result reported to whenAnalysed is None then.
+	"""
+
+	def __init__(self, folder, analyse=True):
+		self._logger = logging.getLogger(__name__)
+
+		# not mkstemp, the file ends up in the upload folder and should get the same permissions as any other file
+		self._path = os.path.join(folder, UPLOAD_PREFIX + uuid.uuid4().hex + UPLOAD_SUFFIX)
+		self._file = os.fdopen(os.open(self._path, os.O_RDWR | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0666), "w+b")
+		self._hash = hashlib.sha1()
+		self._remainder = ""
+		self._complete = False
+		self._closed = False
+		self.fileHash = None
+
+		self._analysisQueue = None
+		self._analysisBacklog = 0
+		self._analysisBacklogMutex = threading.Lock()
+		self._analysisAborted = False
+		self._analysisResult = None
+		self._analysisCallback = None
+		self._analysisDone = threading.Event()
+		self._analysisMutex = threading.Lock()
+		self._gcode = None
+
+		if analyse:
+			self._analysisQueue = Queue.Queue()
+			self._gcode = gcodeInterpreter.gcode()
+			analysisThread = threading.Thread(target=self._analyse, args=(self._gcode, self._analysisQueue))
+			analysisThread.daemon = True
+			analysisThread.start()
+		else:
+			self._analysisDone.set()
+
+	#~~ file interface used by werkzeug
+
+	def write(self, data):
+		self._file.write(data)
+		self._hash.update(data)
+
+		if self._analysisQueue is not None:
+			data = self._remainder + data
+			end = data.rfind("\n") + 1
+			self._remainder = data[end:]
+			if end > 0:
+				with self._analysisBacklogMutex:
+					self._analysisBacklog += end
+					backlog = self._analysisBacklog
+				if backlog > UPLOAD_ANALYSIS_BACKLOG:
+					self._logger.debug("Analysis can't keep up with the upload, analysing it once it's complete instead")
+					self.abortAnalysis()
+				else:
+					self._analysisQueue.put((end, data[:end].splitlines(True)))
+
+	def seek(self, offset, whence=0):
+		self.finish()
+		self._file.seek(offset, whence)
+
+	def tell(self):
+		return self._file.tell()
+
+	def read(self, *args):
+		return self._file.read(*args)
+
+	def readline(self, *args):
+		return self._file.readline(*args)
+
+	def flush(self):
+		self._file.flush()
+
+	def close(self):
+		if self._closed:
+			return
+		self._closed = True
+		self.abortAnalysis()
+		self._file.close()
+		if os.path.exists(self._path):
+			os.remove(self._path)
+
+	def __del__(self):
+		try:
+			self.close()
+		except:
+			pass
+
+	#~~ handing over the upload
+
+	def commit(self, path):
+		"""
+		Moves the completely received file to the given path.
+		"""
+		self.finish()
+		self._file.close()
+		if os.path.exists(path):
+			os.remove(path)
+		os.rename(self._path, path)
+		self._closed = True
+
+	def whenAnalysed(self, callback):
+		"""
+		Calls callback with the analysis result of the upload (see _getAnalysisResult) or None if it wasn't analysed,
+		right away if the analysis is already done, from the analysis thread once it's done otherwise.
+		"""
+		with self._analysisMutex:
+			if not self._analysisDone.is_set():
+				self._analysisCallback = callback
+				return
+		callback(self._analysisResult)
+
+	def abortAnalysis(self):
+		analysisQueue = self._analysisQueue
+		if analysisQueue is None:
+			return
+		self._analysisQueue = None
+		self._analysisAborted = True
+		self._gcode.abort()
+
+		# drop what's still queued, the analysis thread stops at the end marker anyway
+		try:
+			while True:
+				analysisQueue.get_nowait()
+		except Queue.Empty:
+			pass
+		analysisQueue.put(None)
+
+	def finish(self):
+		"""
+		Marks the upload as completely received.
+		"""
+		if self._complete:
+			return
+		self._complete = True
+		self.fileHash = self._hash.hexdigest()
+		if self._analysisQueue is not None:
+			if len(self._remainder) > 0:
+				self._analysisQueue.put((len(self._remainder), [self._remainder]))
+				self._remainder = ""
+			self._analysisQueue.put(None)
+			self._analysisQueue = None
+
+	def _analyse(self, gcode, analysisQueue):
+		result = None
+		try:
+			gcode.loadList(self._iterQueuedLines(analysisQueue))
+			result = _getAnalysisResult(gcode)
+		except gcodeInterpreter.AnalysisAborted:
+			pass
+		except:
+			self._logger.exception("Error while analysing upload")
+
+		if self._analysisAborted:
+			# aborted after the last progress check
+			result = None
+
+		with self._analysisMutex:
+			self._analysisResult = result
+			self._analysisDone.set()
+			callback = self._analysisCallback
+			self._analysisCallback = None
+		if callback is not None:
+			callback(result)
+
+	def _iterQueuedLines(self, analysisQueue):
+		while True:
+			chunk = analysisQueue.get()
+			if chunk is None:
+				return
+			(size, lines) = chunk
+			for line in lines:
+				yield line
+			with self._analysisBacklogMutex:
+				self._analysisBacklog -= size
+
+#~~ metadata stores
+
+class MetadataStore(object):
+	"""
+	Persists the metadata of the files in the upload folder. Changes made via set and remove become visible to get
+	right away but are only guaranteed to be persisted after commit has been called, which implementations may batch
+	up.
+	"""
+
+	def __init__(self, folder):
+		pass
+
+	def get(self, filename):
+		return None
+
+	def set(self, filename, metadata):
+		pass
+
+	def remove(self, filename):
+		pass
+
+	def commit(self):
+		pass
+
+	def close(self):
+		pass
+
+class YamlMetadataStore(MetadataStore):
+	"""
+	Keeps all metadata in metadata.yaml in the upload folder, which is rewritten in full on every commit.
+	"""
+
+	def __init__(self, folder):
+		MetadataStore.__init__(self, folder)
+		self._logger = logging.getLogger(__name__)
+		self._path = os.path.join(folder, "metadata.yaml")
+		self._mutex = threading.Lock()
+		self._dirty = False
+
+		self._metadata = _loadYamlMetadata(self._path)
+
+	def get(self, filename):
+		with self._mutex:
+			return self._metadata.get(filename, None)
+
+	def set(self, filename, metadata):
+		with self._mutex:
+			self._metadata[filename] = metadata
+			self._dirty = True
+
+	def remove(self, filename):
+		with self._mutex:
+			if filename in self._metadata:
+				del self._metadata[filename]
+				self._dirty = True
+
+	def commit(self):
+		with self._mutex:
+			if not self._dirty:
+				return
+			with open(self._path, "wb") as f:
+				yaml.safe_dump(self._metadata, f, default_flow_style=False, indent="    ", allow_unicode=True)
+			self._dirty = False
+
+class SqliteDatabase(object):
+	"""
+	The SQLite database at the given path, shared by all threads and running in write-ahead logging mode. Statements
+	given as schema are executed once it is opened. Changes are written right away but committed in batches via
+	commit, at most every metadata.commitInterval seconds, so a crash loses at most the changes of the last interval
+	and never leaves the database half written. It is committed and closed on exit.
+
+	All access to the connection has to happen while holding mutex.
+	"""
+
+	def __init__(self, path, schema):
+		self._logger = logging.getLogger(__name__)
+		self._path = path
+		self._commitInterval = settings().getFloat(["metadata", "commitInterval"])
+		self._commitTimer = None
+		self.mutex = threading.RLock()
+
+		self._connection = sqlite3.connect(self._path, check_same_thread=False)
+		self._connection.execute("PRAGMA journal_mode=WAL")
+		self._connection.execute("PRAGMA synchronous=NORMAL")
+		for statement in schema:
+			self._connection.execute(statement)
+		self._connection.commit()
+
+		atexit.register(self.close)
+
+	def isOpen(self):
+		return self._connection is not None
+
+	def execute(self, statement, parameters=()):
+		with self.mutex:
+			return self._connection.execute(statement, parameters)
+
+	def importYaml(self, path, importer, keepFile=False):
+		"""
+		Hands the contents of the YAML file at the given path to importer, if it exists, and commits the result right
+		away. The file is renamed to path + ".migrated" afterwards. With keepFile it is left in place instead and the
+		import is remembered in the database's user_version, so it only happens once.
+		"""
+		if not os.path.isfile(path):
+			return
+		if keepFile and self.execute("PRAGMA user_version").fetchone()[0] > 0:
+			return
+
+		try:
+			with open(path, "r") as f:
+				data = yaml.safe_load(f)
+		except:
+			self._logger.exception("Could not load %s for import" % path)
+			return
+
+		with self.mutex:
+			importer(data)
+			if keepFile:
+				self._connection.execute("PRAGMA user_version = 1")
+			self._connection.commit()
+		if not keepFile:
+			os.rename(path, path + ".migrated")
+		self._logger.info("Imported %s" % path)
+
+	def commit(self):
+		with self.mutex:
+			if self._connection is None:
+				return
+			if not self._commitInterval:
+				self._connection.commit()
+			elif self._commitTimer is None:
+				self._commitTimer = threading.Timer(self._commitInterval, self._commitNow)
+				self._commitTimer.daemon = True
+				self._commitTimer.start()
+
+	def _commitNow(self):
+		with self.mutex:
+			self._commitTimer = None
+			if self._connection is not None:
+				self._connection.commit()
+
+	def close(self):
+		with self.mutex:
+			if self._connection is None:
+				return
+			if self._commitTimer is not None:
+				self._commitTimer.cancel()
+				self._commitTimer = None
+			self._connection.commit()
+			self._connection.close()
+			self._connection = None
+
+class SqliteMetadataStore(MetadataStore):
+	"""
+	Keeps the metadata in an SQLite database (metadata.db in the upload folder, see SqliteDatabase) with one row per
+	file, so changing the metadata of one file only writes that file's row. Enabled by setting metadata.store to
+	octoprint.gcodefiles.SqliteMetadataStore.
+
+	An existing metadata.yaml is imported on first start and left in place, so going back to YamlMetadataStore or
+	an older version still finds the metadata as of the switch.
+	"""
+
+	def __init__(self, folder):
+		MetadataStore.__init__(self, folder)
+		self._logger = logging.getLogger(__name__)
+		self._database = SqliteDatabase(os.path.join(folder, "metadata.db"), [
+			"CREATE TABLE IF NOT EXISTS metadata (filename TEXT PRIMARY KEY, data TEXT NOT NULL)"
+		])
+		self._mutex = self._database.mutex
+
+		self._metadata = {}
+		for (filename, data) in self._database.execute("SELECT filename, data FROM metadata"):
+			try:
+				self._metadata[filename] = json.loads(data)
+			except ValueError:
+				self._logger.warn("Ignoring unreadable metadata of %s" % filename)
+
+		self._database.importYaml(os.path.join(folder, "metadata.yaml"), self._importYaml, keepFile=True)
+
+	def _importYaml(self, metadata):
+		if not isinstance(metadata, dict):
+			return
+		for (filename, fileMetadata) in metadata.items():
+			if not filename in self._metadata:
+				self._write(filename, fileMetadata)
+
+	def _write(self, filename, metadata):
+		self._metadata[filename] = metadata
+		self._database.execute("INSERT OR REPLACE INTO metadata (filename, data) VALUES (?, ?)", (filename, json.dumps(metadata)))
+
+	def get(self, filename):
+		with self._mutex:
+			return self._metadata.get(filename, None)
+
+	def set(self, filename, metadata):
+		with self._mutex:
+			self._write(filename, metadata)
+
+	def remove(self, filename):
+		with self._mutex:
+			if filename in self._metadata:
+				del self._metadata[filename]
+				self._database.execute("DELETE FROM metadata WHERE filename = ?", (filename,))
+
+	def commit(self):
+		self._database.commit()
+
+	def close(self):
+		self._database.close()
+
+def _loadYamlMetadata(path):
+	if not os.path.isfile(path):
+		return {}
+	with open(path, "r") as f:
+		metadata = yaml.safe_load(f)
+	if not isinstance(metadata, dict):
+		return {}
+	return metadata
+
+class AnalysisCache(object):
+	"""
+	Results of the gcode analysis by the hash of the analysed file's contents (see getFileHash), persisted in a table
+	of its own in the SQLite database at the given path (see SqliteDatabase), so storing a result or marking one as
+	used only writes that result's row. Results of other versions of the analysis are ignored. Once there are more
+	than maxEntries results, the least recently used ones are dropped.
+
+	An existing analysisCache.yaml next to the database is imported on first start and renamed to
+	analysisCache.yaml.migrated afterwards.
+	"""
+
+	def __init__(self, path, maxEntries=1000):
+		self._logger = logging.getLogger(__name__)
+		self._maxEntries = maxEntries
+		self._database = SqliteDatabase(path, [
+			"CREATE TABLE IF NOT EXISTS analysisCache (hash TEXT PRIMARY KEY, version INTEGER NOT NULL, lastUsed REAL NOT NULL, result TEXT NOT NULL)",
+			"CREATE INDEX IF NOT EXISTS analysisCacheLastUsed ON analysisCache (lastUsed)"
+		])
+		self._mutex = self._database.mutex
+
+		self._database.importYaml(os.path.join(os.path.dirname(path), "analysisCache.yaml"), self._importYaml)
+
+	def _importYaml(self, entries):
+		if not isinstance(entries, dict):
+			return
+		for (fileHash, entry) in entries.items():
+			self._database.execute("INSERT OR IGNORE INTO analysisCache (hash, version, lastUsed, result) VALUES (?, ?, ?, ?)",
+				(fileHash, entry.get("version"), entry.get("lastUsed", 0), json.dumps(entry.get("result"))))
+		self._evict()
+
+	def get(self, fileHash):
+		with self._mutex:
+			if not self._database.isOpen():
+				return None
+			row = self._database.execute("SELECT result FROM analysisCache WHERE hash = ? AND version = ?", (fileHash, gcodeInterpreter.ANALYZER_VERSION)).fetchone()
+			if row is None:
+				return None
+			self._database.execute("UPDATE analysisCache SET lastUsed = ? WHERE hash = ?", (time.time(), fileHash))
+			self._database.commit()
+			return json.loads(row[0])
+
+	def set(self, fileHash, result):
+		with self._mutex:
+			if not self._database.isOpen():
+				return
+			self._database.execute("INSERT OR REPLACE INTO analysisCache (hash, version, lastUsed, result) VALUES (?, ?, ?, ?)",
+				(fileHash, gcodeInterpreter.ANALYZER_VERSION, time.time(), json.dumps(dict(result))))
+			self._evict()
+			self._database.commit()
+
+	def _evict(self):
+		if self._maxEntries is None:
+			return
+		self._database.execute("DELETE FROM analysisCache WHERE hash IN (SELECT hash FROM analysisCache ORDER BY lastUsed DESC LIMIT -1 OFFSET ?)", (self._maxEntries,))
+
+	def close(self):
+		self._database.close()
+
+def getFileHash(path):
+	"""
+	Returns the SHA1 hash of the contents of the file at the given path.
+	"""
+	fileHash = hashlib.sha1()
+	with open(path, "rb") as f:
+		while True:
+			chunk = f.read(1024 * 1024)
+			if not chunk:
+				break
+			fileHash.update(chunk)
+	return fileHash.hexdigest()
+
+def _getAnalysisResult(gcode):
+	return {
+		"totalMoveTimeMinute": gcode.totalMoveTimeMinute,
+		"extrusionAmount": gcode.extrusionAmount,
+		"extrusionVolume": gcode.extrusionVolume
+	}
+
+#~~ analysis worker processes
+
+_abortEvent = None
+
+def _initAnalysisProcess(abortEvent):
+	global _abortEvent
+	_abortEvent = abortEvent
+
+	# shutting down is up to the server
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _analyzeInProcess(path):
+	"""
+	Runs in the analysis worker processes, everything going in and out needs to be picklable.
+	"""
+	def onProgress(progress):
+		if _abortEvent is not None and _abortEvent.is_set():
+			raise gcodeInterpreter.AnalysisAborted()
+
+	try:
+		gcode = gcodeInterpreter.gcode()
+		gcode.progressCallback = onProgress
+		gcode.load(path)
+		return _getAnalysisResult(gcode)
+	except gcodeInterpreter.AnalysisAborted:
+		return {"aborted": True}
+	except Exception as e:
+		return {"error": str(e)}
@@ -8,14 +8,20 @@ import threading
 import copy
 import os
 
+from collections import deque
+
 #import logging, logging.config
 
 import octoprint.util.comm as comm
 import octoprint.util as util
+from octoprint.util.telemetry import TelemetryBuffer, TelemetryStore, RECORD_TEMPERATURE, RECORD_PROGRESS, RECORD_Z, RECORD_STATE
 
 from octoprint.settings import settings
 from octoprint.events import eventManager
 
+# version of the state push protocol, see StateMonitor
+STATE_PROTOCOL_VERSION = 1
+
 def getConnectionOptions():
 	"""
 	 Retrieves the available ports, baudrates, prefered port and baudrate for connecting to the printer.
@@ -30,7 +36,6 @@ def getConnectionOptions():
 
 class Printer():
 	def __init__(self, gcodeManager):
-		from collections import deque
 
 		self._gcodeManager = gcodeManager
 		self._gcodeManager.registerCallback(self)
@@ -40,14 +45,26 @@ class Printer():
 		self._bedTemp = None
 		self._targetTemp = None
 		self._targetBedTemp = None
-		self._temps = {
-			"actual": deque([], 300),
-			"target": deque([], 300),
-			"actualBed": deque([], 300),
-			"targetBed": deque([], 300)
-		}
+		# timestamps are in milliseconds, the interval is configured in seconds
+		self._temps = TelemetryBuffer(
+			["actual", "target", "actualBed", "targetBed"],
+			settings().getInt(["telemetry", "temperatureHistory", "samples"]),
+			settings().getFloat(["telemetry", "temperatureHistory", "interval"]),
+			timeScale=1000
+		)
 		self._tempBacklog = []
 
+		# telemetry of print runs persisted to disk
+		self._telemetryStore = None
+		self._lastProgressRecord = None
+		self._progressRecordInterval = settings().getFloat(["telemetry", "store", "progressInterval"])
+		if settings().getBoolean(["telemetry", "store", "enabled"]):
+			self._telemetryStore = TelemetryStore(
+				settings().getBaseFolder("telemetry"),
+				settings().getInt(["telemetry", "store", "maxRuns"]),
+				settings().getFloat(["telemetry", "store", "flushInterval"])
+			)
+
 		self._latestMessage = None
 		self._messages = deque([], 300)
 		self._messageBacklog = []
@@ -55,6 +72,8 @@ class Printer():
 		self._latestLog = None
 		self._log = deque([], 300)
 		self._logBacklog = []
+		# whether lines exchanged with the printer end up in the log, only needed while clients are watching it
+		self._serialLogging = False
 
 		self._state = None
 
@@ -80,11 +99,14 @@ class Printer():
 		self._lastProgressReport = None
 
 		self._stateMonitor = StateMonitor(
-			ratelimit=0.5,
+			ratelimit=settings().getFloat(["stateUpdates", "interval"]),
 			updateCallback=self._sendCurrentDataCallbacks,
 			addTemperatureCallback=self._sendAddTemperatureCallbacks,
 			addLogCallback=self._sendAddLogCallbacks,
-			addMessageCallback=self._sendAddMessageCallbacks
+			addMessageCallback=self._sendAddMessageCallbacks,
+			logInterval=settings().getFloat(["stateUpdates", "logInterval"]),
+			logBatchSize=settings().getInt(["stateUpdates", "logBatchSize"]),
+			maxLoad=settings().getFloat(["stateUpdates", "maxLoad"])
 		)
 		self._stateMonitor.reset(
 			state={"state": None, "stateString": self.getStateString(), "flags": self._getStateFlags()},
@@ -99,6 +121,13 @@ class Printer():
 		self._callbacks.append(callback)
 		self._sendInitialStateUpdate(callback)
 
+	def sendInitialStateUpdate(self, callback):
+		"""
+		Sends the current state and history to the given object, for clients that don't register themselves as
+		callbacks but get their updates from one that does.
+		"""
+		self._sendInitialStateUpdate(callback)
+
 	def unregisterCallback(self, callback):
 		if callback in self._callbacks:
 			self._callbacks.remove(callback)
@@ -118,9 +147,9 @@ class Printer():
 			try: callback.addMessage(data)
 			except: pass
 
-	def _sendCurrentDataCallbacks(self, data):
+	def _sendCurrentDataCallbacks(self, sequence, changes):
 		for callback in self._callbacks:
-			try: callback.sendCurrentData(copy.deepcopy(data))
+			try: callback.sendCurrentData(sequence, copy.deepcopy(changes))
 			except: pass
 
 	def _sendTriggerUpdateCallbacks(self, type):
@@ -150,7 +179,7 @@ class Printer():
 		"""
 		if self._comm is not None:
 			self._comm.close()
-		self._comm = comm.MachineCom(port, baudrate, callbackObject=self)
+		self._comm = comm.MachineCom(port, baudrate, callbackObject=self, serialLogging=self._serialLogging)
 
 	def disconnect(self):
 		"""
@@ -180,6 +209,17 @@ class Printer():
 
 		self._printAfterSelect = printAfterSelect
 		self._comm.selectFile(filename, sd)
+		if not sd and settings().getBoolean(["feature", "precompileJobs"]):
+			self._gcodeManager.scheduleCompilation(filename)
+		self._setProgressData(0, None, None, None)
+		self._setCurrentZ(None)
+
+	def selectGeneratedFile(self, name, lineFactory, commandCount, printAfterSelect=False):
+		if self._comm is None or (self._comm.isBusy() or self._comm.isStreaming()):
+			return
+
+		self._printAfterSelect = printAfterSelect
+		self._comm.selectGeneratedFile(name, lineFactory, commandCount)
 		self._setProgressData(0, None, None, None)
 		self._setCurrentZ(None)
 
@@ -261,6 +301,9 @@ class Printer():
 		self._printTime = printTime
 		self._printTimeLeft = printTimeLeft
 
+		if self._telemetryStore is not None:
+			self._recordProgressTelemetry(progress, filepos, printTime, printTimeLeft)
+
 		formattedPrintTime = None
 		if (self._printTime):
 			formattedPrintTime = util.getFormattedTimeDelta(datetime.timedelta(seconds=self._printTime))
@@ -275,13 +318,23 @@ class Printer():
 
 		self._stateMonitor.setProgress({"progress": self._progress, "filepos": formattedFilePos, "printTime": formattedPrintTime, "printTimeLeft": formattedPrintTimeLeft})
 
+	def _recordProgressTelemetry(self, progress, filepos, printTime, printTimeLeft):
+		# progress changes with every line sent, only record it once per percent or every progressInterval seconds
+		now = time.time()
+		percent = int(progress * 100) if progress is not None else None
+		if self._lastProgressRecord is not None:
+			(lastTime, lastPercent) = self._lastProgressRecord
+			if percent == lastPercent and now - lastTime < self._progressRecordInterval:
+				return
+		self._lastProgressRecord = (now, percent)
+		self._telemetryStore.record(RECORD_PROGRESS, (progress, filepos, printTime, printTimeLeft))
+
 	def _addTemperatureData(self, temp, bedTemp, targetTemp, bedTargetTemp):
 		currentTimeUtc = int(time.time() * 1000)
 
-		self._temps["actual"].append((currentTimeUtc, temp))
-		self._temps["target"].append((currentTimeUtc, targetTemp))
-		self._temps["actualBed"].append((currentTimeUtc, bedTemp))
-		self._temps["targetBed"].append((currentTimeUtc, bedTargetTemp))
+		self._temps.append(currentTimeUtc, (temp, targetTemp, bedTemp, bedTargetTemp))
+		if self._telemetryStore is not None:
+			self._telemetryStore.record(RECORD_TEMPERATURE, (temp, targetTemp, bedTemp, bedTargetTemp))
 
 		self._temp = temp
 		self._bedTemp = bedTemp
@@ -310,7 +363,7 @@ class Printer():
 
 			# Use a string for mtime because it could be float and the
 			# javascript needs to exact match
-			if not sd:
+			if not sd and os.path.isfile(filename):
 				fileMTime = str(os.stat(filename).st_mtime)
 
 			if filesize:
@@ -327,10 +380,11 @@ class Printer():
 
 	def _sendInitialStateUpdate(self, callback):
 		try:
-			data = self._stateMonitor.getCurrentData()
-			# convert the dict of deques to a dict of lists
-			temps = {k: list(v) for (k,v) in self._temps.iteritems()}
+			(sequence, data) = self._stateMonitor.getSnapshot()
+			temps = self._temps.toColumns()
 			data.update({
+				"protocol": STATE_PROTOCOL_VERSION,
+				"seq": sequence,
 				"temperatureHistory": temps,
 				"logHistory": list(self._log),
 				"messageHistory": list(self._messages)
@@ -388,8 +442,20 @@ class Printer():
 		elif self._comm is not None and state == self._comm.STATE_PRINTING:
 			self._gcodeManager.pauseAnalysis() # do not analyse gcode while printing
 
+		self._recordStateTelemetry(oldState, state)
 		self._setState(state)
 
+	def _recordStateTelemetry(self, oldState, state):
+		if self._telemetryStore is None or self._comm is None:
+			return
+
+		printingStates = (self._comm.STATE_PRINTING, self._comm.STATE_PAUSED)
+		if state in printingStates and not oldState in printingStates:
+			self._telemetryStore.startRun(self._selectedFile["filename"] if self._selectedFile is not None else None)
+		self._telemetryStore.record(RECORD_STATE, (state,))
+		if oldState in printingStates and not state in printingStates:
+			self._telemetryStore.endRun(state == self._comm.STATE_OPERATIONAL)
+
 	def mcMessage(self, message):
 		"""
 		 Callback method for the comm object, called upon message exchanges via serial.
@@ -414,6 +480,8 @@ class Printer():
 			# we have to react to all z-changes, even those that might "go backward" due to a slicer's retraction or
 			# anti-backlash-routines. Event subscribes should individually take care to filter out "wrong" z-changes
 			eventManager().fire("ZChange", newZ)
+			if self._telemetryStore is not None:
+				self._telemetryStore.record(RECORD_Z, (newZ,))
 
 		self._setCurrentZ(newZ)
 
@@ -498,6 +566,34 @@ class Printer():
 	def getCurrentData(self):
 		return self._stateMonitor.getCurrentData()
 
+	def getStateSnapshot(self):
+		"""
+		Returns the sequence number of the last state update pushed to the callbacks and the state as of that update,
+		for clients to resynchronize from.
+		"""
+		return self._stateMonitor.getSnapshot()
+
+	def getStateUpdateMetrics(self):
+		"""
+		Returns the push rate, queue depth and timing statistics of the state updates, see StateMonitor.getMetrics.
+		"""
+		return self._stateMonitor.getMetrics()
+
+	def setSerialLogging(self, enabled):
+		"""
+		Sets whether the lines sent to and received from the printer are added to the log. Other log messages, like
+		connection state changes, are always added.
+		"""
+		self._serialLogging = enabled
+		if self._comm is not None:
+			self._comm.setSerialLogging(enabled)
+
+	def getTelemetryStore(self):
+		"""
+		Returns the TelemetryStore persisting the telemetry of print runs or None if that's disabled.
+		"""
+		return self._telemetryStore
+
 	def getCurrentJob(self):
 		currentData = self._stateMonitor.getCurrentData()
 		return currentData["job"]
@@ -613,8 +709,30 @@ class SdFileStreamer(threading.Thread):
 			self._finishCallback(sdFilename)
 
 class StateMonitor(object):
-	def __init__(self, ratelimit, updateCallback, addTemperatureCallback, addLogCallback, addMessageCallback):
+	"""
+	Collects the printer state and pushes changes to it to the updateCallback.
+
+	How soon a change is pushed depends on its priority: state transitions (including errors) are pushed right away,
+	progress, z, job, temperature and message changes are coalesced into one push at most every interval seconds and
+	log lines are batched for logInterval seconds or until logBatchSize of them are waiting, whatever comes first. A
+	push always carries everything that changed up to then. If pushing gets expensive the coalescing interval is
+	stretched so that pushes take up at most maxLoad of the time.
+
+	Updates are numbered consecutively and only contain the parts of the state (state, job, currentZ, progress) that
+	changed since the previous update, with their complete new values. Clients start from a snapshot (see
+	getSnapshot) and apply the updates following its sequence number, a gap in the sequence means they missed one and
+	need a new snapshot.
+	"""
+
+	PRIORITY_IMMEDIATE = "immediate"
+	PRIORITY_COALESCED = "coalesced"
+	PRIORITY_BATCHED = "batched"
+
+	def __init__(self, ratelimit, updateCallback, addTemperatureCallback, addLogCallback, addMessageCallback, logInterval=2.0, logBatchSize=100, maxLoad=0.25):
 		self._ratelimit = ratelimit
+		self._logInterval = logInterval
+		self._logBatchSize = logBatchSize
+		self._maxLoad = maxLoad
 		self._updateCallback = updateCallback
 		self._addTemperatureCallback = addTemperatureCallback
 		self._addLogCallback = addLogCallback
@@ -627,7 +745,22 @@ class StateMonitor(object):
 		self._currentZ = None
 		self._progress = None
 
-		self._changeEvent = threading.Event()
+		# changes waiting for the next push per priority and the time that push is due
+		self._changeCondition = threading.Condition()
+		self._pendingChanges = dict((priority, 0) for priority in (self.PRIORITY_IMMEDIATE, self.PRIORITY_COALESCED, self.PRIORITY_BATCHED))
+		self._pushDue = None
+
+		self._sequence = 0
+		self._lastData = None
+		self._sequenceMutex = threading.Lock()
+
+		# metrics
+		self._pushTimes = deque([], 100)
+		self._pushCount = 0
+		self._changeCount = 0
+		self._averagePushDuration = 0.0
+		self._maxPushDuration = 0.0
+		self._maxQueued = 0
 
 		self._lastUpdate = time.time()
 		self._worker = threading.Thread(target=self._work)
@@ -642,46 +775,123 @@ class StateMonitor(object):
 
 	def addTemperature(self, temperature):
 		self._addTemperatureCallback(temperature)
-		self._changeEvent.set()
+		self._markChanged(self.PRIORITY_COALESCED)
 
 	def addLog(self, log):
 		self._addLogCallback(log)
-		self._changeEvent.set()
+		self._markChanged(self.PRIORITY_BATCHED)
 
 	def addMessage(self, message):
 		self._addMessageCallback(message)
-		self._changeEvent.set()
+		self._markChanged(self.PRIORITY_COALESCED)
 
 	def setCurrentZ(self, currentZ):
 		self._currentZ = currentZ
-		self._changeEvent.set()
+		self._markChanged(self.PRIORITY_COALESCED)
 
 	def setState(self, state):
+		changed = state != self._state
 		self._state = state
-		self._changeEvent.set()
+		self._markChanged(self.PRIORITY_IMMEDIATE if changed else self.PRIORITY_COALESCED)
 
 	def setJobData(self, jobData):
 		self._jobData = jobData
-		self._changeEvent.set()
+		self._markChanged(self.PRIORITY_COALESCED)
 
 	def setProgress(self, progress):
 		self._progress = progress
-		self._changeEvent.set()
+		self._markChanged(self.PRIORITY_COALESCED)
+
+	def getMetrics(self):
+		"""
+		Returns statistics about the pushes so far: their count and current rate per second, their average and maximum
+		duration, the changes merged into them, the changes currently waiting per priority and the current coalescing
+		interval.
+		"""
+		with self._changeCondition:
+			queued = dict(self._pendingChanges)
+			pushTimes = list(self._pushTimes)
+			pushRate = 0.0
+			if len(pushTimes) > 1:
+				pushRate = (len(pushTimes) - 1) / max(time.time() - pushTimes[0], 0.001)
+			return {
+				"pushes": self._pushCount,
+				"pushRate": pushRate,
+				"changes": self._changeCount,
+				"averagePushTime": self._averagePushDuration,
+				"maxPushTime": self._maxPushDuration,
+				"queued": queued,
+				"maxQueued": self._maxQueued,
+				"interval": self._getInterval()
+			}
+
+	def _getInterval(self):
+		return max(self._ratelimit, self._averagePushDuration / self._maxLoad)
+
+	def _markChanged(self, priority):
+		with self._changeCondition:
+			self._pendingChanges[priority] += 1
+			self._changeCount += 1
+			self._maxQueued = max(self._maxQueued, sum(self._pendingChanges.values()))
+
+			if priority == self.PRIORITY_IMMEDIATE:
+				due = time.time()
+			elif priority == self.PRIORITY_COALESCED or self._pendingChanges[priority] >= self._logBatchSize:
+				due = self._lastUpdate + self._getInterval()
+			else:
+				due = self._lastUpdate + max(self._logInterval, self._getInterval())
+
+			if self._pushDue is None or due < self._pushDue:
+				self._pushDue = due
+				self._changeCondition.notify()
 
 	def _work(self):
 		while True:
-			self._changeEvent.wait()
+			with self._changeCondition:
+				# wait until a push is due, an urgent change may bring it forward meanwhile
+				while self._pushDue is None or self._pushDue > time.time():
+					if self._pushDue is None:
+						self._changeCondition.wait()
+					else:
+						self._changeCondition.wait(self._pushDue - time.time())
 
-			now = time.time()
-			delta = now - self._lastUpdate
-			additionalWaitTime = self._ratelimit - delta
-			if additionalWaitTime > 0:
-				time.sleep(additionalWaitTime)
+				# reset first, so changes made while pushing are pushed with the next update
+				self._pushDue = None
+				for priority in self._pendingChanges.keys():
+					self._pendingChanges[priority] = 0
 
-			data = self.getCurrentData()
-			self._updateCallback(data)
+			start = time.time()
+			(sequence, changes) = self._getChanges()
+			self._updateCallback(sequence, changes)
 			self._lastUpdate = time.time()
-			self._changeEvent.clear()
+
+			with self._changeCondition:
+				duration = self._lastUpdate - start
+				self._pushTimes.append(self._lastUpdate)
+				self._pushCount += 1
+				self._averagePushDuration = 0.9 * self._averagePushDuration + 0.1 * duration
+				self._maxPushDuration = max(self._maxPushDuration, duration)
+
+	def _getChanges(self):
+		with self._sequenceMutex:
+			data = self.getCurrentData()
+			if self._lastData is None:
+				changes = data
+			else:
+				changes = dict((key, value) for (key, value) in data.iteritems() if self._lastData.get(key) != value)
+			self._lastData = copy.deepcopy(data)
+			self._sequence += 1
+			return (self._sequence, copy.deepcopy(changes))
+
+	def getSnapshot(self):
+		"""
+		Returns the sequence number of the last update and the state as of that update, so that applying the updates
+		following it brings clients up to date.
+		"""
+		with self._sequenceMutex:
+			if self._lastData is None:
+				return (self._sequence, self.getCurrentData())
+			return (self._sequence, copy.deepcopy(self._lastData))
 
 	def getCurrentData(self):
 		return {
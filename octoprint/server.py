@@ -3,21 +3,45 @@ __author__ = "Gina Häußge <osd@foosel.net>"
 __license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
 
 from werkzeug.utils import secure_filename
+from werkzeug.datastructures import FileStorage, ImmutableMultiDict
 import tornadio2
-from flask import Flask, request, render_template, jsonify, send_from_directory, url_for, current_app, session, abort, make_response
+import tornadio2.proto as proto
+import tornado.web
+import tornado.wsgi
+import tornado.ioloop
+import tornado.escape
+import tornado.httputil
+import tornado.httpserver
+import tornado.iostream
+from flask import Flask, Request, request, render_template, jsonify, send_from_directory, url_for, current_app, session, abort, make_response
 from flask.ext.login import LoginManager, login_user, logout_user, login_required, current_user
 from flask.ext.principal import Principal, Permission, RoleNeed, Identity, identity_changed, AnonymousIdentity, identity_loaded, UserNeed
 
 import os
+import re
+import socket
+import httplib
+import urllib
+import cStringIO
+import sre_constants
+import time
+import Queue
+import itertools
 import threading
 import logging, logging.config
 import subprocess
+import mimetypes
+import datetime
+
+from collections import deque
 
 from octoprint.printer import Printer, getConnectionOptions
 from octoprint.settings import settings, valid_boolean_trues
 import octoprint.timelapse
 import octoprint.gcodefiles as gcodefiles
 import octoprint.util as util
+import octoprint.util.sprayPath as sprayPath
+import octoprint.util.multipart as multipart
 import octoprint.users as users
 
 import octoprint.events as events
@@ -26,15 +50,33 @@ SUCCESS = {}
 BASEURL = "/ajax/"
 APIBASEURL = "/api/"
 
+class OctoPrintRequest(Request):
+	def _load_form_data(self):
+		Request._load_form_data(self)
+
+		# files already received while the request arrived, see UploadHTTPConnection
+		uploads = self.environ.get("octoprint.uploads", None)
+		if uploads:
+			files = []
+			for (name, filename, contentType, stream) in uploads:
+				if stream is None:
+					stream = cStringIO.StringIO()
+				files.append((name, FileStorage(stream, filename, name, contentType)))
+			self.__dict__["files"] = ImmutableMultiDict(files)
+
 app = Flask("octoprint")
+app.request_class = OctoPrintRequest
 # Only instantiated by the Server().run() method
 # In order that threads don't start too early when running as a Daemon
 printer = None
 timelapse = None
 
 gcodeManager = None
+sprayMethodCache = None
 userManager = None
 eventManager = None
+stateBroadcaster = None
+wsgiContainer = None
 
 principals = Principal(app)
 admin_permission = Permission(RoleNeed("admin"))
@@ -42,156 +84,423 @@ user_permission = Permission(RoleNeed("user"))
 
 spray_status = False
 
-# position constants
-sp_home_x = 0.0
-sp_home_y = 0.0
-sp_home_z = 0.0
-sp_offset = 0.0
-sp_x1 = -60.0
-sp_x2 = 60.0
-sp_y1 = -80.0
-sp_y2 = 80.0
-sp_top = 104.0
-sp_wash_x = 0.0
-sp_wash_y = -110.0
-sp_wash_z = -50.0
-# wash position top, use to approach
-sp_wash_u = -35.0
-sp_magnet = 16.5
+# requests are handled by several worker threads, starting and stopping a spray job (checking the printer's state,
+# selecting the method and updating spray_status) must not interleave
+sprayMutex = threading.Lock()
+
+@app.teardown_request
+def closeUploadStreams(exception):
+	# uploads that weren't added to the upload folder would leave their temporary files behind otherwise
+	if "files" in request.__dict__:
+		for file in request.files.values():
+			if isinstance(file.stream, gcodefiles.UploadStream):
+				file.stream.close()
 
-# commands
-sc_valve_wash = "G1 V2 F200\nG4 S1\n"
-sc_valve_spray = "G1 V1 F200\nG4 S1\n"
-sc_valve_waste = "G1 V0 F200\nG4 S1\n"
-#go to valve position % nr
-sc_valve_pos = "G1 V{} F200\nG4 S1\n"
-sc_air_on = "M106\n"
-sc_air_off = "M106 S0\n"
-sc_init = "G28XYZ\nG28P\nG90\n"
-sc_motor_off = "M18\n"
+#~~ Printer state
+
+class LogSubscription(object):
+	"""
+	A client's subscription to the printer log: lines matching one of the filters (regular expressions) are left out
+	and of the remaining ones only every sample-th line of the log is sent.
+
+	The filters come from the clients and are run against every log line on the server, so only a few short
+	patterns without backreferences and without repetitions of repetitions or alternatives (like "(a+)+" or
+	"(a|aa)*", which can take exponential time to fail) are accepted. Anything else raises a ValueError.
+	"""
+
+	MAX_FILTERS = 10
+	MAX_FILTER_LENGTH = 100
+
+	def __init__(self, filters=None, sample=1):
+		if filters is None:
+			filters = []
+		if len(filters) > self.MAX_FILTERS:
+			raise ValueError("At most %d filters are allowed" % self.MAX_FILTERS)
+		self._filters = [_compileLogFilter(pattern, self.MAX_FILTER_LENGTH) for pattern in filters]
+		self._sample = max(1, int(sample))
+
+		# subscriptions with the same key get the same lines
+		self.key = (tuple(filters), self._sample)
+
+	def apply(self, lines):
+		"""
+		Returns the given lines, (number, line) tuples, that pass the filters and the sampling.
+		"""
+		return [line for (number, line) in lines if number % self._sample == 0 and not any(pattern.search(line) for pattern in self._filters)]
+
+def _compileLogFilter(pattern, maxLength):
+	if not isinstance(pattern, basestring):
+		raise ValueError("Filter %r is not a string" % pattern)
+	if len(pattern) > maxLength:
+		raise ValueError("Filter %r is longer than %d characters" % (pattern, maxLength))
+	try:
+		for (op, av, repeated) in util.getRegexNodes(pattern):
+			_checkLogFilterNode(op, repeated)
+		return re.compile(pattern)
+	except sre_constants.error, e:
+		raise ValueError("Filter %r is no valid regular expression: %s" % (pattern, str(e)))
+
+def _checkLogFilterNode(op, repeated):
+	if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+		raise ValueError("Backreferences are not allowed in filters")
+	if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and repeated:
+		raise ValueError("Nested repetitions are not allowed in filters")
+	if op == sre_constants.BRANCH and repeated:
+		raise ValueError("Repeated alternatives are not allowed in filters")
+
+class StateBroadcaster(object):
+	"""
+	The one callback of the printer and the gcode manager for all PrinterStateConnections. Every update is encoded
+	into a socket.io message once and that message is handed to all connections, instead of every connection
+	encoding the same data again.
+
+	The printer log is only sent to connections subscribed to it (see subscribeLog), and the printer only logs the
+	lines exchanged with the printer while there are any.
+
+	State updates are skipped for connections that haven't managed to send out the previous messages yet. Once they
+	have caught up they get a snapshot of the current state instead of all the updates they missed, so slow clients
+	get fewer but current updates instead of an ever growing queue. The temperatures, log lines and messages of the
+	skipped updates are kept per connection in bounded queues and sent along with the snapshot.
+
+	Temperatures, log lines and messages are collected in bounded queues between two updates, which the threads
+	reporting them append to without taking a lock. If an update is late the oldest entries are dropped and counted.
+	"""
+
+	# maximum number of temperatures, log lines and messages each kept between two updates
+	MAX_BACKLOG = 1000
+
+	# number of log lines kept for clients subscribing to the log
+	LOG_HISTORY = 300
+
+	def __init__(self, printer, gcodeManager, eventManager):
+		self._logger = logging.getLogger(__name__)
 
-# go to wash position
-sc_go_to_wash = ";go to wash\nG1 Z{} F200\nG1 X{} Y{} Z{} F200\nG1 Z{}\n".format (sp_wash_u, sp_wash_x, sp_wash_y, sp_wash_u, sp_wash_z)
+		self._printer = printer
 
-# aspirate % position
-sc_aspirate = "G1 P{} F200\n"
+		self._connections = []
+		self._connectionsMutex = threading.Lock()
+		self._logSubscriptions = {}
+
+		self._temperatureBacklog = deque([], self.MAX_BACKLOG)
+		self._logBacklog = deque([], self.MAX_BACKLOG)
+		self._logLineNumbers = itertools.count()
+		self._logHistory = deque([], self.LOG_HISTORY)
+		self._messageBacklog = deque([], self.MAX_BACKLOG)
+		self._droppedBacklog = {"temperatures": 0, "logs": 0, "messages": 0}
+		self._droppedBacklogMutex = threading.Lock()
+
+		printer.registerCallback(self)
+		gcodeManager.registerCallback(self)
+		eventManager.subscribe("MovieDone", self._onMovieDone)
+
+	def addConnection(self, connection):
+		with self._connectionsMutex:
+			self._connections.append(connection)
+		self._printer.sendInitialStateUpdate(connection)
+
+	def removeConnection(self, connection):
+		with self._connectionsMutex:
+			if connection in self._connections:
+				self._connections.remove(connection)
+		self.unsubscribeLog(connection)
+
+	def subscribeLog(self, connection, filters=None, sample=1):
+		"""
+		Subscribes the connection to the printer log, replacing any previous subscription of it. Raises a ValueError if
+		the filters are not accepted (see LogSubscription). Returns the LogSubscription.
+		"""
+		try:
+			subscription = LogSubscription(filters, sample)
+		except (ValueError, TypeError), e:
+			raise ValueError("Invalid log subscription: %s" % str(e))
+
+		with self._connectionsMutex:
+			self._logSubscriptions[connection] = subscription
+		self._printer.setSerialLogging(True)
+		return subscription
+
+	def unsubscribeLog(self, connection):
+		with self._connectionsMutex:
+			if not connection in self._logSubscriptions:
+				return
+			del self._logSubscriptions[connection]
+			subscribed = len(self._logSubscriptions) > 0
+		if not subscribed:
+			self._printer.setSerialLogging(False)
+
+	#~~ callbacks of printer and gcode manager
 
-# set syringe to absolute mode
-sc_syringe_absolute= "M82\n"
+	def sendHistoryData(self, data):
+		# connections get their history when they are added
+		pass
 
-# set syringe to realtive mode
-sc_syringe_relative = "M83\n"
+	def getMetrics(self):
+		"""
+		Returns the number of entries dropped from the backlogs so far and the outgoing queue statistics of all
+		connections, see PrinterStateConnection.getMetrics.
+		"""
+		return {
+			"droppedBacklog": dict(self._droppedBacklog),
+			"connections": [connection.getMetrics() for connection in self._getConnections()]
+		}
 
-# empty syringe
-sc_empty = "G1 P0 F200\n"
+	def sendCurrentData(self, sequence, changes):
+		temperatures = _drain(self._temperatureBacklog)
+		logs = _drain(self._logBacklog)
+		messages = _drain(self._messageBacklog)
 
-# wait % seconds
-sc_wait = "G4 S{}\n"
+		# only the changed parts of the state are sent, the backlogs only if there's something in them
+		data = {
+			"seq": sequence,
+			"changes": changes
+		}
+		if len(temperatures) > 0:
+			data["temperatures"] = temperatures
+		if len(messages) > 0:
+			data["messages"] = messages
+
+		# the log goes to subscribed connections only, with their filters applied once per distinct subscription
+		logData = {}
+		with self._connectionsMutex:
+			logSubscriptions = dict(self._logSubscriptions)
+
+		def getLogs(subscription):
+			if subscription is None or len(logs) == 0:
+				return []
+			if not subscription.key in logData:
+				logData[subscription.key] = subscription.apply(logs)
+			return logData[subscription.key]
+
+		encoded = {}
+		snapshot = None
+		for connection in self._getConnections():
+			subscription = logSubscriptions.get(connection)
+			if connection.isBacklogged():
+				connection.snapshotPending = True
+				connection.addMissed(temperatures, getLogs(subscription), messages)
+				continue
+
+			endpoint = connection.endpoint
+			if connection.snapshotPending:
+				if snapshot is None:
+					(snapshotSequence, snapshot) = self._printer.getStateSnapshot()
+					snapshot["seq"] = snapshotSequence
+				# this update's backlogs are part of what the connection missed
+				connection.addMissed(temperatures, getLogs(subscription), messages)
+				connectionSnapshot = dict(snapshot)
+				connectionSnapshot.update(connection.drainMissed())
+				connection.sendEncoded(proto.event(endpoint, "snapshot", None, connectionSnapshot))
+				connection.snapshotPending = False
+			else:
+				key = (endpoint, subscription.key if subscription is not None and len(logs) > 0 else None)
+				if not key in encoded:
+					connectionData = data
+					connectionLogs = getLogs(subscription)
+					if len(connectionLogs) > 0:
+						connectionData = dict(data)
+						connectionData["logs"] = connectionLogs
+					encoded[key] = proto.event(endpoint, "delta", None, connectionData)
+				connection.sendEncoded(encoded[key])
 
-# set speed % speed
-sc_speed = "G1 F{}\n"
+	def sendUpdateTrigger(self, type):
+		self._broadcast("updateTrigger", type)
 
-# go to syringe position % position
-sc_syringe_position = "G1 P{}\n"
+	def sendFeedbackCommandOutput(self, name, output):
+		self._broadcast("feedbackCommandOutput", {"name": name, "output": output})
 
-# move fast % x, y position
-sc_move_fast = "G1 X{} Y{} F200\n"
+	def getLogHistory(self):
+		"""
+		Returns the last log lines as (number, line) tuples, numbered like the ones sent to the subscriptions.
+		"""
+		return list(self._logHistory)
 
-# move fast % z position
-sc_move_fast_z = "G1 Z{} F200\n"
+	def addLog(self, data):
+		line = (next(self._logLineNumbers), data)
+		self._logHistory.append(line)
+		if len(self._logSubscriptions) == 0:
+			return
+		self._addToBacklog(self._logBacklog, "logs", line)
 
-# spray fast % x, y, p, f
-sc_spray = "G1 X{} Y{} P{} F{}\n"
+	def addMessage(self, data):
+		self._addToBacklog(self._messageBacklog, "messages", data)
 
-sc_go_home = "G1 X0 Y0 Z-35 F200\nG1 Z0 F200\n"
+	def addTemperature(self, data):
+		self._addToBacklog(self._temperatureBacklog, "temperatures", data)
 
+	def _addToBacklog(self, backlog, name, data):
+		if len(backlog) == backlog.maxlen:
+			# only overflows take a lock
+			with self._droppedBacklogMutex:
+				self._droppedBacklog[name] += 1
+		backlog.append(data)
 
+	def _onMovieDone(self, event, payload):
+		self.sendUpdateTrigger("timelapseFiles")
 
-#~~ Printer state
+	def _broadcast(self, name, data):
+		encoded = {}
+		for connection in self._getConnections():
+			endpoint = connection.endpoint
+			if not endpoint in encoded:
+				encoded[endpoint] = proto.event(endpoint, name, None, data)
+			connection.sendEncoded(encoded[endpoint])
+
+	def _getConnections(self):
+		with self._connectionsMutex:
+			return list(self._connections)
+
+def _drain(queue):
+	"""
+	Removes the entries currently in the given deque and returns them as a list. Safe against other threads appending
+	at the same time, their entries are either part of the result or stay in the queue.
+	"""
+	result = []
+	for i in range(len(queue)):
+		try:
+			result.append(queue.popleft())
+		except IndexError:
+			break
+	return result
 
 class PrinterStateConnection(tornadio2.SocketConnection):
-	def __init__(self, printer, gcodeManager, userManager, eventManager, session, endpoint=None):
+	"""
+	Messages handed to a connection by the StateBroadcaster go through a bounded outgoing queue, which is emptied into
+	the socket.io session on the IOLoop. If it is full the oldest message is dropped and counted, a client missing a
+	state update that way asks for a new snapshot.
+	"""
+
+	# number of messages waiting for a polling client to fetch them after which it counts as backlogged
+	MAX_QUEUED_MESSAGES = 10
+
+	# maximum number of messages waiting to be handed to the session
+	MAX_OUTGOING_MESSAGES = 100
+
+	# maximum number of temperatures, log lines and messages each kept for the snapshot while backlogged
+	MAX_MISSED = 1000
+
+	def __init__(self, printer, userManager, eventManager, broadcaster, session, endpoint=None):
 		tornadio2.SocketConnection.__init__(self, session, endpoint)
 
 		self._logger = logging.getLogger(__name__)
 
-		self._temperatureBacklog = []
-		self._temperatureBacklogMutex = threading.Lock()
-		self._logBacklog = []
-		self._logBacklogMutex = threading.Lock()
-		self._messageBacklog = []
-		self._messageBacklogMutex = threading.Lock()
-
 		self._printer = printer
-		self._gcodeManager = gcodeManager
 		self._userManager = userManager
 		self._eventManager = eventManager
+		self._broadcaster = broadcaster
+
+		self._ioloop = tornado.ioloop.IOLoop.instance()
+		self._outgoing = deque([], self.MAX_OUTGOING_MESSAGES)
+		self._flushScheduled = False
+		self._sentMessages = 0
+		self._droppedMessages = 0
+		self._droppedMessagesMutex = threading.Lock()
+		self._missed = {
+			"temperatures": deque([], self.MAX_MISSED),
+			"logs": deque([], self.MAX_MISSED),
+			"messages": deque([], self.MAX_MISSED)
+		}
+
+		self.snapshotPending = False
 
 	def on_open(self, info):
 		self._logger.info("New connection from client")
-		# Use of global here is smelly
-		self._printer.registerCallback(self)
-		self._gcodeManager.registerCallback(self)
-
+		self._broadcaster.addConnection(self)
 		self._eventManager.fire("ClientOpened")
-		self._eventManager.subscribe("MovieDone", self._onMovieDone)
 
 	def on_close(self):
 		self._logger.info("Closed client connection")
-		# Use of global here is smelly
-		self._printer.unregisterCallback(self)
-		self._gcodeManager.unregisterCallback(self)
-
+		self._broadcaster.removeConnection(self)
 		self._eventManager.fire("ClientClosed")
-		self._eventManager.unsubscribe("MovieDone", self._onMovieDone)
 
 	def on_message(self, message):
 		pass
 
-	def sendCurrentData(self, data):
-		# add current temperature, log and message backlogs to sent data
-		with self._temperatureBacklogMutex:
-			temperatures = self._temperatureBacklog
-			self._temperatureBacklog = []
+	@tornadio2.event
+	def resync(self):
+		# the client missed an update, send it the current state to start over from
+		(sequence, data) = self._printer.getStateSnapshot()
+		data["seq"] = sequence
+		self.emit("snapshot", data)
 
-		with self._logBacklogMutex:
-			logs = self._logBacklog
-			self._logBacklog = []
+	@tornadio2.event
+	def subscribeLog(self, filters=None, sample=1):
+		try:
+			subscription = self._broadcaster.subscribeLog(self, filters, sample)
+		except ValueError, e:
+			self._logger.warn(str(e))
+			return
 
-		with self._messageBacklogMutex:
-			messages = self._messageBacklog
-			self._messageBacklog = []
+		# start the client off with what's already in the log
+		self.emit("logHistory", subscription.apply(self._broadcaster.getLogHistory()))
 
-		data.update({
-			"temperatures": temperatures,
-			"logs": logs,
-			"messages": messages
-		})
-		self.emit("current", data)
+	@tornadio2.event
+	def unsubscribeLog(self):
+		self._broadcaster.unsubscribeLog(self)
 
 	def sendHistoryData(self, data):
 		self.emit("history", data)
 
-	def sendUpdateTrigger(self, type):
-		self.emit("updateTrigger", type)
-
-	def sendFeedbackCommandOutput(self, name, output):
-		self.emit("feedbackCommandOutput", {"name": name, "output": output})
-
-	def addLog(self, data):
-		with self._logBacklogMutex:
-			self._logBacklog.append(data)
-
-	def addMessage(self, data):
-		with self._messageBacklogMutex:
-			self._messageBacklog.append(data)
-
-	def addTemperature(self, data):
-		with self._temperatureBacklogMutex:
-			self._temperatureBacklog.append(data)
+	def sendEncoded(self, message):
+		"""
+		Queues a message already encoded by the StateBroadcaster for sending, may be called from any thread.
+		"""
+		if self.is_closed:
+			return
+
+		if len(self._outgoing) == self._outgoing.maxlen:
+			# only overflows take a lock
+			with self._droppedMessagesMutex:
+				self._droppedMessages += 1
+		self._outgoing.append(message)
+		if not self._flushScheduled:
+			self._flushScheduled = True
+			self._ioloop.add_callback(self._flushOutgoing)
+
+	def _flushOutgoing(self):
+		# reset first, so messages queued meanwhile schedule another flush
+		self._flushScheduled = False
+		for message in _drain(self._outgoing):
+			if self.is_closed:
+				return
+			self.session.send_message(message)
+			self._sentMessages += 1
+
+	def addMissed(self, temperatures, logs, messages):
+		"""
+		Keeps the temperatures, log lines and messages of a state update skipped for this connection until its
+		snapshot is sent, only the newest MAX_MISSED of each.
+		"""
+		self._missed["temperatures"].extend(temperatures)
+		self._missed["logs"].extend(logs)
+		self._missed["messages"].extend(messages)
+
+	def drainMissed(self):
+		"""
+		Returns the non-empty lists of temperatures, log lines and messages kept by addMissed and clears them.
+		"""
+		result = {}
+		for (name, queue) in self._missed.items():
+			entries = _drain(queue)
+			if len(entries) > 0:
+				result[name] = entries
+		return result
+
+	def getMetrics(self):
+		return {
+			"queued": len(self._outgoing),
+			"sent": self._sentMessages,
+			"dropped": self._droppedMessages
+		}
 
-	def _onMovieDone(self, event, payload):
-		self.sendUpdateTrigger("timelapseFiles")
+	def isBacklogged(self):
+		"""
+		Whether the messages sent so far haven't left yet, either because they are still waiting in the outgoing
+		queue, because a polling client hasn't fetched them or because they are still in the websocket's write buffer.
+		"""
+		if len(self._outgoing) > self.MAX_QUEUED_MESSAGES or len(self.session.send_queue) > self.MAX_QUEUED_MESSAGES:
+			return True
+		stream = getattr(self.session.handler, "stream", None)
+		return stream is not None and stream.writing()
 
 # Did attempt to make webserver an encapsulated class but ended up with __call__ failures
 
@@ -278,7 +587,7 @@ def printerClean():
 	printer.command("; cleaning")
 	printer.command("G28 V")
 	printer.command("G28 XYZP")
-	filename = "/home/pi/OctoPrint/octoprint/methods/clean.gcode"
+	filename = _getMethodPath("clean.gcode")
 	#printer.command(";" + filename)
 	printer.selectFile(filename, False, True)
 	
@@ -289,7 +598,7 @@ def printerClean():
 @login_required
 def printerPurge():
 
-	filename = "/home/pi/OctoPrint/octoprint/methods/purge.gcode"
+	filename = _getMethodPath("purge.gcode")
 	#printer.command(";" + filename)
 	printer.selectFile(filename, False, True)
 
@@ -299,7 +608,7 @@ def printerPurge():
 @login_required
 def printerPrime():
 
-	filename = "/home/pi/OctoPrint/octoprint/methods/prime.gcode"
+	filename = _getMethodPath("prime.gcode")
 	#printer.command(";" + filename)
 	printer.selectFile(filename, False, True)
 
@@ -310,10 +619,6 @@ def printerPrime():
 @app.route(BASEURL + "control/spray", methods=["POST"])
 @login_required
 def printerSpray():
-	if not printer.isOperational() or printer.isPrinting():
-		# do not jog when a print job is running or we don't have a connection
-		return jsonify(SUCCESS)
-
 	if "distance" in request.values.keys():
 		spray_distance = float(request.values["distance"])
 		# printer.command(";Distance " + spray_distance)
@@ -342,137 +647,52 @@ def printerSpray():
 		spray_solution = request.values["solution"]
 		# printer.command(";Solution: " + spray_solution)
 		
-	#filename = gcodeManager.getAbsolutePath("immediate.gcode", mustExist=False)
-	filename = "/home/pi/OctoPrint/octoprint/methods/spray.gcode"
-	printer.command(";" + filename)
-	
-	file = open(filename, "w")
-	file.write( ";Spray file generated on the fly\n")
-
-	###################section start###################
-
-	#coating starts
-	file.write(";start coating\n")
-	file.write(sc_init)
-
-	#syringe parameter in ul/mm
-	spray_syringe_volume_per_travel = 16.7
-	
-	#flow contains ul/cm^2
-	#densitity in ul/mm
-	spray_density = float(spray_flow)/100 * spray_distance
-
-	spray_lines = int((sp_y2 - sp_y1)/spray_distance)
-	spray_travel_distance =  spray_lines * (sp_x2 - sp_x1) + (sp_y2 - sp_y1)
-	spray_time = spray_travel_distance / spray_speed
-
-	spray_syringe_volume = spray_travel_distance * spray_density
-	spray_syringe_travel = spray_syringe_volume / spray_syringe_volume_per_travel
-
-	spray_syringe_x = (sp_x2 - sp_x1) * spray_density / spray_syringe_volume_per_travel * -1
-	spray_syringe_y = spray_distance * spray_density / spray_syringe_volume_per_travel * -1
-	
-	# this is an intrinsic factor, test
-	spray_feed = spray_speed * 1.0
-	
-	#prime system
-	file.write(sc_go_to_wash)
-	#file.write(sc_valve_pos.format(spray_solution))
-	
-	for i in range(0, 5):
-		file.write("G1 V{}.5 F200\n".format(spray_solution))
-		file.write("G4 S1\n")
-		file.write("G1 P4.2 F200\n")
-		file.write("G4 S1\n")
-		file.write("G1 V{} F200\n".format(spray_solution))
-		file.write("G4 S1\n")
-		file.write("G1 V0 F200\n")
-		file.write("G4 S1\n")
-		file.write("G1 P0 F100\n")
-		file.write("G4 S1\n")
-		
-	file.write(sc_air_on)
-	# prime spray with spray solution
-	file.write(sc_valve_pos.format(spray_solution))
-	file.write(sc_aspirate.format(2))
-	file.write(sc_valve_spray + sc_speed.format(0.1) + sc_syringe_position.format(0))
-
-	#start loop
-	for n in range(spray_cycles):
-		#aspirate syringe
-		file.write(sc_air_on)
-		file.write(sc_syringe_absolute)
-		file.write(sc_valve_pos.format(spray_solution))
-		file.write(sc_aspirate.format(spray_syringe_travel + 2))
-		file.write(sc_valve_spray)		
-		file.write(sc_speed.format(0.1) + sc_syringe_position.format(spray_syringe_travel))
-		file.write(sc_move_fast_z.format(sp_wash_u))
-
-		#move to start
-		y_offset = spray_distance / spray_lines * n + sp_y1
-		file.write(sc_move_fast.format(sp_x1, y_offset))
-		file.write(sc_move_fast_z.format((spray_hight - sp_top)))
-		file.write(sc_syringe_relative)
-		#spray cycle
-		for y in range(spray_lines):
-			if y % 2 == 0:
-				#even
-				file.write(sc_spray.format(sp_x2, y_offset, spray_syringe_y, spray_feed))
-				file.write(sc_spray.format(sp_x1, y_offset, spray_syringe_x, spray_feed))
-			elif y == 0:
-				#first line
-				file.write(sc_spray.format(sp_x2, y_offset, spray_syringe_x, spray_feed))
-			else:
-			   #odd line
-				file.write(sc_spray.format(sp_x1, y_offset, spray_syringe_y, spray_feed))
-				file.write(sc_spray.format(sp_x2, y_offset, spray_syringe_x, spray_feed))
-
-			y_offset += spray_distance
-
-		#move to wash
-		file.write("G1 Y{} Z{} F200\n".format(sp_y1, sp_wash_u))
-		file.write(sc_go_to_wash)
-
-		#empty syringe
-		file.write(sc_syringe_absolute)
-		file.write(sc_valve_waste + sc_empty)
-		#back to start
-
-		#clean syringe
-
-		if n != int(spray_cycles):
-			file.write(sc_air_off)
-			file.write(sc_wait.format(spray_delay))
-
-	# now do the wash
-	with open("/home/pi/OctoPrint/octoprint/methods/clean.gcode",'rb') as sf_clean:
-		file.write(sf_clean.read())
+	with open(_getMethodPath("clean.gcode"),'rb') as sf_clean:
+		cleanTemplate = sf_clean.read()
 
-	#file.write(sc_go_home)
-	#file.write(sc_motor_off)
-
-	###################section stop###################
-	file.close()
 	global spray_status
-	spray_status = True
-	printer.selectFile(filename, False, True)
+	with sprayMutex:
+		if not printer.isOperational() or printer.isPrinting():
+			# do not jog when a print job is running or we don't have a connection
+			return jsonify(SUCCESS)
+
+		spray_status = True
+		key = sprayMethodCache.getKey(spray_distance, spray_hight, spray_speed, spray_flow, spray_cycles, spray_delay, spray_solution, cleanTemplate=cleanTemplate)
+		filename = sprayMethodCache.getCachedMethod(key)
+		if filename is None and settings().getBoolean(["spray", "streamMethods"]):
+			# generate the method while it is being sprayed, it ends up in the cache for the next time along the way
+			plan = sprayPath.SprayPlan(spray_distance, spray_hight, spray_speed, spray_flow, spray_cycles, spray_delay, str(spray_solution).strip(), cleanTemplate=cleanTemplate)
+			printer.command(";spray.gcode")
+			printer.selectGeneratedFile("spray.gcode", lambda: sprayMethodCache.iterLinesAndCache(key, plan), plan.commandCount, True)
+		else:
+			if filename is None:
+				filename = sprayMethodCache.getMethod(spray_distance, spray_hight, spray_speed, spray_flow, spray_cycles, spray_delay, spray_solution, cleanTemplate=cleanTemplate)
+			printer.command(";" + filename)
+			printer.selectFile(filename, False, True)
 	return jsonify(SUCCESS)
 
+def _getMethodPath(filename):
+	"""
+	Returns the path of the given fixed method (clean, purge, prime), which live in the spray methods folder.
+	"""
+	return os.path.join(settings().getBaseFolder("sprayMethods"), filename)
+
 @app.route(BASEURL + "control/job", methods=["POST"])
 @login_required
 def printJobControl():
 	global spray_status
 	if "command" in request.values.keys():
-		if request.values["command"] == "start":
-			spray_status = False
-			printer.startPrint()
-		elif request.values["command"] == "pause":
-			printer.togglePausePrint()
-		elif request.values["command"] == "cancel":
-			printer.cancelPrint(False)
-			if spray_status:
-				printer.selectFile("/home/pi/OctoPrint/octoprint/methods/clean.gcode", False, True)
+		with sprayMutex:
+			if request.values["command"] == "start":
 				spray_status = False
+				printer.startPrint()
+			elif request.values["command"] == "pause":
+				printer.togglePausePrint()
+			elif request.values["command"] == "cancel":
+				printer.cancelPrint(False)
+				if spray_status:
+					printer.selectFile(_getMethodPath("clean.gcode"), False, True)
+					spray_status = False
 	#else:
 	#printer.commands(["G1 Z16.5","M84", "M104 S0", "M140 S0", "M106 S0"])
 	return jsonify(SUCCESS)
@@ -551,7 +771,16 @@ def sdCommand():
 
 @app.route(BASEURL + "gcodefiles", methods=["GET"])
 def readGcodeFiles():
-	files = gcodeManager.getAllFileData()
+	sortBy = request.values.get("sort", "name")
+	reverse = request.values.get("order", "asc") == "desc"
+	try:
+		offset = max(0, int(request.values.get("offset", 0)))
+		limit = int(request.values["limit"]) if "limit" in request.values.keys() else None
+	except ValueError:
+		return make_response("offset and limit need to be integers", 400)
+
+	# the local files are paginated, files on the printer's sd card are always included
+	files = gcodeManager.getAllFileData(sortBy, reverse, offset, limit)
 
 	sdFileList = printer.getSdFiles()
 	if sdFileList is not None:
@@ -563,7 +792,7 @@ def readGcodeFiles():
 				"date": "n/a",
 				"origin": "sd"
 			})
-	return jsonify(files=files, free=util.getFormattedSize(util.getFreeBytes(settings().getBaseFolder("uploads"))))
+	return jsonify(files=files, total=gcodeManager.getFileCount(), free=util.getFormattedSize(gcodeManager.getFreeBytes()))
 
 @app.route(BASEURL + "gcodefiles/<path:filename>", methods=["GET"])
 def readGcodeFile(filename):
@@ -659,18 +888,28 @@ def refreshFiles():
 	return jsonify(SUCCESS)
 
 #-- very simple api routines
+def _getApiKey():
+	# never from the form, so the key is checked before a request body is parsed
+	return request.headers.get("X-Api-Key", request.args.get("apikey", None))
+
+def _checkApiKey(apiKey):
+	"""
+	Returns None if the API is enabled and the given key is the right one, otherwise the HTTP status code to reject the
+	request with.
+	"""
+	if not settings().get(["api", "enabled"]) or apiKey is None:
+		return 401
+	if apiKey != settings().get(["api", "key"]):
+		return 403
+	return None
+
 @app.route(APIBASEURL + "load", methods=["POST"])
 def apiLoad():
 	logger = logging.getLogger(__name__)
 
-	if not settings().get(["api", "enabled"]):
-		abort(401)
-
-	if not "apikey" in request.values.keys():
-		abort(401)
-
-	if request.values["apikey"] != settings().get(["api", "key"]):
-		abort(403)
+	status = _checkApiKey(_getApiKey())
+	if status is not None:
+		abort(status)
 
 	if not "file" in request.files.keys():
 		abort(400)
@@ -693,14 +932,9 @@ def apiLoad():
 
 @app.route(APIBASEURL + "state", methods=["GET"])
 def apiPrinterState():
-	if not settings().get(["api", "enabled"]):
-		abort(401)
-
-	if not "apikey" in request.values.keys():
-		abort(401)
-
-	if request.values["apikey"] != settings().get(["api", "key"]):
-		abort(403)
+	status = _checkApiKey(_getApiKey())
+	if status is not None:
+		abort(status)
 
 	currentData = printer.getCurrentData()
 	currentData.update({
@@ -708,6 +942,33 @@ def apiPrinterState():
 	})
 	return jsonify(currentData)
 
+#~~ telemetry of print runs
+
+@app.route(BASEURL + "telemetry", methods=["GET"])
+def getTelemetryRuns():
+	telemetryStore = printer.getTelemetryStore()
+	if telemetryStore is None:
+		return jsonify(runs=[])
+	return jsonify(runs=telemetryStore.getRuns(request.values.get("filename", None)))
+
+@app.route(BASEURL + "telemetry/<runId>", methods=["GET"])
+def getTelemetry(runId):
+	telemetryStore = printer.getTelemetryStore()
+	if telemetryStore is None:
+		abort(404)
+
+	try:
+		start = float(request.values["start"]) if "start" in request.values.keys() else None
+		end = float(request.values["end"]) if "end" in request.values.keys() else None
+		points = max(1, int(request.values.get("points", 500)))
+	except ValueError:
+		return make_response("start and end need to be numbers, points an integer", 400)
+
+	result = telemetryStore.query(runId, start, end, points)
+	if result is None:
+		abort(404)
+	return jsonify(result)
+
 #~~ timelapse handling
 
 @app.route(BASEURL + "timelapse", methods=["GET"])
@@ -1040,6 +1301,15 @@ def performSystemAction():
 					return app.make_response(("Command failed: %r" % ex, 500, []))
 	return jsonify(SUCCESS)
 
+@app.route(BASEURL + "system/metrics", methods=["GET"])
+@login_required
+@admin_permission.require(403)
+def getSystemMetrics():
+	wsgiMetrics = None
+	if isinstance(wsgiContainer, ThreadedWSGIContainer):
+		wsgiMetrics = wsgiContainer.getMetrics()
+	return jsonify(wsgi=wsgiMetrics, stateUpdates=printer.getStateUpdateMetrics(), stateBroadcast=stateBroadcaster.getMetrics())
+
 #~~ Login/user handling
 
 @app.route(BASEURL + "login", methods=["POST"])
@@ -1096,6 +1366,455 @@ def load_user(id):
 		return userManager.findUser(id)
 	return users.DummyUser()
 
+#~~ file downloads
+
+class DownloadHandler(tornado.web.RequestHandler):
+	"""
+	Serves the files in a folder directly from Tornado, so big downloads don't keep the IOLoop busy the way serving
+	them through the WSGI fallback does. Files are sent in chunks, each one only after the previous one has been
+	flushed to the client, with support for single byte ranges (Range, If-Range) and ETags (If-None-Match).
+
+	The ETag is made up of inode, size and mtime of the file, which changes whenever the file is replaced or modified
+	and is available right away, without reading the file.
+
+	The chunks are read into memory and written through the IOStream instead of using sendfile: Tornado 3.0's
+	IOStream has no support for it and writing to its socket directly would bypass its write buffer (and SSL).
+
+	Only GET and HEAD are handled here, all other requests are passed on to the given fallback.
+	"""
+
+	CHUNK_SIZE = 64 * 1024
+
+	_rangeMatcher = re.compile("^bytes=(\d*)-(\d*)$")
+
+	def initialize(self, path, allowedExtensions, fallback):
+		self._path = path
+		self._allowedExtensions = set(allowedExtensions)
+		self._fallback = fallback
+		self._file = None
+		self._remaining = 0
+
+	def prepare(self):
+		if not self.request.method in ("GET", "HEAD"):
+			self._fallback(self.request)
+			self._finished = True
+
+	def head(self, filename):
+		self.get(filename, includeBody=False)
+
+	@tornado.web.asynchronous
+	def get(self, filename, includeBody=True):
+		if not util.isAllowedFile(filename.lower(), self._allowedExtensions):
+			raise tornado.web.HTTPError(404)
+		absolutePath = os.path.join(self._path, secure_filename(filename))
+		if not os.path.isfile(absolutePath):
+			raise tornado.web.HTTPError(404)
+
+		statResult = os.stat(absolutePath)
+		size = statResult.st_size
+		etag = '"%x-%x-%x"' % (statResult.st_ino, size, int(statResult.st_mtime * 1000000))
+
+		self.set_header("ETag", etag)
+		self.set_header("Last-Modified", datetime.datetime.utcfromtimestamp(statResult.st_mtime))
+		self.set_header("Accept-Ranges", "bytes")
+		self.set_header("Content-Disposition", "attachment; filename=%s" % os.path.basename(absolutePath))
+		mimeType = mimetypes.guess_type(absolutePath)[0]
+		self.set_header("Content-Type", mimeType if mimeType is not None else "application/octet-stream")
+
+		ifNoneMatch = self.request.headers.get("If-None-Match")
+		if ifNoneMatch is not None and (ifNoneMatch.strip() == "*" or etag in [tag.strip() for tag in ifNoneMatch.split(",")]):
+			self.set_status(304)
+			self.clear_header("Content-Disposition")
+			self.clear_header("Content-Type")
+			self.finish()
+			return
+
+		start = 0
+		end = size
+		rangeHeader = self.request.headers.get("Range")
+		ifRange = self.request.headers.get("If-Range")
+		if rangeHeader is not None and (ifRange is None or ifRange.strip() == etag):
+			byteRange = self._parseRange(rangeHeader, size)
+			if byteRange is False:
+				self.set_status(416)
+				self.set_header("Content-Range", "bytes */%d" % size)
+				self.clear_header("Content-Disposition")
+				self.finish()
+				return
+			elif byteRange is not None:
+				(start, end) = byteRange
+				self.set_status(206)
+				self.set_header("Content-Range", "bytes %d-%d/%d" % (start, end - 1, size))
+
+		self.set_header("Content-Length", end - start)
+		if not includeBody or end == start:
+			self.finish()
+			return
+
+		self._file = open(absolutePath, "rb")
+		self._file.seek(start)
+		self._remaining = end - start
+		self._sendChunk()
+
+	def _sendChunk(self):
+		if self._file is None:
+			# connection got closed in the meantime
+			return
+
+		if self._remaining <= 0:
+			self._closeFile()
+			self.finish()
+			return
+
+		data = self._file.read(min(self.CHUNK_SIZE, self._remaining))
+		if not data:
+			# file got truncated while sending it, nothing we can do but cut the response short
+			self._closeFile()
+			self.request.connection.stream.close()
+			return
+
+		self._remaining -= len(data)
+		self.write(data)
+		self.flush(callback=self._sendChunk)
+
+	def _closeFile(self):
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+
+	def on_connection_close(self):
+		self._closeFile()
+
+	def compute_etag(self):
+		# the ETag is already set in get, don't have Tornado hash the last chunk written
+		return None
+
+	def _parseRange(self, rangeHeader, size):
+		"""
+		Returns (start, end) of the byte range requested by the given Range header, None if the header is to be
+		ignored (unknown unit or multiple ranges) and False if the range can't be satisfied.
+		"""
+		match = self._rangeMatcher.match(rangeHeader.strip())
+		if match is None:
+			return None
+
+		(first, last) = match.groups()
+		if first == "" and last == "":
+			return None
+		elif first == "":
+			# suffix range, the last n bytes
+			length = int(last)
+			if length == 0:
+				return False
+			return (max(0, size - length), size)
+		else:
+			start = int(first)
+			end = size if last == "" else min(size, int(last) + 1)
+			if start >= size or start >= end:
+				return False
+			return (start, end)
+
+#~~ streaming uploads
+
+# upload endpoints whose request bodies are parsed while they arrive, with the form field of the uploaded file
+STREAMING_UPLOADS = {
+	BASEURL + "gcodefiles/upload": "gcode_file",
+	APIBASEURL + "load": "file"
+}
+
+# bytes of an upload read from the socket at most before they are passed on
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+class UploadHTTPServer(tornado.httpserver.HTTPServer):
+	"""
+	HTTPServer streaming gcode uploads to disk, see UploadHTTPConnection and UploadIOStream.
+	"""
+
+	def handle_stream(self, stream, address):
+		if not isinstance(stream, tornado.iostream.SSLIOStream):
+			# nothing has been read from the connection yet, so it can still be handed to another stream
+			stream = UploadIOStream(stream.socket, io_loop=stream.io_loop, max_buffer_size=stream.max_buffer_size, read_chunk_size=64 * 1024)
+		UploadHTTPConnection(stream, address, self.request_callback, self.no_keep_alive, self.xheaders, self.protocol)
+
+class UploadIOStream(tornado.iostream.IOStream):
+	"""
+	The plain IOStream reads everything the client manages to send before it runs the streaming callback of a
+	read_bytes, which with a fast client is about the whole upload. This one stops reading from the socket once
+	UPLOAD_CHUNK_SIZE bytes are waiting for the streaming callback, so the client has to wait for them to be written.
+	"""
+
+	def _read_to_buffer(self):
+		if self._streaming_callback is not None and self._read_buffer_size >= UPLOAD_CHUNK_SIZE:
+			return 0
+		return tornado.iostream.IOStream._read_to_buffer(self)
+
+class UploadHTTPConnection(tornado.httpserver.HTTPConnection):
+	"""
+	Tornado 3.0's HTTPConnection reads the complete request body into memory before the request gets handled. For the
+	endpoints in STREAMING_UPLOADS this one parses multipart bodies while they arrive instead (see
+	multipart.MultipartParser) and writes the uploaded gcode file straight into a gcodefiles.UploadStream, at most
+	one per request. The request is then handed on with only the other form fields as its body and the received file
+	attached, which OctoPrintRequest turns back into request.files.
+
+	Uploads through the API need the API key in the X-Api-Key header or the query string, it's checked before
+	anything of the body is stored.
+	"""
+
+	def _on_headers(self, data):
+		if not self._startUpload(data):
+			tornado.httpserver.HTTPConnection._on_headers(self, data)
+
+	def _startUpload(self, data):
+		"""
+		Starts streaming the body of the request with the given headers if it's an upload, returns False otherwise.
+		"""
+		if gcodeManager is None or not settings().getBoolean(["feature", "streamingUploads"]):
+			return False
+
+		data = tornado.escape.native_str(data.decode("latin1"))
+		eol = data.find("\r\n")
+		try:
+			(method, uri, version) = data[:eol].split(" ")
+			path = uri.split("?", 1)[0]
+			if method != "POST" or not path in STREAMING_UPLOADS:
+				return False
+			headers = tornado.httputil.HTTPHeaders.parse(data[eol:])
+			contentLength = int(headers.get("Content-Length"))
+		except (ValueError, TypeError):
+			# let the default handling deal with whatever this is
+			return False
+
+		boundary = multipart.getBoundary(headers.get("Content-Type"))
+		if boundary is None:
+			return False
+
+		remoteIp = self.address[0] if self.address_family in (socket.AF_INET, socket.AF_INET6) else "0.0.0.0"
+		self._request = tornado.httpserver.HTTPRequest(connection=self, method=method, uri=uri, version=version, headers=headers, remote_ip=remoteIp, protocol=self.protocol)
+		self._uploads = []
+		self._uploadField = STREAMING_UPLOADS[path]
+		self._parser = multipart.MultipartParser(boundary, self._createUploadPart)
+
+		if path == APIBASEURL + "load":
+			status = _checkApiKey(headers.get("X-Api-Key", self._request.arguments.get("apikey", [None])[0]))
+			if status is not None:
+				self._rejectUpload(status)
+				return True
+
+		if headers.get("Expect") == "100-continue":
+			self.stream.write("HTTP/1.1 100 (Continue)\r\n\r\n")
+		self.stream.set_close_callback(self._onUploadAborted)
+		self.stream.read_bytes(contentLength, self._onUploadReceived, streaming_callback=self._onUploadData)
+		return True
+
+	def _createUploadPart(self, name, filename, contentType):
+		if filename is None:
+			return None
+
+		stream = None
+		if name == self._uploadField and not any(isinstance(upload[3], gcodefiles.UploadStream) for upload in self._uploads):
+			stream = gcodeManager.createUploadStream(filename)
+		self._uploads.append((name, filename, contentType, stream))
+		if stream is None:
+			# not a gcode file or not the field the endpoint expects, nothing to keep but its name
+			return _DiscardedUploadPart()
+		return stream
+
+	def _onUploadData(self, data):
+		if self._parser is None:
+			return
+		try:
+			self._parser.feed(data)
+		except ValueError, e:
+			logging.getLogger(__name__).warn("Rejecting malformed upload from %s: %s" % (self._request.remote_ip, str(e)))
+			self._rejectUpload(400)
+		except:
+			logging.getLogger(__name__).exception("Error while receiving upload from %s" % self._request.remote_ip)
+			self._rejectUpload(500)
+
+	def _onUploadReceived(self, data):
+		if self._parser is None:
+			return
+		self.stream.set_close_callback(None)
+		try:
+			self._parser.finish()
+		except ValueError, e:
+			logging.getLogger(__name__).warn("Rejecting incomplete upload from %s: %s" % (self._request.remote_ip, str(e)))
+			self._rejectUpload(400)
+			return
+
+		for (name, filename, contentType, stream) in self._uploads:
+			if stream is not None:
+				stream.finish()
+
+		body = urllib.urlencode(self._parser.fields)
+		self._request.body = body
+		self._request.headers["Content-Type"] = "application/x-www-form-urlencoded"
+		self._request.headers["Content-Length"] = str(len(body))
+		self._request.uploads = self._uploads
+		self._parser = None
+		self._uploads = None
+		self.request_callback(self._request)
+
+	def _onUploadAborted(self):
+		self._closeUploads()
+
+	def _rejectUpload(self, status):
+		self._closeUploads()
+		self.stream.set_close_callback(None)
+		if not self.stream.closed():
+			self.stream.write("HTTP/1.1 %d %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n" % (status, httplib.responses[status]), self.close)
+
+	def _closeUploads(self):
+		self._parser = None
+		if self._uploads is not None:
+			for (name, filename, contentType, stream) in self._uploads:
+				if stream is not None:
+					stream.close()
+			self._uploads = None
+
+class _DiscardedUploadPart(object):
+	def write(self, data):
+		pass
+
+#~~ WSGI fallback
+
+class ThreadedWSGIContainer(tornado.wsgi.WSGIContainer):
+	"""
+	WSGIContainer that runs the WSGI application in a pool of worker threads instead of on the IOLoop, so slow
+	requests don't hold up the socket.io connections. Only the finished response is written back on the IOLoop.
+	With no threads, requests are processed right on the IOLoop like by the plain WSGIContainer.
+
+	At most maxQueued requests wait for a free worker, further requests are answered right away with a 503.
+
+	Files received by UploadHTTPConnection are passed on to the WSGI application in the environ as
+	"octoprint.uploads".
+	"""
+
+	def __init__(self, wsgi_application, threads=4, maxQueued=64):
+		tornado.wsgi.WSGIContainer.__init__(self, wsgi_application)
+		self._logger = logging.getLogger(__name__)
+		self._ioloop = tornado.ioloop.IOLoop.instance()
+		self._queue = Queue.Queue(maxQueued)
+		self._threads = threads
+
+		self._metricsMutex = threading.Lock()
+		self._active = 0
+		self._received = 0
+		self._completed = 0
+		self._rejected = 0
+		self._totalQueueTime = 0.0
+		self._maxQueueTime = 0.0
+		self._totalProcessingTime = 0.0
+		self._maxProcessingTime = 0.0
+
+		for i in range(threads):
+			worker = threading.Thread(target=self._work, name="WSGIWorker-%d" % i)
+			worker.daemon = True
+			worker.start()
+
+	def __call__(self, request):
+		with self._metricsMutex:
+			self._received += 1
+		if self._threads == 0:
+			(statusCode, response) = self._processRequest(request)
+			with self._metricsMutex:
+				self._completed += 1
+			self._writeResponse(request, statusCode, response)
+			return
+
+		try:
+			self._queue.put_nowait((request, time.time()))
+		except Queue.Full:
+			with self._metricsMutex:
+				self._rejected += 1
+			self._logger.warn("Request queue is full, rejecting %s %s" % (request.method, request.uri))
+			self._writeResponse(request, 503, "HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nRetry-After: 1\r\n\r\n")
+
+	def _work(self):
+		while True:
+			(request, queuedAt) = self._queue.get()
+			startedAt = time.time()
+			with self._metricsMutex:
+				self._active += 1
+
+			try:
+				(statusCode, response) = self._processRequest(request)
+			except:
+				self._logger.exception("Error while processing %s %s" % (request.method, request.uri))
+				(statusCode, response) = (500, "HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\n\r\n")
+
+			finishedAt = time.time()
+			with self._metricsMutex:
+				self._active -= 1
+				self._completed += 1
+				self._totalQueueTime += startedAt - queuedAt
+				self._maxQueueTime = max(self._maxQueueTime, startedAt - queuedAt)
+				self._totalProcessingTime += finishedAt - startedAt
+				self._maxProcessingTime = max(self._maxProcessingTime, finishedAt - startedAt)
+
+			self._ioloop.add_callback(self._writeResponse, request, statusCode, response)
+
+	def _processRequest(self, request):
+		"""
+		Runs the WSGI application for the given request and returns the status code and the complete HTTP response,
+		same as WSGIContainer.__call__ does but without writing it to the connection.
+		"""
+		data = {}
+		response = []
+
+		def start_response(status, response_headers, exc_info=None):
+			data["status"] = status
+			data["headers"] = response_headers
+			return response.append
+		environ = tornado.wsgi.WSGIContainer.environ(request)
+		environ["octoprint.uploads"] = getattr(request, "uploads", None)
+		appResponse = self.wsgi_application(environ, start_response)
+		response.extend(appResponse)
+		body = "".join(response)
+		if hasattr(appResponse, "close"):
+			appResponse.close()
+		if not data:
+			raise Exception("WSGI app did not call start_response")
+
+		statusCode = int(data["status"].split()[0])
+		headers = data["headers"]
+		headerSet = set(key.lower() for (key, value) in headers)
+		body = tornado.escape.utf8(body)
+		if statusCode != 304:
+			if not "content-length" in headerSet:
+				headers.append(("Content-Length", str(len(body))))
+			if not "content-type" in headerSet:
+				headers.append(("Content-Type", "text/html; charset=UTF-8"))
+		if not "server" in headerSet:
+			headers.append(("Server", "TornadoServer/%s" % tornado.version))
+
+		parts = [tornado.escape.utf8("HTTP/1.1 " + data["status"] + "\r\n")]
+		for (key, value) in headers:
+			parts.append(tornado.escape.utf8(key) + ": " + tornado.escape.utf8(value) + "\r\n")
+		parts.append("\r\n")
+		parts.append(body)
+		return (statusCode, "".join(parts))
+
+	def _writeResponse(self, request, statusCode, response):
+		request.write(response)
+		request.finish()
+		self._log(statusCode, request)
+
+	def getMetrics(self):
+		with self._metricsMutex:
+			return {
+				"threads": self._threads,
+				"active": self._active,
+				"queued": self._queue.qsize(),
+				"received": self._received,
+				"completed": self._completed,
+				"rejected": self._rejected,
+				"averageQueueTime": self._totalQueueTime / self._completed if self._completed > 0 else 0.0,
+				"maxQueueTime": self._maxQueueTime,
+				"averageProcessingTime": self._totalProcessingTime / self._completed if self._completed > 0 else 0.0,
+				"maxProcessingTime": self._maxProcessingTime
+			}
+
 #~~ startup code
 class Server():
 	def __init__(self, configfile=None, basedir=None, host="0.0.0.0", port=5000, debug=False):
@@ -1110,11 +1829,12 @@ class Server():
 		# Global as I can't work out a way to get it into PrinterStateConnection
 		global printer
 		global gcodeManager
+		global sprayMethodCache
 		global userManager
 		global eventManager
+		global stateBroadcaster
+		global wsgiContainer
 		
-		from tornado.wsgi import WSGIContainer
-		from tornado.httpserver import HTTPServer
 		from tornado.ioloop import IOLoop
 		from tornado.web import Application, FallbackHandler
 
@@ -1127,7 +1847,9 @@ class Server():
 
 		eventManager = events.eventManager()
 		gcodeManager = gcodefiles.GcodeManager()
+		sprayMethodCache = sprayPath.SprayMethodCache(settings().getBaseFolder("sprayMethods"), settings().getInt(["spray", "methodCache", "maxSize"]))
 		printer = Printer(gcodeManager)
+		stateBroadcaster = StateBroadcaster(printer, gcodeManager, eventManager)
 
 		# setup system and gcode command triggers
 		events.SystemCommandTrigger(printer)
@@ -1162,10 +1884,13 @@ class Server():
 
 		self._router = tornadio2.TornadioRouter(self._createSocketConnection)
 
+		wsgiContainer = ThreadedWSGIContainer(app, max(0, settings().getInt(["server", "wsgi", "threads"])), settings().getInt(["server", "wsgi", "maxQueued"]))
 		self._tornado_app = Application(self._router.urls + [
-			(".*", FallbackHandler, {"fallback": WSGIContainer(app)})
+			(BASEURL + "gcodefiles/([^/]+)", DownloadHandler, {"path": settings().getBaseFolder("uploads"), "allowedExtensions": gcodefiles.SUPPORTED_EXTENSIONS, "fallback": wsgiContainer}),
+			(BASEURL + "timelapse/([^/]+)", DownloadHandler, {"path": settings().getBaseFolder("timelapse"), "allowedExtensions": ["mpg"], "fallback": wsgiContainer}),
+			(".*", FallbackHandler, {"fallback": wsgiContainer})
 		])
-		self._server = HTTPServer(self._tornado_app)
+		self._server = UploadHTTPServer(self._tornado_app)
 		self._server.listen(self._port, address=self._host)
 
 		eventManager.fire("Startup")
@@ -1177,8 +1902,8 @@ class Server():
 		IOLoop.instance().start()
 
 	def _createSocketConnection(self, session, endpoint=None):
-		global printer, gcodeManager, userManager, eventManager
-		return PrinterStateConnection(printer, gcodeManager, userManager, eventManager, session, endpoint)
+		global printer, userManager, eventManager, stateBroadcaster
+		return PrinterStateConnection(printer, userManager, eventManager, stateBroadcaster, session, endpoint)
 
 	def _initSettings(self, configfile, basedir):
 		s = settings(init=True, basedir=basedir, configfile=configfile)
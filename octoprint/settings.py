@@ -32,12 +32,22 @@ default_settings = {
 			"detection": 0.5,
 			"connection": 2,
 			"communication": 5
+		},
+		"sendWindow": {
+			"enabled": False,
+			"lines": 4,
+			"rxBufferSize": 127,
+			"okAfterResend": False
 		}
 	},
 	"server": {
 		"host": "0.0.0.0",
 		"port": 5000,
-		"firstRun": True
+		"firstRun": True,
+		"wsgi": {
+			"threads": 4,
+			"maxQueued": 64
+		}
 	},
 	"webcam": {
 		"stream": None,
@@ -52,14 +62,59 @@ default_settings = {
 		"gCodeVisualizer": True,
 		"waitForStartOnConnect": False,
 		"alwaysSendChecksum": False,
-		"sdSupport": True
+		"sdSupport": True,
+		"precompileJobs": False,
+		"mapJobFiles": False,
+		"sprayTimeEstimation": True,
+		"streamingUploads": True
 	},
 	"folder": {
 		"uploads": None,
 		"timelapse": None,
 		"timelapse_tmp": None,
 		"logs": None,
-		"virtualSd": None
+		"virtualSd": None,
+		"sprayMethods": None,
+		"telemetry": None,
+		"compiledJobs": None
+	},
+	"metadata": {
+		"store": "octoprint.gcodefiles.YamlMetadataStore",
+		"commitInterval": 1.0
+	},
+	"stateUpdates": {
+		"interval": 0.5,
+		"logInterval": 2.0,
+		"logBatchSize": 100,
+		"maxLoad": 0.25
+	},
+	"telemetry": {
+		"temperatureHistory": {
+			"samples": 4320,
+			"interval": 5.0
+		},
+		"store": {
+			"enabled": True,
+			"maxRuns": 100,
+			"flushInterval": 1.0,
+			"progressInterval": 5.0
+		}
+	},
+	"analysis": {
+		"processes": 1,
+		"timeout": 600,
+		"cacheSize": 1000
+	},
+	"spray": {
+		"streamMethods": True,
+		"kinematics": {
+			"maxFeedrate": {"x": 500, "y": 500, "z": 500, "p": 25, "v": 25},
+			"maxAcceleration": {"x": 3000, "y": 3000, "z": 3000, "p": 100, "v": 100},
+			"homingFeedrate": 50
+		},
+		"methodCache": {
+			"maxSize": 100 * 1024 * 1024
+		}
 	},
 	"temperature": {
 		"profiles":
@@ -101,6 +156,11 @@ default_settings = {
 	"api": {
 		"enabled": False,
 		"key": ''.join('%02X' % ord(z) for z in uuid.uuid4().bytes)
+	},
+	"devel": {
+		"virtualPrinter": {
+			"latency": 0
+		}
 	}
 }
 
@@ -412,6 +412,8 @@ function TemperatureViewModel(loginStateViewModel, settingsViewModel) {
     });
 
     self.temperatures = [];
+    // the history sent by the server may cover more than the last 300 samples
+    self.maxTemperatureSamples = 300;
     self.plotOptions = {
         yaxis: {
             min: 0,
@@ -490,16 +492,23 @@ function TemperatureViewModel(loginStateViewModel, settingsViewModel) {
             self.temperatures.actualBed.push([data[i].currentTime, data[i].bedTemp])
             self.temperatures.targetBed.push([data[i].currentTime, data[i].targetBedTemp])
         }
-        self.temperatures.actual = self.temperatures.actual.slice(-300);
-        self.temperatures.target = self.temperatures.target.slice(-300);
-        self.temperatures.actualBed = self.temperatures.actualBed.slice(-300);
-        self.temperatures.targetBed = self.temperatures.targetBed.slice(-300);
+        self.temperatures.actual = self.temperatures.actual.slice(-self.maxTemperatureSamples);
+        self.temperatures.target = self.temperatures.target.slice(-self.maxTemperatureSamples);
+        self.temperatures.actualBed = self.temperatures.actualBed.slice(-self.maxTemperatureSamples);
+        self.temperatures.targetBed = self.temperatures.targetBed.slice(-self.maxTemperatureSamples);
 
         self.updatePlot();
     }
 
     self._processTemperatureHistoryData = function(data) {
-        self.temperatures = data;
+        // the history comes as one list per column, the graph wants [time, value] pairs
+        self.temperatures = {
+            actual: _.zip(data.time, data.actual),
+            target: _.zip(data.time, data.target),
+            actualBed: _.zip(data.time, data.actualBed),
+            targetBed: _.zip(data.time, data.targetBed)
+        };
+        self.maxTemperatureSamples = Math.max(300, data.time.length);
         self.updatePlot();
     }
 
@@ -787,14 +796,47 @@ function TerminalViewModel(loginStateViewModel) {
     self.regexM105 = /(Send: M105)|(Recv: ok T:)/;
     self.regexM27 = /(Send: M27)|(Recv: SD printing byte)/;
 
+    // the server only sends the log while the terminal is shown, with the suppressed lines already filtered out
+    self.active = false;
+    self._logSubscriber = undefined;
+
     self.filterM105.subscribe(function(newValue) {
+        self.updateSubscription();
         self.updateOutput();
     });
 
     self.filterM27.subscribe(function(newValue) {
+        self.updateSubscription();
         self.updateOutput();
     });
 
+    self.setLogSubscriber = function(subscriber) {
+        self._logSubscriber = subscriber;
+        self.updateSubscription();
+    }
+
+    self.setActive = function(active) {
+        if (self.active == active)
+            return;
+        self.active = active;
+        self.updateSubscription();
+    }
+
+    self.updateSubscription = function() {
+        if (!self._logSubscriber)
+            return;
+
+        if (!self.active) {
+            self._logSubscriber(undefined);
+            return;
+        }
+
+        var filters = [];
+        if (self.filterM105()) filters.push(self.regexM105.source);
+        if (self.filterM27()) filters.push(self.regexM27.source);
+        self._logSubscriber(filters);
+    }
+
     self.fromCurrentData = function(data) {
         self._processStateData(data.state);
         self._processCurrentLogData(data.logs);
@@ -818,6 +860,10 @@ function TerminalViewModel(loginStateViewModel) {
         self.updateOutput();
     }
 
+    self.fromLogHistoryData = function(data) {
+        self._processHistoryLogData(data);
+    }
+
     self._processStateData = function(data) {
         self.isErrorOrClosed(data.flags.closedOrError);
         self.isOperational(data.flags.operational);
@@ -1668,8 +1714,23 @@ function DataUpdater(loginStateViewModel, connectionViewModel, printerStateViewM
     self.timelapseViewModel = timelapseViewModel;
     self.gcodeViewModel = gcodeViewModel;
 
+    // state as of the last applied update, see StateMonitor in printer.py
+    self._stateSeq = undefined;
+    self._stateData = undefined;
+    self._pendingDeltas = [];
+
     self._socket = io.connect();
+    self.terminalViewModel.setLogSubscriber(function(filters) {
+        if (filters === undefined) {
+            self._socket.emit("unsubscribeLog");
+        } else {
+            self._socket.emit("subscribeLog", {filters: filters});
+        }
+    });
     self._socket.on("connect", function() {
+        // subscriptions don't survive the connection
+        self.terminalViewModel.updateSubscription();
+
         if ($("#offline_overlay").is(":visible")) {
             $("#offline_overlay").hide();
             self.timelapseViewModel.requestData();
@@ -1679,6 +1740,10 @@ function DataUpdater(loginStateViewModel, connectionViewModel, printerStateViewM
         }
     });
     self._socket.on("disconnect", function() {
+        // the new session will start with a new snapshot
+        self._stateSeq = undefined;
+        self._pendingDeltas = [];
+
         $("#offline_overlay_message").html(
             "The server appears to be offline, at least I'm not getting any response from it. I'll try to reconnect " +
             "automatically <strong>over the next couple of minutes</strong>, however you are welcome to try a manual reconnect " +
@@ -1694,6 +1759,8 @@ function DataUpdater(loginStateViewModel, connectionViewModel, printerStateViewM
         );
     });
     self._socket.on("history", function(data) {
+        self._applySnapshot(data);
+
         self.connectionViewModel.fromHistoryData(data);
         self.printerStateViewModel.fromHistoryData(data);
         self.temperatureViewModel.fromHistoryData(data);
@@ -1703,15 +1770,17 @@ function DataUpdater(loginStateViewModel, connectionViewModel, printerStateViewM
         self.gcodeViewModel.fromHistoryData(data);
         self.gcodeFilesViewModel.fromCurrentData(data);
     });
-    self._socket.on("current", function(data) {
-        self.connectionViewModel.fromCurrentData(data);
-        self.printerStateViewModel.fromCurrentData(data);
-        self.temperatureViewModel.fromCurrentData(data);
-        self.controlViewModel.fromCurrentData(data);
-        self.terminalViewModel.fromCurrentData(data);
-        self.timelapseViewModel.fromCurrentData(data);
-        self.gcodeViewModel.fromCurrentData(data);
-        self.gcodeFilesViewModel.fromCurrentData(data);
+    self._socket.on("snapshot", function(data) {
+        // a snapshot after a backlog carries the temperatures, logs and messages of the updates skipped meanwhile
+        self._applySnapshot(data, data.temperatures || [], data.logs || [], data.messages || []);
+    });
+    self._socket.on("delta", function(data) {
+        if (self._stateSeq === undefined) {
+            // still waiting for the snapshot to apply this to
+            self._pendingDeltas.push(data);
+            return;
+        }
+        self._applyDelta(data);
     });
     self._socket.on("updateTrigger", function(type) {
         if (type == "gcodeFiles") {
@@ -1723,6 +1792,67 @@ function DataUpdater(loginStateViewModel, connectionViewModel, printerStateViewM
     self._socket.on("feedbackCommandOutput", function(data) {
         self.controlViewModel.fromFeedbackCommandData(data);
     });
+    self._socket.on("logHistory", function(data) {
+        self.terminalViewModel.fromLogHistoryData(data);
+    });
+
+    self._applySnapshot = function(data, temperatures, logs, messages) {
+        self._stateSeq = data.seq;
+        self._stateData = {
+            state: data.state,
+            job: data.job,
+            currentZ: data.currentZ,
+            progress: data.progress
+        };
+
+        if (temperatures !== undefined) {
+            self._fromCurrentData(temperatures, logs, messages);
+        }
+
+        var pendingDeltas = self._pendingDeltas;
+        self._pendingDeltas = [];
+        _.each(pendingDeltas, function(delta) {
+            self._applyDelta(delta);
+        });
+    }
+
+    self._applyDelta = function(data) {
+        if (data.seq <= self._stateSeq) {
+            // the state changes are already contained in the snapshot, the temperatures, logs and messages are not
+            if (data.temperatures || data.logs || data.messages) {
+                self._fromCurrentData(data.temperatures || [], data.logs || [], data.messages || []);
+            }
+            return;
+        }
+        if (data.seq != self._stateSeq + 1) {
+            // missed an update, request a new snapshot and keep this one until it arrives
+            self._stateSeq = undefined;
+            self._pendingDeltas = [data];
+            self._socket.emit("resync");
+            return;
+        }
+
+        self._stateSeq = data.seq;
+        _.extend(self._stateData, data.changes);
+        self._fromCurrentData(data.temperatures || [], data.logs || [], data.messages || []);
+    }
+
+    self._fromCurrentData = function(temperatures, logs, messages) {
+        var data = _.extend({}, self._stateData, {
+            temperatures: temperatures,
+            logs: logs,
+            messages: messages
+        });
+
+        self.connectionViewModel.fromCurrentData(data);
+        self.printerStateViewModel.fromCurrentData(data);
+        self.temperatureViewModel.fromCurrentData(data);
+        self.controlViewModel.fromCurrentData(data);
+        self.terminalViewModel.fromCurrentData(data);
+        self.timelapseViewModel.fromCurrentData(data);
+        self.gcodeViewModel.fromCurrentData(data);
+        self.gcodeFilesViewModel.fromCurrentData(data);
+    }
 
     self.reconnect = function() {
         self._socket.socket.connect();
@@ -2172,6 +2302,7 @@ $(function() {
         })
         $('#tabs a[data-toggle="tab"]').on('shown', function (e) {
             temperatureViewModel.updatePlot();
+            terminalViewModel.setActive($(e.target).attr("href") == "#term");
             terminalViewModel.updateOutput();
         });
 
@@ -6,6 +6,8 @@ import os
 import traceback
 import sys
 import time
+import sre_parse
+import sre_constants
 
 from octoprint.settings import settings
 
@@ -104,3 +106,24 @@ def getFreeBytes(path):
 		st = os.statvfs(path)
 		return st.f_bavail * st.f_frsize
 
+
+def getRegexNodes(pattern):
+	"""
+	Parses the given regular expression and yields (op, av, repeated) for all nodes of the parse tree (see sre_parse),
+	including the ones nested in groups, branches, repetitions and lookarounds. repeated tells whether the node is
+	part of a repetition. Raises sre_constants.error if the expression is invalid.
+	"""
+	subpatterns = [(sre_parse.parse(pattern), False)]
+	while subpatterns:
+		(subpattern, repeated) = subpatterns.pop()
+		for (op, av) in subpattern:
+			yield (op, av, repeated)
+
+			if not isinstance(av, (tuple, list)):
+				continue
+			isRepeat = op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+			for item in av:
+				for child in (item if isinstance(item, list) else [item]):
+					if isinstance(child, sre_parse.SubPattern):
+						subpatterns.append((child, repeated or isRepeat))
+
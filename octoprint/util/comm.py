@@ -1,25 +1,31 @@
-from __future__ import absolute_import
 # coding=utf-8
+from __future__ import absolute_import
 __author__ = "Gina Häußge <osd@foosel.net>"
 __license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
 
 import os
 import glob
+import mmap
 import time
 import re
+import sre_constants
 import threading
+import itertools
 import Queue as queue
 import logging
 import serial
+import numpy
 
 from collections import deque
 
 from octoprint.util.avr_isp import stk500v2
 from octoprint.util.avr_isp import ispBase
+from octoprint.util import gcodeCompiler
+from octoprint.util import sprayEstimator
 
 from octoprint.settings import settings
 from octoprint.events import eventManager
-from octoprint.util import isDevVersion, getExceptionString, getNewTimeout
+from octoprint.util import isDevVersion, getExceptionString, getNewTimeout, getRegexNodes
 from octoprint.util.virtual import VirtualPrinter
 
 try:
@@ -75,6 +81,131 @@ gcodeToEvent = {
 	"M81": "PowerOff"
 }
 
+##~~ response classification
+
+RESPONSE_OK = "ok"
+RESPONSE_TEMPERATURE = "temperature"
+RESPONSE_SD_INIT_FAIL = "sdInitFail"
+RESPONSE_NOT_SD_PRINTING = "notSdPrinting"
+RESPONSE_SD_CARD_OK = "sdCardOk"
+RESPONSE_BEGIN_FILE_LIST = "beginFileList"
+RESPONSE_END_FILE_LIST = "endFileList"
+RESPONSE_SD_PRINTING_BYTE = "sdPrintingByte"
+RESPONSE_FILE_OPENED = "fileOpened"
+RESPONSE_FILE_SELECTED = "fileSelected"
+RESPONSE_WRITING_TO_FILE = "writingToFile"
+RESPONSE_DONE_SPRAYING_FILE = "doneSprayingFile"
+
+# one alternative per response type, the name of the matching group is the type of the response
+_responseMatcher = re.compile("|".join([
+	"(?P<%s>(?:^| )T:)" % RESPONSE_TEMPERATURE,
+	"(?P<%s>SD init fail)" % RESPONSE_SD_INIT_FAIL,
+	"(?P<%s>Not SD printing)" % RESPONSE_NOT_SD_PRINTING,
+	"(?P<%s>SD card ok)" % RESPONSE_SD_CARD_OK,
+	"(?P<%s>Begin file list)" % RESPONSE_BEGIN_FILE_LIST,
+	"(?P<%s>End file list)" % RESPONSE_END_FILE_LIST,
+	"(?P<%s>SD printing byte)" % RESPONSE_SD_PRINTING_BYTE,
+	"(?P<%s>File opened)" % RESPONSE_FILE_OPENED,
+	"(?P<%s>File selected)" % RESPONSE_FILE_SELECTED,
+	"(?P<%s>Writing to file)" % RESPONSE_WRITING_TO_FILE,
+	"(?P<%s>Done spraying file)" % RESPONSE_DONE_SPRAYING_FILE
+]))
+
+_temperatureMatcher = re.compile("T:(-?[0-9\.]*)")
+_bedTemperatureMatcher = re.compile(" B:(-?[0-9\.]*)")
+_sdPrintingByteMatcher = re.compile("([0-9]*)/([0-9]*)")
+_fileOpenedMatcher = re.compile("File opened:\s*(.*?)\s+Size:\s*([0-9]*)")
+_errorNumberMatcher = re.compile("Error:[0-9]\n")
+_communicationErrorMatcher = re.compile("|".join([
+	"checksum mismatch",
+	"Wrong checksum",
+	"Line Number is not Last Line Number",
+	"expected line",
+	"No Line Number with checksum",
+	"No Checksum with line number",
+	"Missing checksum"
+]))
+
+def classifyResponse(line):
+	"""
+	Determines the type of a line received from the printer, returns one of the RESPONSE_* constants or None if the
+	line is none of those (e.g. an empty line or a message to display).
+	"""
+	if line == "ok\n" or line == "ok":
+		# by far the most common response, no need to bother the regex engine with it
+		return RESPONSE_OK
+
+	match = _responseMatcher.search(line)
+	if match is None:
+		return None
+	return match.lastgroup
+
+def parseTemperatureResponse(line):
+	"""
+	Extracts hotend and bed temperature from a temperature report, the latter is None if not included. Raises a
+	ValueError if the reported values can't be parsed.
+	"""
+	temp = float(_temperatureMatcher.search(line).group(1))
+	bedTemp = None
+	match = _bedTemperatureMatcher.search(line)
+	if match is not None:
+		bedTemp = float(match.group(1))
+	return (temp, bedTemp)
+
+def _combinePatterns(matchers):
+	"""
+	Returns a PatternFilter for the given compiled regexes, or None if there are none.
+	"""
+	if not matchers:
+		return None
+	return PatternFilter(matchers)
+
+def _hasBackreferences(pattern):
+	try:
+		return any(op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS) for (op, av, repeated) in getRegexNodes(pattern))
+	except sre_constants.error:
+		return True
+
+class PatternFilter(object):
+	"""
+	Tells whether any of the given compiled regexes matches a line, in one search for most lines: the patterns are
+	combined into one regex, each wrapped in a named group of its own.
+
+	Patterns with backreferences can't be combined, the groups they refer to would be numbered differently in the
+	combined regex, and neither can patterns compiled with flags or ones with group names already used by another
+	pattern. Those are searched separately.
+	"""
+
+	def __init__(self, matchers):
+		self._combined = None
+		self._separate = []
+
+		alternatives = []
+		for matcher in matchers:
+			if matcher.flags & ~re.UNICODE or _hasBackreferences(matcher.pattern):
+				self._separate.append(matcher)
+				continue
+
+			alternative = "(?P<pattern%d>%s)" % (len(alternatives), matcher.pattern)
+			try:
+				self._combined = re.compile("|".join(alternatives + [alternative]))
+				alternatives.append(alternative)
+			except re.error:
+				self._separate.append(matcher)
+
+	def matches(self, line):
+		if self._combined is not None and self._combined.search(line) is not None:
+			return True
+		for matcher in self._separate:
+			if matcher.search(line) is not None:
+				return True
+		return False
+
+def _readLines(filename):
+	with open(filename, "r") as f:
+		for line in f:
+			yield line
+
 class MachineCom(object):
 	STATE_NONE = 0
 	STATE_OPEN_SERIAL = 1
@@ -88,8 +219,17 @@ class MachineCom(object):
 	STATE_ERROR = 9
 	STATE_CLOSED_WITH_ERROR = 10
 	STATE_TRANSFERING_FILE = 11
+
+	# everything that ends up in the printer's planner is sent in the order it was issued (SEND_PRIORITY_NORMAL), only
+	# out-of-band lines like the empty wake-up lines during baudrate detection may jump the queue
+	SEND_PRIORITY_HIGH = 0
+	SEND_PRIORITY_NORMAL = 1
+	SEND_PRIORITY_CLOSE = 2
+
+	# seconds to wait for the writer to send out what's still queued when closing the connection
+	CLOSE_TIMEOUT = 5.0
 	
-	def __init__(self, port = None, baudrate = None, callbackObject = None):
+	def __init__(self, port = None, baudrate = None, callbackObject = None, serialLogging = True):
 		self._logger = logging.getLogger(__name__)
 		self._serialLogger = logging.getLogger("SERIAL")
 
@@ -107,6 +247,7 @@ class MachineCom(object):
 		self._port = port
 		self._baudrate = baudrate
 		self._callback = callbackObject
+		self._serialLogging = serialLogging
 		self._state = self.STATE_NONE
 		self._serial = None
 		self._baudrateDetectList = baudrateList()
@@ -119,16 +260,39 @@ class MachineCom(object):
 		self._currentZ = None
 		self._heatupWaitStartTime = 0
 		self._heatupWaitTimeLost = 0.0
+		self._heatingUp = False
 
 		self._alwaysSendChecksum = settings().getBoolean(["feature", "alwaysSendChecksum"])
 		self._currentLine = 0
 		self._resendDelta = None
 		self._lastLines = deque([], 50)
 
+		# windowed sending, keeps multiple lines in flight instead of waiting for an ok after each line
+		self._sendWindow = None
+		if settings().getBoolean(["serial", "sendWindow", "enabled"]):
+			# the window may never outgrow the resend history, otherwise we couldn't serve resend requests for it
+			windowLines = min(settings().getInt(["serial", "sendWindow", "lines"]), self._lastLines.maxlen - 1)
+			self._sendWindow = SendWindow(windowLines, settings().getInt(["serial", "sendWindow", "rxBufferSize"]))
+		# whether the firmware follows a resend request with an "ok" (like Marlin) or not (like the virtual printer),
+		# in the latter case the resend request is what frees the rejected line's place in the window
+		self._okAfterResend = settings().getBoolean(["serial", "sendWindow", "okAfterResend"])
+		self._heldLine = None
+		self._lastResendNumber = None
+		self._resendSwallowRepetitions = 0
+
 		# multithreading locks
 		self._sendNextLock = threading.Lock()
 		self._sendingLock = threading.Lock()
 
+		# serial I/O, lines read from the printer end up in the response queue along with their type (see
+		# classifyResponse), lines to write to the printer are taken from the send queue, both handled by their own
+		# threads started once the port is open
+		self._responseQueue = queue.Queue()
+		self._sendQueue = queue.PriorityQueue()
+		self._sendSequence = itertools.count()
+		self._readerThread = None
+		self._writerThread = None
+
 		# monitoring thread
 		self.thread = threading.Thread(target=self._monitor)
 		self.thread.daemon = True
@@ -141,6 +305,22 @@ class MachineCom(object):
 
 		# print job
 		self._currentFile = None
+		self._timeEstimate = None
+
+		# handlers for the response types determined by classifyResponse
+		self._responseHandlers = {
+			RESPONSE_TEMPERATURE: self._onTemperatureResponse,
+			RESPONSE_SD_INIT_FAIL: self._onSdInitFailResponse,
+			RESPONSE_NOT_SD_PRINTING: self._onNotSdPrintingResponse,
+			RESPONSE_SD_CARD_OK: self._onSdCardOkResponse,
+			RESPONSE_BEGIN_FILE_LIST: self._onBeginFileListResponse,
+			RESPONSE_END_FILE_LIST: self._onEndFileListResponse,
+			RESPONSE_SD_PRINTING_BYTE: self._onSdPrintingByteResponse,
+			RESPONSE_FILE_OPENED: self._onFileOpenedResponse,
+			RESPONSE_FILE_SELECTED: self._onFileSelectedResponse,
+			RESPONSE_WRITING_TO_FILE: self._onWritingToFileResponse,
+			RESPONSE_DONE_SPRAYING_FILE: self._onDoneSprayingFileResponse
+		}
 
 	def __del__(self):
 		self.close()
@@ -157,15 +337,44 @@ class MachineCom(object):
 				self._sdFiles = []
 				self._callback.mcSdFiles([])
 
+		# a print that's over, be it cancelled, failed or done, doesn't need its file open anymore
+		if self._state in (self.STATE_PRINTING, self.STATE_PAUSED) and not newState in (self.STATE_PRINTING, self.STATE_PAUSED):
+			self._closeCurrentFile()
+
 		oldState = self.getStateString()
 		self._state = newState
 		self._log('Changing monitoring state from \'%s\' to \'%s\'' % (oldState, self.getStateString()))
 		self._callback.mcStateChange(newState)
 
+	def _closeCurrentFile(self):
+		"""
+		Releases the resources held by the current file, it can still be started again afterwards.
+		"""
+		if self._currentFile is not None:
+			try:
+				self._currentFile.close()
+			except:
+				self._logger.exception("Could not close %s" % self._currentFile.getFilename())
+
 	def _log(self, message):
 		self._callback.mcLog(message)
 		self._serialLogger.debug(message)
 
+	def setSerialLogging(self, enabled):
+		"""
+		Sets whether the lines exchanged with the printer are forwarded to the callback's mcLog. They still go to the
+		serial log file if that is enabled.
+		"""
+		self._serialLogging = enabled
+
+	def _isLoggingSerial(self):
+		return self._serialLogging or self._serialLogger.isEnabledFor(logging.DEBUG)
+
+	def _logSerial(self, message):
+		if self._serialLogging:
+			self._callback.mcLog(message)
+		self._serialLogger.debug(message)
+
 	def _addToLastLines(self, cmd):
 		self._lastLines.append(cmd)
 		self._logger.debug("Got %d lines of history in memory" % len(self._lastLines))
@@ -262,6 +471,11 @@ class MachineCom(object):
 			return time.time() - self._currentFile.getStartTime()
 
 	def getPrintTimeRemainingEstimate(self):
+		if self._timeEstimate is not None and self._currentFile is not None:
+			commandIndex = self._currentFile.getCommandIndex()
+			if commandIndex is not None:
+				return self._timeEstimate.getRemainingTime(commandIndex) / 60
+
 		printTime = self.getPrintTime()
 		if printTime is None:
 			return None
@@ -284,6 +498,13 @@ class MachineCom(object):
 
 	def close(self, isError = False):
 		printing = self.isPrinting() or self.isPaused()
+
+		# stop the writer once it has sent everything queued before (like the M84 or cooldown sent right before
+		# disconnecting), unless the connection broke and nothing can be delivered anymore anyway
+		self._sendQueue.put((self.SEND_PRIORITY_CLOSE, next(self._sendSequence), None))
+		if not isError and self._writerThread is not None and self._writerThread is not threading.currentThread():
+			self._writerThread.join(self.CLOSE_TIMEOUT)
+
 		if self._serial is not None:
 			self._serial.close()
 			if isError:
@@ -303,6 +524,9 @@ class MachineCom(object):
 		cmd = cmd.encode('ascii', 'replace')
 		if self.isPrinting() and not self.isSdFileSelected():
 			self._commandQueue.put(cmd)
+			if self._sendWindow is not None:
+				# send it right away if there's still room in the window instead of waiting for the next ok
+				self._fillSendWindow()
 		elif self.isOperational():
 			self._sendCommand(cmd)
 
@@ -314,6 +538,9 @@ class MachineCom(object):
 			raise ValueError("No file selected for spraying")
 
 		self._printSection = "CUSTOM"
+		self._heldLine = None
+		if self._sendWindow is not None:
+			self._sendWindow.reset()
 		self._changeState(self.STATE_PRINTING)
 		eventManager().fire("PrintStarted", self._currentFile.getFilename())
 
@@ -325,7 +552,7 @@ class MachineCom(object):
 					self._currentFile.setFilepos(0)
 				self.sendCommand("M24")
 			else:
-				self._sendNext()
+				self._sendNextLines()
 		except:
 			self._errorValue = getExceptionString()
 			self._changeState(self.STATE_ERROR)
@@ -335,6 +562,7 @@ class MachineCom(object):
 		if not self.isOperational() or self.isBusy():
 			return
 
+		self._closeCurrentFile()
 		self._currentFile = StreamingGcodeFileInformation(filename)
 		self._currentFile.start()
 
@@ -352,22 +580,80 @@ class MachineCom(object):
 				return
 			self.sendCommand("M23 %s" % filename)
 		else:
-			self._currentFile = PrintingGcodeFileInformation(filename)
+			self._closeCurrentFile()
+			self._currentFile = None
+			if settings().getBoolean(["feature", "precompileJobs"]):
+				# compiling happens in the background, until it's done the file is sent as is
+				try:
+					compiled = gcodeCompiler.loadCompiledGcode(filename, compileIfStale=False)
+					if compiled is not None:
+						self._currentFile = PrintingCompiledGcodeFileInformation(filename, compiled)
+				except:
+					self._logger.exception("Could not load a compiled version of %s, sending it as is" % filename)
+			if self._currentFile is None:
+				if settings().getBoolean(["feature", "mapJobFiles"]):
+					self._currentFile = PrintingMappedGcodeFileInformation(filename)
+				else:
+					self._currentFile = PrintingGcodeFileInformation(filename)
+			self._startTimeEstimation(lambda: _readLines(filename))
 			eventManager().fire("FileSelected", filename)
 			self._callback.mcFileSelected(filename, self._currentFile.getFilesize(), False)
 
+	def selectGeneratedFile(self, name, lineFactory, commandCount):
+		"""
+		Selects a job that is generated on the fly instead of read from a file, see
+		PrintingGeneratedGcodeFileInformation for the parameters.
+		"""
+		if self.isBusy():
+			return
+
+		self._closeCurrentFile()
+		self._currentFile = PrintingGeneratedGcodeFileInformation(name, lineFactory, commandCount)
+		self._startTimeEstimation(lineFactory)
+		eventManager().fire("FileSelected", name)
+		self._callback.mcFileSelected(name, self._currentFile.getFilesize(), False)
+
 	def unselectFile(self):
 		if self.isBusy():
 			return
 
+		self._closeCurrentFile()
 		self._currentFile = None
+		self._timeEstimate = None
 		eventManager().fire("FileSelected", None)
 		self._callback.mcFileSelected(None, None, False)
 
+	def _startTimeEstimation(self, lineFactory):
+		"""
+		Simulates the selected job in the background to know the remaining time for every command in it, see
+		octoprint.util.sprayEstimator.
+		"""
+		self._timeEstimate = None
+		if not settings().getBoolean(["feature", "sprayTimeEstimation"]):
+			return
+
+		currentFile = self._currentFile
+		def estimate():
+			try:
+				timeEstimate = sprayEstimator.SprayTimeEstimator.fromSettings().estimate(lineFactory())
+			except:
+				self._logger.exception("Could not estimate the time needed for %s" % currentFile.getFilename())
+				return
+
+			# the selection might have changed in the meantime
+			if self._currentFile is currentFile:
+				self._timeEstimate = timeEstimate
+				self._logger.info("Estimated %.0fs and %.1ful for %s" % (timeEstimate.totalTime, timeEstimate.syringeVolume, currentFile.getFilename()))
+
+		thread = threading.Thread(target=estimate)
+		thread.daemon = True
+		thread.start()
+
 	def cancelPrint(self):
 		if not self.isOperational() or self.isStreaming():
 			return
 
+		# leaving the printing state closes the file, see _changeState
 		self._changeState(self.STATE_OPERATIONAL)
 
 		if self.isSdFileSelected():
@@ -385,7 +671,7 @@ class MachineCom(object):
 			if self.isSdFileSelected():
 				self.sendCommand("M24")
 			else:
-				self._sendNext()
+				self._sendNextLines()
 		if pause and self.isPrinting():
 			self._changeState(self.STATE_PAUSED)
 			if self.isSdFileSelected():
@@ -449,6 +735,11 @@ class MachineCom(object):
 		feedbackControls = settings().getFeedbackControls()
 		pauseTriggers = settings().getPauseTriggers()
 
+		# cheap pre-checks so that received lines only get matched against the individual patterns if one of them
+		# is actually going to match
+		feedbackFilter = _combinePatterns([matcher for (name, matcher, template) in feedbackControls])
+		pauseTriggerFilter = _combinePatterns(pauseTriggers.values())
+
 		#Open the serial port.
 		if self._port == 'AUTO':
 			self._changeState(self.STATE_DETECT_SERIAL)
@@ -486,6 +777,7 @@ class MachineCom(object):
 			eventManager().fire("Error", self.getErrorString())
 			return
 		self._log("Connected to: %s, starting monitor" % (self._serial))
+		self._startIoThreads()
 		if self._baudrate == 0:
 			self._changeState(self.STATE_DETECT_BAUDRATE)
 		else:
@@ -496,10 +788,10 @@ class MachineCom(object):
 		tempRequestTimeout = timeout
 		sdStatusRequestTimeout = timeout
 		startSeen = not settings().getBoolean(["feature", "waitForStartOnConnect"])
-		heatingUp = False
+		self._heatingUp = False
 		while True:
 			try:
-				line = self._readline()
+				(line, responseType) = self._readResponse()
 				if line == None:
 					break
 
@@ -510,18 +802,11 @@ class MachineCom(object):
 					# Marlin reports an MIN/MAX temp error as "Error:x\n: Extruder switched off. MAXTEMP triggered !\n"
 					#	But a bed temp error is reported as "Error: Temperature heated bed switched off. MAXTEMP triggered !!"
 					#	So we can have an extra newline in the most common case. Awesome work people.
-					if re.match('Error:[0-9]\n', line):
+					if _errorNumberMatcher.match(line):
 						line = line.rstrip() + self._readline()
+						responseType = classifyResponse(line)
 					#Skip the communication errors, as those get corrected.
-					if 'checksum mismatch' in line \
-							or 'Wrong checksum' in line \
-							or 'Line Number is not Last Line Number' in line \
-							or 'expected line' in line \
-							or 'No Line Number with checksum' in line \
-							or 'No Checksum with line number' in line \
-							or 'Missing checksum' in line:
-						pass
-					elif not self.isError():
+					if _communicationErrorMatcher.search(line) is None and not self.isError():
 						self._errorValue = line[6:]
 						self._changeState(self.STATE_ERROR)
 						eventManager().fire("Error", self.getErrorString())
@@ -532,76 +817,20 @@ class MachineCom(object):
 					self._sdFiles.append(line.strip().lower())
 					continue
 
-				##~~ Temperature processing
-				if ' T:' in line or line.startswith('T:'):
-					try:
-						self._temp = float(re.search("-?[0-9\.]*", line.split('T:')[1]).group(0))
-						if ' B:' in line:
-							self._bedTemp = float(re.search("-?[0-9\.]*", line.split(' B:')[1]).group(0))
-
-						self._callback.mcTempUpdate(self._temp, self._bedTemp, self._targetTemp, self._bedTargetTemp)
-					except ValueError:
-						# catch conversion issues, we'll rather just not get the temperature update instead of killing the connection
-						pass
-
-					#If we are waiting for an M109 or M190 then measure the time we lost during heatup, so we can remove that time from our printing time estimate.
-					if not 'ok' in line:
-						heatingUp = True
-						if self._heatupWaitStartTime != 0:
-							t = time.time()
-							self._heatupWaitTimeLost = t - self._heatupWaitStartTime
-							self._heatupWaitStartTime = t
-
-				##~~ SD Card handling
-				elif 'SD init fail' in line:
-					self._sdAvailable = False
-					self._sdFiles = []
-					self._callback.mcSdStateChange(self._sdAvailable)
-				elif 'Not SD printing' in line:
-					if self.isSdFileSelected() and self.isPrinting():
-						# something went wrong, printer is reporting that we actually are not printing right now...
-						self._sdFilePos = 0
-						self._changeState(self.STATE_OPERATIONAL)
-				elif 'SD card ok' in line:
-					self._sdAvailable = True
-					self.refreshSdFiles()
-					self._callback.mcSdStateChange(self._sdAvailable)
-				elif 'Begin file list' in line:
-					self._sdFiles = []
-					self._sdFileList = True
-				elif 'End file list' in line:
-					self._sdFileList = False
-					self._callback.mcSdFiles(self._sdFiles)
-				elif 'SD printing byte' in line:
-					# answer to M27, at least on Marlin, Repetier and Sprinter: "SD printing byte %d/%d"
-					match = re.search("([0-9]*)/([0-9]*)", line)
-					self._currentFile.setFilepos(int(match.group(1)))
-					self._callback.mcProgress()
-				elif 'File opened' in line:
-					# answer to M23, at least on Marlin, Repetier and Sprinter: "File opened:%s Size:%d"
-					match = re.search("File opened:\s*(.*?)\s+Size:\s*([0-9]*)", line)
-					self._currentFile = PrintingSdFileInformation(match.group(1), int(match.group(2)))
-				elif 'File selected' in line:
-					# final answer to M23, at least on Marlin, Repetier and Sprinter: "File selected"
-					self._callback.mcFileSelected(self._currentFile.getFilename(), self._currentFile.getFilesize(), True)
-					eventManager().fire("FileSelected", self._currentFile.getFilename())
-				elif 'Writing to file' in line:
-					# anwer to M28, at least on Marlin, Repetier and Sprinter: "Writing to file: %s"
-					self._printSection = "CUSTOM"
-					self._changeState(self.STATE_PRINTING)
-				elif 'Done spraying file' in line:
-					# printer is reporting file finished printing
-					self._sdFilePos = 0
-					self._callback.mcPrintjobDone()
-					self._changeState(self.STATE_OPERATIONAL)
-					eventManager().fire("PrintDone")
+				##~~ Response handling
+				if responseType == RESPONSE_OK:
+					pass
+				elif responseType is not None:
+					self._responseHandlers[responseType](line)
 
 				##~~ Message handling
-				elif line.strip() != '' and line.strip() != 'ok' and not line.startswith("wait") and not line.startswith('Resend:') and line != 'echo:Unknown command:""\n' and self.isOperational():
-					self._callback.mcMessage(line)
+				else:
+					strippedLine = line.strip()
+					if strippedLine != '' and strippedLine != 'ok' and not line.startswith("wait") and not line.startswith('Resend:') and line != 'echo:Unknown command:""\n' and self.isOperational():
+						self._callback.mcMessage(line)
 
 				##~~ Parsing for feedback commands
-				if feedbackControls:
+				if feedbackControls and (feedbackFilter is None or feedbackFilter.matches(line)):
 					for name, matcher, template in feedbackControls:
 						try:
 							match = matcher.search(line)
@@ -612,7 +841,7 @@ class MachineCom(object):
 							pass
 
 				##~~ Parsing for pause triggers
-				if pauseTriggers:
+				if pauseTriggers and (pauseTriggerFilter is None or pauseTriggerFilter.matches(line)):
 					if "enable" in pauseTriggers.keys() and pauseTriggers["enable"].search(line) is not None:
 						self.setPause(True)
 					elif "disable" in pauseTriggers.keys() and pauseTriggers["disable"].search(line) is not None:
@@ -620,8 +849,12 @@ class MachineCom(object):
 					elif "toggle" in pauseTriggers.keys() and pauseTriggers["toggle"].search(line) is not None:
 						self.setPause(not self.isPaused())
 
-				if "ok" in line and heatingUp:
-					heatingUp = False
+				if "ok" in line and self._heatingUp:
+					self._heatingUp = False
+
+				if self._sendWindow is not None and line.startswith("ok"):
+					# one line less in flight, no matter in which state the acknowledgement arrives
+					self._sendWindow.acknowledge()
 
 				### Baudrate detection
 				if self._state == self.STATE_DETECT_BAUDRATE:
@@ -633,7 +866,7 @@ class MachineCom(object):
 							eventManager().fire("Error", self.getErrorString())
 						elif self._baudrateDetectRetry > 0:
 							self._baudrateDetectRetry -= 1
-							self._serial.write('\n')
+							self._doSendWithoutChecksum("", self.SEND_PRIORITY_HIGH)
 							self._log("Baudrate test retry: %d" % (self._baudrateDetectRetry))
 							self._sendCommand("M105")
 							self._testingBaudrate = True
@@ -646,7 +879,7 @@ class MachineCom(object):
 								self._baudrateDetectRetry = 5
 								self._baudrateDetectTestOk = 0
 								timeout = getNewTimeout("communication")
-								self._serial.write('\n')
+								self._doSendWithoutChecksum("", self.SEND_PRIORITY_HIGH)
 								self._sendCommand("M105")
 								self._testingBaudrate = True
 							except:
@@ -700,13 +933,16 @@ class MachineCom(object):
 					if line == "" and time.time() > timeout:
 						self._log("Communication timeout during spraying, forcing a line")
 						line = 'ok'
+						if self._sendWindow is not None:
+							# the printer obviously isn't working on anything, so nothing can be in flight anymore
+							self._sendWindow.reset()
 
 					if self.isSdPrinting():
-						if time.time() > tempRequestTimeout and not heatingUp:
+						if time.time() > tempRequestTimeout and not self._heatingUp:
 							self._sendCommand("M105")
 							tempRequestTimeout = getNewTimeout("communication")
 
-						if time.time() > sdStatusRequestTimeout and not heatingUp:
+						if time.time() > sdStatusRequestTimeout and not self._heatingUp:
 							self._sendCommand("M27")
 							sdStatusRequestTimeout = time.time() + 1
 
@@ -720,7 +956,9 @@ class MachineCom(object):
 
 						if 'ok' in line:
 							timeout = getNewTimeout("communication")
-							if self._resendDelta is not None:
+							if self._sendWindow is not None:
+								self._fillSendWindow()
+							elif self._resendDelta is not None:
 								self._resendNextCommand()
 							elif not self._commandQueue.empty() and not self.isStreaming():
 								self._sendCommand(self._commandQueue.get())
@@ -738,45 +976,219 @@ class MachineCom(object):
 				eventManager().fire("Error", self.getErrorString())
 		self._log("Connection closed, closing down monitor")
 
-	def _readline(self):
-		if self._serial == None:
-			return None
+	##~~ response handlers
+
+	def _onTemperatureResponse(self, line):
 		try:
-			ret = self._serial.readline()
-		except:
-			self._log("Unexpected error while reading serial port: %s" % (getExceptionString()))
-			self._errorValue = getExceptionString()
-			self.close(True)
-			return None
-		if ret == '':
-			#self._log("Recv: TIMEOUT")
-			return ''
-		self._log("Recv: %s" % (unicode(ret, 'ascii', 'replace').encode('ascii', 'replace').rstrip()))
-		return ret
+			(temp, bedTemp) = parseTemperatureResponse(line)
+			self._temp = temp
+			if bedTemp is not None:
+				self._bedTemp = bedTemp
+
+			self._callback.mcTempUpdate(self._temp, self._bedTemp, self._targetTemp, self._bedTargetTemp)
+		except ValueError:
+			# catch conversion issues, we'll rather just not get the temperature update instead of killing the connection
+			pass
+
+		#If we are waiting for an M109 or M190 then measure the time we lost during heatup, so we can remove that time from our printing time estimate.
+		if not 'ok' in line:
+			self._heatingUp = True
+			if self._heatupWaitStartTime != 0:
+				t = time.time()
+				self._heatupWaitTimeLost = t - self._heatupWaitStartTime
+				self._heatupWaitStartTime = t
+
+	def _onSdInitFailResponse(self, line):
+		self._sdAvailable = False
+		self._sdFiles = []
+		self._callback.mcSdStateChange(self._sdAvailable)
+
+	def _onNotSdPrintingResponse(self, line):
+		if self.isSdFileSelected() and self.isPrinting():
+			# something went wrong, printer is reporting that we actually are not printing right now...
+			self._sdFilePos = 0
+			self._changeState(self.STATE_OPERATIONAL)
+
+	def _onSdCardOkResponse(self, line):
+		self._sdAvailable = True
+		self.refreshSdFiles()
+		self._callback.mcSdStateChange(self._sdAvailable)
+
+	def _onBeginFileListResponse(self, line):
+		self._sdFiles = []
+		self._sdFileList = True
+
+	def _onEndFileListResponse(self, line):
+		self._sdFileList = False
+		self._callback.mcSdFiles(self._sdFiles)
+
+	def _onSdPrintingByteResponse(self, line):
+		# answer to M27, at least on Marlin, Repetier and Sprinter: "SD printing byte %d/%d"
+		match = _sdPrintingByteMatcher.search(line)
+		self._currentFile.setFilepos(int(match.group(1)))
+		self._callback.mcProgress()
+
+	def _onFileOpenedResponse(self, line):
+		# answer to M23, at least on Marlin, Repetier and Sprinter: "File opened:%s Size:%d"
+		match = _fileOpenedMatcher.search(line)
+		self._closeCurrentFile()
+		self._currentFile = PrintingSdFileInformation(match.group(1), int(match.group(2)))
+
+	def _onFileSelectedResponse(self, line):
+		# final answer to M23, at least on Marlin, Repetier and Sprinter: "File selected"
+		self._callback.mcFileSelected(self._currentFile.getFilename(), self._currentFile.getFilesize(), True)
+		eventManager().fire("FileSelected", self._currentFile.getFilename())
+
+	def _onWritingToFileResponse(self, line):
+		# anwer to M28, at least on Marlin, Repetier and Sprinter: "Writing to file: %s"
+		self._printSection = "CUSTOM"
+		self._changeState(self.STATE_PRINTING)
+
+	def _onDoneSprayingFileResponse(self, line):
+		# printer is reporting file finished printing
+		self._sdFilePos = 0
+		self._callback.mcPrintjobDone()
+		self._changeState(self.STATE_OPERATIONAL)
+		eventManager().fire("PrintDone")
+
+	##~~ serial I/O
+
+	def _startIoThreads(self):
+		self._readerThread = threading.Thread(target=self._readLoop)
+		self._readerThread.daemon = True
+		self._readerThread.start()
+
+		self._writerThread = threading.Thread(target=self._writeLoop)
+		self._writerThread.daemon = True
+		self._writerThread.start()
+
+	def _readResponse(self):
+		"""
+		Returns the next line received from the printer and its type (see classifyResponse), ("", None) if the serial
+		read timed out and (None, None) if the connection was closed.
+		"""
+		response = self._responseQueue.get()
+		if response is None:
+			return (None, None)
+		return response
+
+	def _readline(self):
+		return self._readResponse()[0]
+
+	def _readLoop(self):
+		while True:
+			serialConnection = self._serial
+			if serialConnection is None:
+				self._responseQueue.put(None)
+				return
+
+			try:
+				ret = serialConnection.readline()
+			except:
+				self._log("Unexpected error while reading serial port: %s" % (getExceptionString()))
+				self._errorValue = getExceptionString()
+				self.close(True)
+				self._responseQueue.put(None)
+				return
+
+			# formatting every line is expensive, only do it if somebody's interested
+			if ret != '' and self._isLoggingSerial():
+				self._logSerial("Recv: %s" % (unicode(ret, 'ascii', 'replace').encode('ascii', 'replace').rstrip()))
+
+			# classified right here, so the monitor only has to act on the responses
+			self._responseQueue.put((ret, classifyResponse(ret)))
+
+	def _writeLoop(self):
+		while True:
+			(priority, sequence, cmd) = self._sendQueue.get()
+			if cmd is None:
+				return
+			self._doWrite(cmd)
+
+	def _sendNextLines(self):
+		if self._sendWindow is not None:
+			self._fillSendWindow()
+		else:
+			self._sendNext()
 
 	def _sendNext(self):
 		with self._sendNextLock:
 			line = self._currentFile.getNext()
 			if line is None:
-				if self.isStreaming():
-					self._sendCommand("M29")
-					filename = self._currentFile.getFilename()
-					self._currentFile = None
-					self._callback.mcFileTransferDone()
-					self._changeState(self.STATE_OPERATIONAL)
-					eventManager().fire("TransferDone", filename)
-				else:
-					self._callback.mcPrintjobDone()
-					self._changeState(self.STATE_OPERATIONAL)
-					eventManager().fire("PrintDone", self._currentFile.getFilename())
+				self._finishFileJob()
 				return
 
-			if type(line) is tuple:
-				self._printSection = line[1]
-				line = line[0]
+			self._sendFileLine(line)
+
+	def _fillSendWindow(self):
+		"""
+		Sends lines until the send window is full. Pending resends take precedence over queued commands, which in
+		turn take precedence over the next lines of the current file. A line that doesn't fit into the window anymore
+		is held back until enough lines have been acknowledged by the printer.
+		"""
+		with self._sendNextLock:
+			while self.isPrinting() and not self.isSdFileSelected():
+				if self._resendDelta is not None:
+					cmd = self._lastLines[-self._resendDelta]
+					length = self._getFramedLength(cmd, self._currentLine - self._resendDelta)
+					if not self._sendWindow.fits(length):
+						break
+					self._sendWindow.push(length)
+					self._resendNextCommand()
+					continue
+
+				if self._heldLine is None:
+					if not self._commandQueue.empty() and not self.isStreaming():
+						self._heldLine = (False, self._commandQueue.get())
+					else:
+						self._heldLine = (True, self._currentFile.getNext())
+
+				(fromFile, line) = self._heldLine
+				if line is None:
+					# end of file, but we may only finish the job once the printer acknowledged everything
+					if len(self._sendWindow) == 0:
+						self._heldLine = None
+						self._finishFileJob()
+					break
+
+				cmd = line
+				if type(line) is tuple:
+					cmd = line[0]
+				length = self._getFramedLength(cmd, self._currentLine)
+				if not self._sendWindow.fits(length):
+					break
+
+				self._heldLine = None
+				self._sendWindow.push(length)
+				if fromFile:
+					self._sendFileLine(line)
+				else:
+					self._sendCommand(line)
+
+	def _sendFileLine(self, line):
+		if type(line) is tuple:
+			self._printSection = line[1]
+			line = line[0]
+
+		self._sendCommand(line, True)
+		self._callback.mcProgress()
+
+	def _finishFileJob(self):
+		if self.isStreaming():
+			self._sendCommand("M29")
+			filename = self._currentFile.getFilename()
+			self._currentFile = None
+			self._callback.mcFileTransferDone()
+			self._changeState(self.STATE_OPERATIONAL)
+			eventManager().fire("TransferDone", filename)
+		else:
+			self._callback.mcPrintjobDone()
+			self._changeState(self.STATE_OPERATIONAL)
+			eventManager().fire("PrintDone", self._currentFile.getFilename())
 
-			self._sendCommand(line, True)
-			self._callback.mcProgress()
+	def _getFramedLength(self, cmd, lineNumber):
+		# "N<lineNumber> <cmd>*<checksum>\n", with the checksum taking up to three digits
+		return len(cmd) + len(str(lineNumber)) + 7
 
 	def _handleResendRequest(self, line):
 		lineToResend = None
@@ -787,6 +1199,20 @@ class MachineCom(object):
 				lineToResend = int(line.split()[1])
 
 		if lineToResend is not None:
+			if self._sendWindow is not None:
+				inFlight = len(self._sendWindow)
+				if not self._okAfterResend:
+					# no "ok" is coming for the rejected line, the resend request acknowledges it instead
+					self._sendWindow.acknowledge()
+
+				if lineToResend == self._lastResendNumber and self._resendSwallowRepetitions > 0:
+					# every line that was still in flight behind the broken one triggers the same resend request
+					# again, we already take care of those
+					self._resendSwallowRepetitions -= 1
+					return
+				self._lastResendNumber = lineToResend
+				self._resendSwallowRepetitions = max(0, min(inFlight, self._currentLine - lineToResend) - 1)
+
 			self._resendDelta = self._currentLine - lineToResend
 			if self._resendDelta > len(self._lastLines) or len(self._lastLines) == 0:
 				self._errorValue = "Sprayer requested line %d but no sufficient history is available, can't resend" % lineToResend
@@ -798,6 +1224,8 @@ class MachineCom(object):
 				else:
 					# reset resend delta, we can't do anything about it
 					self._resendDelta = None
+			elif self._sendWindow is not None and self.isPrinting():
+				self._fillSendWindow()
 			else:
 				self._resendNextCommand()
 
@@ -847,13 +1275,26 @@ class MachineCom(object):
 	def _doSendWithChecksum(self, cmd, lineNumber):
 		self._logger.debug("Sending cmd '%s' with lineNumber %r" % (cmd, lineNumber))
 
-		commandToSend = "N%d %s" % (lineNumber, cmd)
-		checksum = reduce(lambda x,y:x^y, map(ord, commandToSend))
-		commandToSend = "%s*%d" % (commandToSend, checksum)
+		# the current file might already have the line framed with exactly this line number
+		commandToSend = None
+		if self._currentFile is not None:
+			commandToSend = self._currentFile.getFramedLine(cmd, lineNumber)
+
+		if commandToSend is None:
+			commandToSend = "N%d %s" % (lineNumber, cmd)
+			checksum = reduce(lambda x,y:x^y, map(ord, commandToSend))
+			commandToSend = "%s*%d" % (commandToSend, checksum)
 		self._doSendWithoutChecksum(commandToSend)
 
-	def _doSendWithoutChecksum(self, cmd):
-		self._log("Send: %s" % cmd)
+	def _doSendWithoutChecksum(self, cmd, priority=SEND_PRIORITY_NORMAL):
+		self._sendQueue.put((priority, next(self._sendSequence), cmd))
+
+	def _doWrite(self, cmd):
+		if self._serial is None:
+			return
+
+		if self._isLoggingSerial():
+			self._logSerial("Send: %s" % cmd)
 		try:
 			self._serial.write(cmd + '\n')
 		except serial.SerialTimeoutException:
@@ -972,6 +1413,50 @@ class MachineComPrintCallback(object):
 	def mcReceivedRegisteredMessage(self, command, message):
 		pass
 
+### Send window ######################################################################################################
+
+class SendWindow(object):
+	"""
+	Keeps track of the lines sent to the printer which have not yet been acknowledged with an "ok". Limits both the
+	number of lines in flight and their total size in bytes, the latter to not overflow the receive buffer of the
+	firmware.
+	"""
+
+	def __init__(self, maxLines, maxBytes):
+		self._maxLines = maxLines
+		self._maxBytes = maxBytes
+		self._lines = deque()
+		self._bytes = 0
+		self._mutex = threading.Lock()
+
+	def __len__(self):
+		return len(self._lines)
+
+	def fits(self, length):
+		"""
+		Returns whether a line of the given length may be sent right now. A line is always allowed if nothing is
+		in flight, so that lines longer than the buffer don't block forever.
+		"""
+		with self._mutex:
+			if len(self._lines) == 0:
+				return True
+			return len(self._lines) < self._maxLines and self._bytes + length <= self._maxBytes
+
+	def push(self, length):
+		with self._mutex:
+			self._lines.append(length)
+			self._bytes += length
+
+	def acknowledge(self):
+		with self._mutex:
+			if len(self._lines) > 0:
+				self._bytes -= self._lines.popleft()
+
+	def reset(self):
+		with self._mutex:
+			self._lines.clear()
+			self._bytes = 0
+
 ### Printing file information classes ##################################################################################
 
 class PrintingFileInformation(object):
@@ -1015,6 +1500,26 @@ class PrintingFileInformation(object):
 		"""
 		self._filepos = 0
 
+	def close(self):
+		"""
+		Releases file handles and the like held for the print. start opens them again.
+		"""
+		pass
+
+	def getFramedLine(self, cmd, lineNumber):
+		"""
+		Returns the given command already framed with the given line number and checksum if available, None
+		otherwise.
+		"""
+		return None
+
+	def getCommandIndex(self):
+		"""
+		Returns the number of commands (not counting comments and empty lines) retrieved from the file so far, or None
+		if that's unknown.
+		"""
+		return None
+
 	def start(self):
 		"""
 		Marks the print job as started and remembers the start time.
@@ -1036,80 +1541,256 @@ class PrintingSdFileInformation(PrintingFileInformation):
 		"""
 		self._filepos = filepos
 
-class PrintingGcodeFileInformation(PrintingFileInformation):
+class PrintingCommandsFileInformation(PrintingFileInformation):
 	"""
-	Encapsulates information regarding an ongoing direct print. Takes care of the needed file handle and ensures
-	that the file is closed in case of an error.
+	Base of the file informations whose commands are sent line by line by the host. Takes care of the initial line
+	number reset, stripping comments and empty lines, reporting the section (;TYPE: marker) a command belongs to when
+	it changes and counting the commands sent. Subclasses provide the raw lines via _readLine.
 	"""
 
 	def __init__(self, filename):
 		PrintingFileInformation.__init__(self, filename)
-		self._filehandle = None
 		self._lineCount = None
-		self._firstLine = None
-		self._prevLineType = None
-
-		if not os.path.exists(self._filename) or not os.path.isfile(self._filename):
-			raise IOError("File %s does not exist" % self._filename)
-		self._filesize = os.stat(self._filename).st_size
+		self._lineType = None
+		self._reportedLineType = None
 
 	def start(self):
 		"""
-		Opens the file for reading and determines the file size. Start time won't be recorded until 100 lines in
+		Rewinds to the first command. Start time won't be recorded until 100 lines in
 		"""
-		self._filehandle = open(self._filename, "r")
 		self._lineCount = None
-		self._prevLineType = "CUSTOM"
+		self._lineType = self._reportedLineType = "CUSTOM"
+
+	def reset(self):
+		PrintingFileInformation.reset(self)
+		self._lineCount = None
+
+	def getCommandIndex(self):
+		if self._lineCount is None:
+			return 0
+		return self._lineCount
 
 	def getNext(self):
 		"""
 		Retrieves the next line for printing.
 		"""
-		if self._filehandle is None:
-			raise ValueError("File %s is not open for reading" % self._filename)
-
 		if self._lineCount is None:
 			self._lineCount = 0
 			return "M110 N0"
 
-		try:
-			processedLine = None
-			while processedLine is None:
-				if self._filehandle is None:
-					# file got closed just now
-					return None
-				line = self._filehandle.readline()
-				if not line:
-					self._filehandle.close()
-					self._filehandle = None
-				processedLine = self._processLine(line)
-			self._lineCount += 1
-			self._filepos = self._filehandle.tell()
-
-			if self._lineCount >= 100 and self._startTime is None:
-				self._startTime = time.time()
-
-			return processedLine
-		except Exception as (e):
-			if self._filehandle is not None:
-				self._filehandle.close()
-				self._filehandle = None
-			raise e
+		processedLine = None
+		while processedLine is None:
+			line = self._readLine()
+			if line is None:
+				return None
+			processedLine = self._processLine(line)
+
+		self._lineCount += 1
+		if self._lineCount >= 100 and self._startTime is None:
+			self._startTime = time.time()
+
+		return processedLine
+
+	def _readLine(self):
+		"""
+		Returns the next raw line and advances the file position past it, None once there are no more lines.
+		"""
+		raise NotImplementedError()
 
 	def _processLine(self, line):
-		lineType = self._prevLineType
 		if line.startswith(";TYPE:"):
-			lineType = line[6:].strip()
+			self._lineType = line[6:].strip()
 		if ";" in line:
 			line = line[0:line.find(";")]
 		line = line.strip()
-		if len(line) > 0:
-			if self._prevLineType != lineType:
-				return line, lineType
-			else:
-				return line
+		if len(line) == 0:
+			return None
+		if self._reportedLineType != self._lineType:
+			self._reportedLineType = self._lineType
+			return line, self._lineType
+		return line
+
+class PrintingGcodeFileInformation(PrintingCommandsFileInformation):
+	"""
+	Encapsulates information regarding an ongoing direct print. Takes care of the needed file handle and ensures
+	that the file is closed in case of an error.
+	"""
+
+	def __init__(self, filename):
+		PrintingCommandsFileInformation.__init__(self, filename)
+		self._filehandle = None
+
+		if not os.path.exists(self._filename) or not os.path.isfile(self._filename):
+			raise IOError("File %s does not exist" % self._filename)
+		self._filesize = os.stat(self._filename).st_size
+
+	def start(self):
+		"""
+		Opens the file for reading and determines the file size. Start time won't be recorded until 100 lines in
+		"""
+		PrintingCommandsFileInformation.start(self)
+		self._filehandle = open(self._filename, "r")
+
+	def getNext(self):
+		if self._filehandle is None and self._lineCount is None:
+			raise ValueError("File %s is not open for reading" % self._filename)
+
+		try:
+			return PrintingCommandsFileInformation.getNext(self)
+		except Exception as (e):
+			self.close()
+			raise e
+
+	def close(self):
+		if self._filehandle is not None:
+			self._filehandle.close()
+			self._filehandle = None
+
+	def _readLine(self):
+		if self._filehandle is None:
+			# file got closed just now
+			return None
+		line = self._filehandle.readline()
+		if not line:
+			self.close()
+			return None
+		self._filepos = self._filehandle.tell()
+		return line
+
+class PrintingMappedGcodeFileInformation(PrintingCommandsFileInformation):
+	"""
+	Encapsulates information regarding an ongoing direct print of a file that is memory mapped instead of read line by
+	line. The positions of all line endings are indexed once when the print starts, after that every line is a simple
+	slice of the mapped file.
+	"""
+
+	def __init__(self, filename):
+		PrintingCommandsFileInformation.__init__(self, filename)
+		self._filehandle = None
+		self._map = None
+		self._lineEnds = None
+		self._nextLine = 0
+
+		if not os.path.exists(self._filename) or not os.path.isfile(self._filename):
+			raise IOError("File %s does not exist" % self._filename)
+		self._filesize = os.stat(self._filename).st_size
+
+	def start(self):
+		"""
+		Maps the file into memory and indexes its lines. Start time won't be recorded until 100 lines in
+		"""
+		self.close()
+		PrintingCommandsFileInformation.start(self)
+
+		self._filehandle = open(self._filename, "rb")
+		self._filesize = os.fstat(self._filehandle.fileno()).st_size
+		if self._filesize > 0:
+			self._map = mmap.mmap(self._filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+			lineEnds = numpy.flatnonzero(numpy.frombuffer(self._map, dtype=numpy.uint8) == ord("\n")) + 1
+			if len(lineEnds) == 0 or lineEnds[-1] != self._filesize:
+				# last line is not terminated by a newline
+				lineEnds = numpy.append(lineEnds, self._filesize)
 		else:
+			# empty files can't be mapped
+			self._map = ""
+			lineEnds = numpy.zeros(0, dtype=numpy.int64)
+		self._lineEnds = lineEnds
+
+		self._nextLine = 0
+		self._filepos = 0
+
+	def close(self):
+		if self._map is not None and not isinstance(self._map, str):
+			self._map.close()
+		self._map = None
+		if self._filehandle is not None:
+			self._filehandle.close()
+			self._filehandle = None
+
+	def _readLine(self):
+		if self._map is None:
 			return None
+		if self._nextLine >= len(self._lineEnds):
+			self.close()
+			return None
+
+		end = int(self._lineEnds[self._nextLine])
+		line = self._map[self._filepos:end]
+		self._nextLine += 1
+		self._filepos = end
+		return line
+
+class PrintingGeneratedGcodeFileInformation(PrintingCommandsFileInformation):
+	"""
+	Encapsulates information regarding an ongoing print of a job that is generated while printing instead of read
+	from a file. The lines are pulled one by one from the iterable returned by lineFactory, which gets called anew
+	every time the job is started. As the size of such a job isn't known in bytes, progress is calculated from the
+	number of commands sent relative to the given total commandCount, the file position is the number of bytes
+	generated so far.
+	"""
+
+	def __init__(self, name, lineFactory, commandCount):
+		PrintingCommandsFileInformation.__init__(self, name)
+		self._lineFactory = lineFactory
+		self._lines = None
+		self._commandCount = commandCount
+
+	def start(self):
+		"""
+		(Re)starts generating the job. Start time won't be recorded until 100 lines in
+		"""
+		PrintingCommandsFileInformation.start(self)
+		self._lines = iter(self._lineFactory())
+		self._filepos = 0
+
+	def getProgress(self):
+		if not self._commandCount > 0:
+			return -1
+		if self._lineCount is None:
+			return 0.0
+		return min(1.0, float(self._lineCount) / float(self._commandCount))
+
+	def _readLine(self):
+		if self._lines is None:
+			return None
+		line = next(self._lines, None)
+		if line is None:
+			self._lines = None
+			return None
+		self._filepos += len(line)
+		return line
+
+class PrintingCompiledGcodeFileInformation(PrintingCommandsFileInformation):
+	"""
+	Encapsulates information regarding an ongoing direct print of a file compiled by
+	octoprint.util.gcodeCompiler. All lines are already stripped and framed, so sending them boils down to slicing
+	them out of memory.
+	"""
+
+	def __init__(self, filename, compiled):
+		PrintingCommandsFileInformation.__init__(self, filename)
+		self._compiled = compiled
+		self._filesize = compiled.sourceSize
+
+	def getFramedLine(self, cmd, lineNumber):
+		index = lineNumber - 1
+		if index < 0 or index >= len(self._compiled) or self._compiled.getCommand(index) != cmd:
+			return None
+		return self._compiled.getFramedLine(index)
+
+	def _readLine(self):
+		index = self._lineCount
+		if index >= len(self._compiled):
+			return None
+		self._filepos = self._compiled.getFilepos(index)
+		return self._compiled.getCommand(index)
+
+	def _processLine(self, line):
+		# compiled lines are already stripped, only the section changes recorded by the compiler are attached
+		section = self._compiled.getSection(self._lineCount)
+		if section is not None:
+			return line, section
+		return line
 
 class StreamingGcodeFileInformation(PrintingGcodeFileInformation):
 	pass
@@ -0,0 +1,265 @@
+# coding=utf-8
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+import os
+import struct
+import zipfile
+import hashlib
+import numpy
+import numpy.lib.format
+
+from octoprint.settings import settings
+
+COMPILED_EXTENSION = ".job"
+COMPILED_VERSION = 1
+
+# number of commands compileGcode processes at once
+COMPILE_BATCH = 10000
+
+class CompiledGcode(object):
+	"""
+	A gcode file preprocessed for sending: comments and empty lines are stripped, section markers ("; TYPE:...") and
+	the position in the source file are remembered for every remaining command and every command is already framed
+	with line number and checksum for the line number it will get when the file is sent right after an "M110 N0".
+
+	Commands are addressed by their index, which is the line number they'll be sent with minus one. The framed lines
+	and the offsets are memory mapped numpy arrays, so only the parts actually sent are paged in.
+	"""
+
+	def __init__(self, data, framedOffsets, commandStarts, commandEnds, fileposList, sectionIndices, sectionNames, sourceSize, sourceMtime):
+		# slicing a buffer yields strings right away, without a numpy array in between
+		self._data = buffer(data)
+		self._framedOffsets = framedOffsets
+		self._commandStarts = commandStarts
+		self._commandEnds = commandEnds
+		self._fileposList = fileposList
+		self._sections = dict(zip(sectionIndices, sectionNames))
+		self.sourceSize = sourceSize
+		self.sourceMtime = sourceMtime
+
+	def __len__(self):
+		return len(self._commandStarts)
+
+	def getCommand(self, index):
+		return self._data[self._commandStarts[index]:self._commandEnds[index]]
+
+	def getFramedLine(self, index):
+		"""
+		Returns the command at the given index including line number and checksum, without trailing newline.
+		"""
+		return self._data[self._framedOffsets[index]:self._framedOffsets[index + 1] - 1]
+
+	def getFilepos(self, index):
+		"""
+		Returns the position in the source file right after the command at the given index.
+		"""
+		return int(self._fileposList[index])
+
+	def getSection(self, index):
+		"""
+		Returns the section starting with the command at the given index or None if the section doesn't change there.
+		"""
+		return self._sections.get(index, None)
+
+def getCompiledPath(path):
+	"""
+	Returns the path of the compiled counterpart of the file at the given path. Compiled files live in their own
+	folder, their names are made unique per source folder by a hash of its path.
+	"""
+	path = os.path.abspath(path)
+	folderHash = hashlib.sha1(os.path.dirname(path)).hexdigest()[:8]
+	filename = "%s-%s%s" % (os.path.basename(path), folderHash, COMPILED_EXTENSION)
+	return os.path.join(settings().getBaseFolder("compiledJobs"), filename)
+
+def isCompiled(path):
+	"""
+	Returns whether the file at the given path has a compiled counterpart that is up to date.
+	"""
+	compiledPath = getCompiledPath(path)
+	if not os.path.isfile(path) or not os.path.isfile(compiledPath):
+		return False
+
+	try:
+		statResult = os.stat(path)
+		with open(compiledPath, "rb") as f:
+			archive = numpy.load(f)
+			return int(archive["version"]) == COMPILED_VERSION \
+				and int(archive["sourceSize"]) == statResult.st_size \
+				and float(archive["sourceMtime"]) == statResult.st_mtime
+	except:
+		return False
+
+def removeCompiled(path):
+	compiledPath = getCompiledPath(path)
+	if os.path.isfile(compiledPath):
+		os.remove(compiledPath)
+
+def compileGcode(path):
+	"""
+	Preprocesses the gcode file at the given path and stores the result in the compiled jobs folder, as an
+	uncompressed npz archive so loadCompiledGcode can map it. The file is processed COMPILE_BATCH commands at a time
+	and the framed lines go to a temporary file right away, so apart from a few numbers per command nothing of the
+	file is held in memory.
+	"""
+	statResult = os.stat(path)
+
+	compiledPath = getCompiledPath(path)
+	temporaryPath = compiledPath + ".tmp"
+	dataPath = compiledPath + ".data.tmp"
+
+	batches = {"framedLengths": [], "prefixLengths": [], "commandLengths": [], "filepos": []}
+	sectionIndices = []
+	sectionNames = []
+
+	def writeBatch(commands, fileposList, firstIndex, dataFile):
+		# line numbers start at 1, right after the "M110 N0" that precedes every job
+		unframed = ["N%d %s" % (firstIndex + index + 1, command) for (index, command) in enumerate(commands)]
+		framed = ["%s*%d\n" % (line, checksum) for (line, checksum) in zip(unframed, _checksums(unframed))]
+		dataFile.write("".join(framed))
+
+		batches["framedLengths"].append(numpy.fromiter(map(len, framed), dtype=numpy.int64, count=len(framed)))
+		batches["prefixLengths"].append(numpy.fromiter((len(line) - len(command) for (line, command) in zip(unframed, commands)), dtype=numpy.int64, count=len(commands)))
+		batches["commandLengths"].append(numpy.fromiter(map(len, commands), dtype=numpy.int64, count=len(commands)))
+		batches["filepos"].append(numpy.array(fileposList, dtype=numpy.int64))
+
+	commandCount = 0
+	commands = []
+	fileposList = []
+
+	prevLineType = lineType = "CUSTOM"
+	filepos = 0
+	with open(path, "r") as f, open(dataPath, "wb") as dataFile:
+		for line in f:
+			filepos += len(line)
+			if line.startswith(";TYPE:"):
+				lineType = line[6:].strip()
+			if ";" in line:
+				line = line[0:line.find(";")]
+			line = line.strip()
+			if len(line) == 0:
+				continue
+
+			if prevLineType != lineType:
+				sectionIndices.append(commandCount + len(commands))
+				sectionNames.append(lineType)
+				prevLineType = lineType
+			commands.append(line)
+			fileposList.append(filepos)
+
+			if len(commands) >= COMPILE_BATCH:
+				writeBatch(commands, fileposList, commandCount, dataFile)
+				commandCount += len(commands)
+				commands = []
+				fileposList = []
+
+		if len(commands) > 0:
+			writeBatch(commands, fileposList, commandCount, dataFile)
+			commandCount += len(commands)
+
+	def concatenate(name):
+		if len(batches[name]) == 0:
+			return numpy.zeros(0, dtype=numpy.int64)
+		return numpy.concatenate(batches[name])
+
+	framedLengths = concatenate("framedLengths")
+	framedOffsets = numpy.zeros(commandCount + 1, dtype=numpy.int64)
+	numpy.cumsum(framedLengths, out=framedOffsets[1:])
+	commandStarts = framedOffsets[:-1] + concatenate("prefixLengths")
+
+	try:
+		# the framed lines are copied over from the temporary file in chunks by numpy
+		data = numpy.memmap(dataPath, dtype=numpy.uint8, mode="r") if framedOffsets[-1] > 0 else numpy.zeros(0, dtype=numpy.uint8)
+		with open(temporaryPath, "wb") as f:
+			# savez stores the members uncompressed, which _mapArchive relies on
+			numpy.savez(f,
+				version=numpy.array(COMPILED_VERSION),
+				data=data,
+				framedOffsets=framedOffsets,
+				commandStarts=commandStarts,
+				commandEnds=commandStarts + concatenate("commandLengths"),
+				filepos=concatenate("filepos"),
+				sectionIndices=numpy.array(sectionIndices, dtype=numpy.int64),
+				sectionNames=numpy.array(sectionNames, dtype=numpy.str_),
+				sourceSize=numpy.array(statResult.st_size),
+				sourceMtime=numpy.array(statResult.st_mtime)
+			)
+		del data
+	finally:
+		os.remove(dataPath)
+	os.rename(temporaryPath, compiledPath)
+	return compiledPath
+
+def loadCompiledGcode(path, compileIfStale=True):
+	"""
+	Loads the compiled counterpart of the gcode file at the given path, (re)compiling it first if it is missing or
+	outdated and compileIfStale is set. Returns None if there's no up to date compiled version available.
+	"""
+	if not isCompiled(path):
+		if not compileIfStale:
+			return None
+		compileGcode(path)
+
+	archive = _mapArchive(getCompiledPath(path))
+	return CompiledGcode(
+		archive["data"],
+		archive["framedOffsets"],
+		archive["commandStarts"],
+		archive["commandEnds"],
+		archive["filepos"],
+		archive["sectionIndices"].tolist(),
+		archive["sectionNames"].tolist(),
+		int(archive["sourceSize"]),
+		float(archive["sourceMtime"])
+	)
+
+def _mapArchive(path):
+	"""
+	Returns the arrays of the uncompressed npz archive at the given path by name. numpy.load can't map the members
+	of an archive, so their positions are looked up in the zip headers and they are mapped read-only with
+	numpy.memmap. Scalars and empty arrays are read right away.
+
+	The maps are returned as plain array views, which keep the maps open but index a lot faster than numpy.memmap.
+	"""
+	with open(path, "rb") as f:
+		archive = zipfile.ZipFile(f)
+		members = archive.infolist()
+		archive.close()
+
+		result = {}
+		for member in members:
+			if member.compress_type != zipfile.ZIP_STORED:
+				raise ValueError("Member %s of %s is compressed and can't be mapped" % (member.filename, path))
+
+			# the data follows the local file header, whose name and extra field may differ from the central directory
+			f.seek(member.header_offset)
+			localHeader = f.read(30)
+			(nameLength, extraLength) = struct.unpack("<HH", localHeader[26:30])
+			f.seek(member.header_offset + 30 + nameLength + extraLength)
+
+			version = numpy.lib.format.read_magic(f)
+			if version == (1, 0):
+				(shape, fortranOrder, dtype) = numpy.lib.format.read_array_header_1_0(f)
+			else:
+				(shape, fortranOrder, dtype) = numpy.lib.format.read_array_header_2_0(f)
+			order = "F" if fortranOrder else "C"
+
+			name = member.filename[:-4] if member.filename.endswith(".npy") else member.filename
+			count = int(numpy.prod(shape))
+			if len(shape) == 0 or count == 0:
+				result[name] = numpy.fromfile(f, dtype=dtype, count=count).reshape(shape, order=order)
+			else:
+				result[name] = numpy.memmap(path, dtype=dtype, mode="r", offset=f.tell(), shape=shape, order=order).view(numpy.ndarray)
+		return result
+
+def _checksums(lines):
+	"""
+	Calculates the XOR checksums of all given lines in one go.
+	"""
+	if len(lines) == 0:
+		return []
+
+	lengths = numpy.fromiter(map(len, lines), dtype=numpy.int64, count=len(lines))
+	starts = numpy.zeros(len(lines), dtype=numpy.int64)
+	numpy.cumsum(lengths[:-1], out=starts[1:])
+	return numpy.bitwise_xor.reduceat(numpy.frombuffer("".join(lines), dtype=numpy.uint8), starts).tolist()
@@ -6,6 +6,7 @@ import re
 import os
 import base64
 import zlib
+import array
 import logging
 
 from octoprint.util import util3d
@@ -28,6 +29,56 @@ def getPreference(key, default=None):
 class AnalysisAborted(Exception):
 	pass
 
+# increase whenever the results of the analysis change for the same file, invalidates cached results
+ANALYZER_VERSION = 1
+
+# number of lines between two progress reports and checks for an abort
+PROGRESS_INTERVAL = 1000
+
+# M codes which don't have any influence on the analysis
+_knownMcodes = frozenset([
+	1,   # Message with possible wait (ignored)
+	80,  # Enable power supply
+	81,  # Suicide/disable power supply
+	84,  # Disable step drivers
+	92,  # Set steps per unit
+	101, # Enable extruder
+	103, # Disable extruder
+	104, # Set temperature, no wait
+	105, # Get temperature
+	106, # Enable fan
+	107, # Disable fan
+	108, # Extruder RPM (these should not be in the final GCode, but they are)
+	109, # Set temperature, wait
+	110, # Reset N counter
+	113, # Extruder PWM (these should not be in the final GCode, but they are)
+	140, # Set bed temperature
+	190, # Set bed temperature & wait
+])
+
+# every upper case letter followed by anything but whitespace, the lookahead makes sure letters within the value of
+# another word get matched as well, just like searching for each letter separately does
+_wordMatcher = re.compile("([A-Z])(?=(\S+))")
+
+def _getWords(line):
+	"""
+	Splits the given line into a dict mapping letters to the (unparsed) value following their first occurrence.
+	"""
+	# reversed, so that the first occurrence of each letter wins
+	return dict(reversed(_wordMatcher.findall(line)))
+
+def _toInt(value):
+	try:
+		return int(value)
+	except:
+		return None
+
+def _toFloat(value):
+	try:
+		return float(value)
+	except:
+		return None
+
 class gcodePath(object):
 	def __init__(self, newType, pathType, layerThickness, startPoint):
 		self.type = newType
@@ -35,12 +86,144 @@ class gcodePath(object):
 		self.layerThickness = layerThickness
 		self.list = [startPoint]
 
+class PathStorage(object):
+	"""
+	Compact storage of the paths of an analysed file: instead of one object per point, the points are kept in
+	flat array columns (x, y, z, e, extrudeAmountMultiply and feed) and the paths in a table of runs of points
+	sharing move type, path type and layer thickness. Layers are runs of paths.
+
+	Just like with gcodePath, each path starts with the last point of the path before it, followed by the points
+	added while it was the current path.
+	"""
+
+	def __init__(self):
+		self.x = array.array("d")
+		self.y = array.array("d")
+		self.z = array.array("d")
+		self.e = array.array("d")
+		self.extrudeAmountMultiply = array.array("d")
+		self.feed = array.array("d")
+
+		# index of the first point of each path, the point at pathStarts[n] - 1 is shared with the path before
+		self.pathStarts = array.array("l")
+		self.pathTypes = array.array("B")
+		self.pathPathTypes = array.array("H")
+		self.pathLayerThicknesses = array.array("d")
+
+		# index of the first path of each layer
+		self.layerStarts = array.array("l", [0])
+
+		self._names = []
+		self._nameIndices = {}
+
+	def addPoint(self, x, y, z, e, extrudeAmountMultiply, feed):
+		self.x.append(x)
+		self.y.append(y)
+		self.z.append(z)
+		self.e.append(e)
+		self.extrudeAmountMultiply.append(extrudeAmountMultiply)
+		self.feed.append(feed)
+
+	def addPath(self, type, pathType, layerThickness):
+		self.pathStarts.append(len(self.x))
+		self.pathTypes.append(self._getNameIndex(type))
+		self.pathPathTypes.append(self._getNameIndex(pathType))
+		self.pathLayerThicknesses.append(layerThickness)
+
+	def addLayer(self):
+		self.layerStarts.append(len(self.pathStarts))
+
+	def getName(self, index):
+		return self._names[index]
+
+	def getPathRange(self, path):
+		"""
+		Returns first and last (exclusive) index of the points of the given path, including the shared first point.
+		"""
+		start = self.pathStarts[path]
+		if path + 1 < len(self.pathStarts):
+			end = self.pathStarts[path + 1]
+		else:
+			end = len(self.x)
+		return max(0, start - 1), end
+
+	def getLayerRange(self, layer):
+		"""
+		Returns first and last (exclusive) index of the paths of the given layer.
+		"""
+		start = self.layerStarts[layer]
+		if layer + 1 < len(self.layerStarts):
+			end = self.layerStarts[layer + 1]
+		else:
+			end = len(self.pathStarts)
+		return start, end
+
+	def getPoint(self, index):
+		point = util3d.Vector3(self.x[index], self.y[index], self.z[index])
+		point.e = self.e[index]
+		point.extrudeAmountMultiply = self.extrudeAmountMultiply[index]
+		return point
+
+	def _getNameIndex(self, name):
+		if not name in self._nameIndices:
+			self._nameIndices[name] = len(self._names)
+			self._names.append(name)
+		return self._nameIndices[name]
+
+class _SequenceView(object):
+	"""
+	Read only sequence creating its items on access.
+	"""
+
+	def __init__(self, length, getItem):
+		self._length = length
+		self._getItem = getItem
+
+	def __len__(self):
+		return self._length
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(self._length))]
+		if index < 0:
+			index += self._length
+		if index < 0 or index >= self._length:
+			raise IndexError("index out of range")
+		return self._getItem(index)
+
+	def __iter__(self):
+		for index in range(self._length):
+			yield self._getItem(index)
+
+class _PathView(object):
+	"""
+	Stands in for a gcodePath stored in a PathStorage.
+	"""
+
+	def __init__(self, storage, path):
+		self.type = storage.getName(storage.pathTypes[path])
+		self.pathType = storage.getName(storage.pathPathTypes[path])
+		self.layerThickness = storage.pathLayerThicknesses[path]
+		(start, end) = storage.getPathRange(path)
+		self.list = _SequenceView(end - start, lambda index: storage.getPoint(start + index))
+
+def getLayerListView(storage):
+	"""
+	Returns a view on the given PathStorage that looks like the layerList of nested lists of gcodePath objects
+	with Vector3 points, creating those only on access.
+	"""
+	def getLayer(layer):
+		(start, end) = storage.getLayerRange(layer)
+		return _SequenceView(end - start, lambda index: _PathView(storage, start + index))
+	return _SequenceView(len(storage.layerStarts), getLayer)
+
 class gcode(object):
 	def __init__(self):
 		self._logger = logging.getLogger(__name__)
 
 		self.regMatch = {}
 		self.layerList = []
+		self.pathStorage = None
 		self.extrusionAmount = 0
 		self.extrusionVolume = None
 		self.totalMoveTimeMinute = 0
@@ -61,9 +244,20 @@ class gcode(object):
 		self._abort = True
 	
 	def _load(self, gcodeFile):
+		# progress is measured in bytes for files and in lines for lists
+		fileSize = None
+		countBytes = False
+		if isinstance(gcodeFile, (file)):
+			fileSize = self._fileSize
+			countBytes = True
+		elif isinstance(gcodeFile, (list)):
+			fileSize = len(gcodeFile)
 		filePos = 0
-		pos = util3d.Vector3()
-		posOffset = util3d.Vector3()
+		linesUntilProgress = PROGRESS_INTERVAL
+
+		# positions are kept in plain floats, the paths go into a PathStorage
+		posX = posY = posZ = 0.0
+		offsetX = offsetY = offsetZ = 0.0
 		currentE = 0.0
 		totalExtrusion = 0.0
 		maxExtrusion = 0.0
@@ -77,32 +271,35 @@ class gcode(object):
 		feedRate = 3600
 		layerThickness = 0.1
 		pathType = 'CUSTOM';
-		currentLayer = []
 		unknownGcodes={}
 		unknownMcodes={}
-		currentPath = gcodePath('move', pathType, layerThickness, pos.copy())
-		currentPath.list[0].e = totalExtrusion
-		currentPath.list[0].extrudeAmountMultiply = extrudeAmountMultiply
-		currentLayer.append(currentPath)
+		storage = PathStorage()
+		addPoint = storage.addPoint
+		storage.addPoint(posX, posY, posZ, totalExtrusion, extrudeAmountMultiply, feedRate)
+		storage.addPath('move', pathType, layerThickness)
+		currentMoveType = 'move'
+		currentPathType = pathType
 		for line in gcodeFile:
-			if self._abort:
-				raise AnalysisAborted()
 			if type(line) is tuple:
 				line = line[0]
-			if self.progressCallback != None:
-				if isinstance(gcodeFile, (file)):
-					self.progressCallback(float(filePos) / float(self._fileSize))
-				elif isinstance(gcodeFile, (list)):
-					self.progressCallback(float(filePos) / float(len(gcodeFile)))
-					filePos += 1
-
-			#Parse Cura_SF comments
-			if line.startswith(';TYPE:'):
-				pathType = line[6:].strip()
-				if pathType != "CUSTOM":
-					startCodeDone = True
-					
+
+			if countBytes:
+				filePos += len(line)
+			else:
+				filePos += 1
+			linesUntilProgress -= 1
+			if linesUntilProgress <= 0:
+				linesUntilProgress = PROGRESS_INTERVAL
+				if self._abort:
+					raise AnalysisAborted()
+				if self.progressCallback is not None and fileSize:
+					self.progressCallback(float(filePos) / float(fileSize))
+
 			if ';' in line:
+				#Parse Cura_SF comments
+				if line.startswith(';TYPE:'):
+					pathType = line[6:].strip()
+
 				# Slic3r GCode comment parser
 				comment = line[line.find(';')+1:].strip()
 				if comment == 'fill':
@@ -116,8 +313,7 @@ class gcode(object):
 
 				# Cura Gcode comment parser
 				if comment.startswith('LAYER:'):
-					self.layerList.append(currentLayer)
-					currentLayer = []
+					storage.addLayer()
 				elif comment.startswith("CURA_PROFILE_STRING"):
 					curaOptions = self._parseCuraProfileString(comment)
 
@@ -127,44 +323,55 @@ class gcode(object):
 						except:
 							filamentDiameter = 0.0
 				line = line[0:line.find(';')]
-			T = self.getCodeInt(line, 'T')
-			if T is not None:
-				if currentExtruder > 0:
-					posOffset.x -= getPreference('extruder_offset_x%d' % (currentExtruder), 0.0)
-					posOffset.y -= getPreference('extruder_offset_y%d' % (currentExtruder), 0.0)
-				currentExtruder = T
-				if currentExtruder > 0:
-					posOffset.x += getPreference('extruder_offset_x%d' % (currentExtruder), 0.0)
-					posOffset.y += getPreference('extruder_offset_y%d' % (currentExtruder), 0.0)
-			
-			G = self.getCodeInt(line, 'G')
+
+			words = _getWords(line)
+			if not words:
+				continue
+
+			if 'T' in words:
+				T = _toInt(words['T'])
+				if T is not None:
+					if currentExtruder > 0:
+						offsetX -= getPreference('extruder_offset_x%d' % (currentExtruder), 0.0)
+						offsetY -= getPreference('extruder_offset_y%d' % (currentExtruder), 0.0)
+					currentExtruder = T
+					if currentExtruder > 0:
+						offsetX += getPreference('extruder_offset_x%d' % (currentExtruder), 0.0)
+						offsetY += getPreference('extruder_offset_y%d' % (currentExtruder), 0.0)
+
+			G = _toInt(words['G']) if 'G' in words else None
 			if G is not None:
 				if G == 0 or G == 1:	#Move
-					x = self.getCodeFloat(line, 'X')
-					y = self.getCodeFloat(line, 'Y')
-					z = self.getCodeFloat(line, 'Z')
-					e = self.getCodeFloat(line, 'E')
-					f = self.getCodeFloat(line, 'F')
-					oldPos = pos.copy()
+					x = _toFloat(words['X']) if 'X' in words else None
+					y = _toFloat(words['Y']) if 'Y' in words else None
+					z = _toFloat(words['Z']) if 'Z' in words else None
+					e = _toFloat(words['E']) if 'E' in words else None
+					f = _toFloat(words['F']) if 'F' in words else None
+					oldX = posX
+					oldY = posY
+					oldZ = posZ
 					if x is not None:
 						if posAbs:
-							pos.x = x * scale + posOffset.x
+							posX = x * scale + offsetX
 						else:
-							pos.x += x * scale
+							posX += x * scale
 					if y is not None:
 						if posAbs:
-							pos.y = y * scale + posOffset.y
+							posY = y * scale + offsetY
 						else:
-							pos.y += y * scale
+							posY += y * scale
 					if z is not None:
 						if posAbs:
-							pos.z = z * scale + posOffset.z
+							posZ = z * scale + offsetZ
 						else:
-							pos.z += z * scale
+							posZ += z * scale
 					if f is not None:
 						feedRate = f
 					if x is not None or y is not None or z is not None:
-						totalMoveTimeMinute += (oldPos - pos).vsize() / feedRate
+						dX = oldX - posX
+						dY = oldY - posY
+						dZ = oldZ - posZ
+						totalMoveTimeMinute += math.sqrt(dX * dX + dY * dY + dZ * dZ) / feedRate
 					moveType = 'move'
 					if e is not None:
 						if posAbsExtruder:
@@ -183,22 +390,20 @@ class gcode(object):
 							currentE += e
 						if totalExtrusion > maxExtrusion:
 							maxExtrusion = totalExtrusion
-					if moveType == 'move' and oldPos.z != pos.z:
-						if oldPos.z > pos.z and abs(oldPos.z - pos.z) > 5.0 and pos.z < 1.0:
-							oldPos.z = 0.0
-						layerThickness = abs(oldPos.z - pos.z)
-					if currentPath.type != moveType or currentPath.pathType != pathType:
-						currentPath = gcodePath(moveType, pathType, layerThickness, currentPath.list[-1])
-						currentLayer.append(currentPath)
-					newPos = pos.copy()
-					newPos.e = totalExtrusion
-					newPos.extrudeAmountMultiply = extrudeAmountMultiply
-					currentPath.list.append(newPos)
+					if moveType == 'move' and oldZ != posZ:
+						if oldZ > posZ and abs(oldZ - posZ) > 5.0 and posZ < 1.0:
+							oldZ = 0.0
+						layerThickness = abs(oldZ - posZ)
+					if currentMoveType != moveType or currentPathType != pathType:
+						storage.addPath(moveType, pathType, layerThickness)
+						currentMoveType = moveType
+						currentPathType = pathType
+					addPoint(posX, posY, posZ, totalExtrusion, extrudeAmountMultiply, feedRate)
 				elif G == 4:	#Delay
-					S = self.getCodeFloat(line, 'S')
+					S = _toFloat(words['S']) if 'S' in words else None
 					if S is not None:
 						totalMoveTimeMinute += S / 60
-					P = self.getCodeFloat(line, 'P')
+					P = _toFloat(words['P']) if 'P' in words else None
 					if P is not None:
 						totalMoveTimeMinute += P / 60 / 1000
 				elif G == 20:	#Units are inches
@@ -206,18 +411,18 @@ class gcode(object):
 				elif G == 21:	#Units are mm
 					scale = 1.0
 				elif G == 28:	#Home
-					x = self.getCodeFloat(line, 'X')
-					y = self.getCodeFloat(line, 'Y')
-					z = self.getCodeFloat(line, 'Z')
+					x = _toFloat(words['X']) if 'X' in words else None
+					y = _toFloat(words['Y']) if 'Y' in words else None
+					z = _toFloat(words['Z']) if 'Z' in words else None
 					if x is None and y is None and z is None:
-						pos = util3d.Vector3()
+						posX = posY = posZ = 0.0
 					else:
 						if x is not None:
-							pos.x = 0.0
+							posX = 0.0
 						if y is not None:
-							pos.y = 0.0
+							posY = 0.0
 						if z is not None:
-							pos.z = 0.0
+							posZ = 0.0
 				elif G == 90:	#Absolute position
 					posAbs = True
 					posAbsExtruder = True
@@ -225,72 +430,41 @@ class gcode(object):
 					posAbs = False
 					posAbsExtruder = False
 				elif G == 92:
-					x = self.getCodeFloat(line, 'X')
-					y = self.getCodeFloat(line, 'Y')
-					z = self.getCodeFloat(line, 'Z')
-					e = self.getCodeFloat(line, 'E')
+					x = _toFloat(words['X']) if 'X' in words else None
+					y = _toFloat(words['Y']) if 'Y' in words else None
+					z = _toFloat(words['Z']) if 'Z' in words else None
+					e = _toFloat(words['E']) if 'E' in words else None
 					if e is not None:
 						currentE = e
 					if x is not None:
-						posOffset.x = pos.x - x
+						offsetX = posX - x
 					if y is not None:
-						posOffset.y = pos.y - y
+						offsetY = posY - y
 					if z is not None:
-						posOffset.z = pos.z - z
+						offsetZ = posZ - z
 				else:
 					if G not in unknownGcodes:
 						self._logger.info("Unknown G code: %r" % G)
 					unknownGcodes[G] = True
 			else:
-				M = self.getCodeInt(line, 'M')
+				M = _toInt(words['M']) if 'M' in words else None
 				if M is not None:
-					if M == 1:	#Message with possible wait (ignored)
-						pass
-					elif M == 80:	#Enable power supply
-						pass
-					elif M == 81:	#Suicide/disable power supply
-						pass
-					elif M == 82:	# Use absolute extruder positions
+					if M == 82:	# Use absolute extruder positions
 						posAbsExtruder = True
 					elif M == 83:	# Use relative extruder positions
 						posAbsExtruder = False
-					elif M == 84:	#Disable step drivers
-						pass
-					elif M == 92:	#Set steps per unit
-						pass
-					elif M == 101:	#Enable extruder
-						pass
-					elif M == 103:	#Disable extruder
-						pass
-					elif M == 104:	#Set temperature, no wait
-						pass
-					elif M == 105:	#Get temperature
-						pass
-					elif M == 106:	#Enable fan
-						pass
-					elif M == 107:	#Disable fan
-						pass
-					elif M == 108:	#Extruder RPM (these should not be in the final GCode, but they are)
-						pass
-					elif M == 109:	#Set temperature, wait
-						pass
-					elif M == 110:	#Reset N counter
-						pass
-					elif M == 113:	#Extruder PWM (these should not be in the final GCode, but they are)
-						pass
-					elif M == 140:	#Set bed temperature
-						pass
-					elif M == 190:	#Set bed temperature & wait
-						pass
 					elif M == 221:	#Extrude amount multiplier
-						s = self.getCodeFloat(line, 'S')
+						s = _toFloat(words['S']) if 'S' in words else None
 						if s != None:
 							extrudeAmountMultiply = s / 100.0
-					else:
+					elif M not in _knownMcodes:
 						if M not in unknownMcodes:
 							self._logger.info("Unknown M code: %r" % M)
 						unknownMcodes[M] = True
-		self.layerList.append(currentLayer)
+		if self.progressCallback is not None and fileSize:
+			self.progressCallback(float(filePos) / float(fileSize))
+		self.pathStorage = storage
+		self.layerList = getLayerListView(storage)
 		self.extrusionAmount = maxExtrusion
 		if filamentDiameter is not None and filamentDiameter > 0:
 			self.extrusionVolume = math.pi * math.pow(filamentDiameter / 2.0, 2) * maxExtrusion / 1000.0
@@ -0,0 +1,136 @@
+# coding=utf-8
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+import cgi
+
+class MultipartParser(object):
+	"""
+	Incremental parser for multipart/form-data request bodies, fed with chunks of arbitrary size as they arrive
+	instead of the complete body.
+
+	Once the headers of a part are complete, createPart is called with the part's field name, its filename (None for
+	plain form fields) and its content type. It returns an object with a write method that receives the part's
+	contents, or None to collect them into fields instead, which is limited to maxFieldSize bytes per field.
+
+	Malformed bodies raise a ValueError from feed or finish.
+	"""
+
+	MAX_HEADER_SIZE = 8 * 1024
+
+	def __init__(self, boundary, createPart, maxFieldSize=64 * 1024):
+		self.fields = []
+
+		self._createPart = createPart
+		self._maxFieldSize = maxFieldSize
+
+		# with a line break in front of the body the first boundary looks like all the following ones
+		self._delimiter = "\r\n--" + boundary
+		self._buffer = "\r\n"
+		self._state = "preamble"
+
+		self._part = None
+		self._field = None
+		self._fieldSize = 0
+
+	def feed(self, data):
+		if self._state == "done":
+			# the epilogue is of no interest
+			return
+		self._buffer += data
+		while self._state != "done":
+			if self._state == "preamble":
+				start = self._buffer.find(self._delimiter)
+				if start < 0:
+					self._buffer = self._buffer[-len(self._delimiter):]
+					return
+				self._buffer = self._buffer[start + len(self._delimiter):]
+				self._state = "delimiter"
+
+			elif self._state == "delimiter":
+				if len(self._buffer) < 2:
+					return
+				if self._buffer.startswith("--"):
+					self._buffer = ""
+					self._state = "done"
+				elif self._buffer.startswith("\r\n"):
+					self._buffer = self._buffer[2:]
+					self._state = "headers"
+				else:
+					raise ValueError("Malformed boundary")
+
+			elif self._state == "headers":
+				end = self._buffer.find("\r\n\r\n")
+				if end < 0:
+					if len(self._buffer) > self.MAX_HEADER_SIZE:
+						raise ValueError("Part headers too long")
+					return
+				self._startPart(self._buffer[:end])
+				self._buffer = self._buffer[end + 4:]
+				self._state = "body"
+
+			elif self._state == "body":
+				end = self._buffer.find(self._delimiter)
+				if end < 0:
+					# the end of the buffer might be the start of the next delimiter, keep that back
+					keep = len(self._delimiter) - 1
+					if len(self._buffer) > keep:
+						self._write(self._buffer[:-keep])
+						self._buffer = self._buffer[-keep:]
+					return
+				self._write(self._buffer[:end])
+				self._endPart()
+				self._buffer = self._buffer[end + len(self._delimiter):]
+				self._state = "delimiter"
+
+	def finish(self):
+		"""
+		Checks that the body fed so far was complete.
+		"""
+		if self._state != "done":
+			raise ValueError("Incomplete multipart body")
+
+	def _startPart(self, headerData):
+		headers = {}
+		for line in headerData.split("\r\n"):
+			if not ":" in line:
+				raise ValueError("Malformed part header")
+			(name, value) = line.split(":", 1)
+			headers[name.strip().lower()] = value.strip()
+
+		(disposition, params) = cgi.parse_header(headers.get("content-disposition", ""))
+		if disposition != "form-data" or not "name" in params:
+			raise ValueError("Part without form-data disposition")
+
+		self._part = self._createPart(params["name"], params.get("filename", None), headers.get("content-type", None))
+		if self._part is None:
+			self._field = (params["name"], [])
+			self._fieldSize = 0
+
+	def _write(self, data):
+		if not data:
+			return
+		if self._part is not None:
+			self._part.write(data)
+			return
+
+		self._fieldSize += len(data)
+		if self._fieldSize > self._maxFieldSize:
+			raise ValueError("Field %s too long" % self._field[0])
+		self._field[1].append(data)
+
+	def _endPart(self):
+		if self._part is None:
+			(name, data) = self._field
+			self.fields.append((name, "".join(data)))
+		self._part = None
+		self._field = None
+
+def getBoundary(contentType):
+	"""
+	Returns the boundary of the given Content-Type header if it's multipart/form-data, None otherwise.
+	"""
+	(value, params) = cgi.parse_header(contentType or "")
+	if value.lower() != "multipart/form-data" or not params.get("boundary"):
+		return None
+	return params["boundary"]
@@ -0,0 +1,181 @@
+# coding=utf-8
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+import re
+import math
+import array
+
+from octoprint.settings import settings
+from octoprint.util.sprayPath import sp_syringe_volume_per_travel
+
+AXES = ["x", "y", "z", "p", "v"]
+
+# valve position that routes the syringe to the spray head, see sprayPath.sc_valve_spray
+SPRAY_VALVE = 1.0
+
+# numbers may come in exponent notation, which is what str() makes of the tiny syringe deltas in dense rasters
+_tokenMatcher = re.compile("([A-Z])\s*([-+]?[0-9]*\.?[0-9]*(?:E[-+]?[0-9]+)?)")
+
+class SprayEstimate(object):
+	"""
+	Result of a SprayTimeEstimator run.
+
+	cumulativeTimes holds the time in seconds it takes to get through each command of the job (comments and empty
+	lines don't count), totalTime is the time for the whole job. syringeVolume is the volume in ul pushed out of the
+	syringe in total, sprayVolume the part of it pushed out while the valve was set to the spray head.
+	"""
+
+	def __init__(self, cumulativeTimes, syringeVolume, sprayVolume):
+		self.cumulativeTimes = cumulativeTimes
+		self.totalTime = cumulativeTimes[-1] if len(cumulativeTimes) > 0 else 0.0
+		self.syringeVolume = syringeVolume
+		self.sprayVolume = sprayVolume
+
+	def __len__(self):
+		return len(self.cumulativeTimes)
+
+	def getRemainingTime(self, commandIndex):
+		"""
+		Returns the time in seconds left once the first commandIndex commands of the job have been processed.
+		"""
+		if commandIndex <= 0:
+			return self.totalTime
+		if commandIndex >= len(self.cumulativeTimes):
+			return 0.0
+		return self.totalTime - self.cumulativeTimes[commandIndex - 1]
+
+class SprayTimeEstimator(object):
+	"""
+	Estimates how long a spray method takes on the deltaSpray by simulating it command by command.
+
+	Every move accelerates from and decelerates to a standstill with a trapezoidal velocity profile. The requested
+	feedrate applies to the XYZ distance of a move, or to the syringe (P) or valve (V) travel for moves of those axes
+	only, and both speed and acceleration are limited so that no participating axis exceeds its own limits. G4 dwells
+	and homing are taken into account as well.
+
+	Limits are given as dicts from axis name (see AXES) to mm/s and mm/s² respectively.
+	"""
+
+	def __init__(self, maxFeedrates, maxAccelerations, homingFeedrate):
+		self._maxFeedrates = maxFeedrates
+		self._maxAccelerations = maxAccelerations
+		self._homingFeedrate = homingFeedrate
+
+	@staticmethod
+	def fromSettings():
+		return SprayTimeEstimator(
+			dict((axis, settings().getFloat(["spray", "kinematics", "maxFeedrate", axis])) for axis in AXES),
+			dict((axis, settings().getFloat(["spray", "kinematics", "maxAcceleration", axis])) for axis in AXES),
+			settings().getFloat(["spray", "kinematics", "homingFeedrate"])
+		)
+
+	def estimate(self, lines):
+		"""
+		Simulates the given gcode lines and returns a SprayEstimate.
+		"""
+		position = dict((axis, 0.0) for axis in AXES)
+		absolute = True
+		absoluteSyringe = True
+		feedrate = None
+
+		cumulativeTimes = array.array("d")
+		totalTime = 0.0
+		syringeVolume = 0.0
+		sprayVolume = 0.0
+
+		for line in lines:
+			if ";" in line:
+				line = line[0:line.find(";")]
+			line = line.strip()
+			if len(line) == 0:
+				continue
+
+			tokens = _tokenMatcher.findall(line.upper())
+			code = tokens[0][0] + tokens[0][1] if len(tokens) > 0 else None
+			parameters = dict((letter.lower(), value) for (letter, value) in tokens[1:])
+
+			if code in ("G0", "G1"):
+				if "f" in parameters and parameters["f"]:
+					feedrate = float(parameters["f"]) / 60.0
+
+				deltas = {}
+				for axis in AXES:
+					if not axis in parameters or not parameters[axis]:
+						continue
+					value = float(parameters[axis])
+					if axis == "p":
+						target = value if absoluteSyringe else position[axis] + value
+					elif axis == "v":
+						target = value
+					else:
+						target = value if absolute else position[axis] + value
+					if target != position[axis]:
+						deltas[axis] = target - position[axis]
+						position[axis] = target
+
+				totalTime += self._getMoveTime(deltas, feedrate)
+				if deltas.get("p", 0.0) < 0:
+					volume = -deltas["p"] * sp_syringe_volume_per_travel
+					syringeVolume += volume
+					if position["v"] == SPRAY_VALVE:
+						sprayVolume += volume
+
+			elif code == "G4":
+				if "s" in parameters and parameters["s"]:
+					totalTime += float(parameters["s"])
+				elif "p" in parameters and parameters["p"]:
+					totalTime += float(parameters["p"]) / 1000.0
+
+			elif code == "G28":
+				# axes without parameter are homed, no axes at all means all of them
+				homedAxes = [axis for axis in AXES if axis in parameters]
+				if len(homedAxes) == 0:
+					homedAxes = AXES
+				if self._homingFeedrate:
+					totalTime += max([abs(position[axis]) for axis in homedAxes]) / self._homingFeedrate
+				for axis in homedAxes:
+					position[axis] = 0.0
+
+			elif code == "G90":
+				absolute = absoluteSyringe = True
+			elif code == "G91":
+				absolute = absoluteSyringe = False
+			elif code == "M82":
+				absoluteSyringe = True
+			elif code == "M83":
+				absoluteSyringe = False
+
+			cumulativeTimes.append(totalTime)
+
+		return SprayEstimate(cumulativeTimes, syringeVolume, sprayVolume)
+
+	def _getMoveTime(self, deltas, feedrate):
+		if len(deltas) == 0:
+			return 0.0
+
+		distance = math.sqrt(sum([deltas[axis] ** 2 for axis in ("x", "y", "z") if axis in deltas]))
+		if distance == 0:
+			distance = max([abs(delta) for delta in deltas.values()])
+
+		# scale the limits of each axis to the path, so none of the axes exceeds its own
+		speed = feedrate
+		acceleration = None
+		for (axis, delta) in deltas.items():
+			share = abs(delta) / distance
+			maxFeedrate = self._maxFeedrates.get(axis)
+			if maxFeedrate:
+				speed = min(speed, maxFeedrate / share) if speed else maxFeedrate / share
+			maxAcceleration = self._maxAccelerations.get(axis)
+			if maxAcceleration:
+				acceleration = min(acceleration, maxAcceleration / share) if acceleration else maxAcceleration / share
+
+		if not speed:
+			return 0.0
+		if not acceleration:
+			return distance / speed
+
+		# trapezoid if the move is long enough to reach full speed, triangle otherwise
+		if distance >= speed * speed / acceleration:
+			return distance / speed + speed / acceleration
+		return 2.0 * math.sqrt(distance / acceleration)
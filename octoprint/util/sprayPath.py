@@ -0,0 +1,410 @@
+# coding=utf-8
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+import numpy
+
+from collections import OrderedDict
+
+from octoprint.util import gcodeCompiler
+
+# increase whenever the generated gcode changes for the same parameters, invalidates all cached methods
+GENERATOR_VERSION = 1
+
+# position constants
+sp_home_x = 0.0
+sp_home_y = 0.0
+sp_home_z = 0.0
+sp_offset = 0.0
+sp_x1 = -60.0
+sp_x2 = 60.0
+sp_y1 = -80.0
+sp_y2 = 80.0
+sp_top = 104.0
+sp_wash_x = 0.0
+sp_wash_y = -110.0
+sp_wash_z = -50.0
+# wash position top, use to approach
+sp_wash_u = -35.0
+sp_magnet = 16.5
+
+# syringe volume in ul/mm
+sp_syringe_volume_per_travel = 16.7
+
+# commands
+sc_valve_wash = "G1 V2 F200\nG4 S1\n"
+sc_valve_spray = "G1 V1 F200\nG4 S1\n"
+sc_valve_waste = "G1 V0 F200\nG4 S1\n"
+#go to valve position % nr
+sc_valve_pos = "G1 V{} F200\nG4 S1\n"
+sc_air_on = "M106\n"
+sc_air_off = "M106 S0\n"
+sc_init = "G28XYZ\nG28P\nG90\n"
+sc_motor_off = "M18\n"
+
+# go to wash position
+sc_go_to_wash = ";go to wash\nG1 Z{} F200\nG1 X{} Y{} Z{} F200\nG1 Z{}\n".format (sp_wash_u, sp_wash_x, sp_wash_y, sp_wash_u, sp_wash_z)
+
+# aspirate % position
+sc_aspirate = "G1 P{} F200\n"
+
+# set syringe to absolute mode
+sc_syringe_absolute= "M82\n"
+
+# set syringe to realtive mode
+sc_syringe_relative = "M83\n"
+
+# empty syringe
+sc_empty = "G1 P0 F200\n"
+
+# wait % seconds
+sc_wait = "G4 S{}\n"
+
+# set speed % speed
+sc_speed = "G1 F{}\n"
+
+# go to syringe position % position
+sc_syringe_position = "G1 P{}\n"
+
+# move fast % x, y position
+sc_move_fast = "G1 X{} Y{} F200\n"
+
+# move fast % z position
+sc_move_fast_z = "G1 Z{} F200\n"
+
+# spray fast % x, y, p, f
+sc_spray = "G1 X{} Y{} P{} F{}\n"
+
+sc_go_home = "G1 X0 Y0 Z-35 F200\nG1 Z0 F200\n"
+
+class SprayMethod(object):
+	"""
+	A generated spray method: the gcode to send plus the raster path it sprays and some totals calculated from it.
+
+	The path is given as flat arrays over the spray moves of all cycles, x and y being the target position of each
+	move and p the (relative) syringe travel during it. Totals are calculated from the path: travelDistance in mm,
+	syringeVolume in ul and sprayTime in seconds, covering the spray moves only.
+	"""
+
+	def __init__(self, gcode, x, y, p, feed, travelDistance, syringeVolume, sprayTime):
+		self.gcode = gcode
+		self.x = x
+		self.y = y
+		self.p = p
+		self.feed = feed
+		self.travelDistance = travelDistance
+		self.syringeVolume = syringeVolume
+		self.sprayTime = sprayTime
+
+	def save(self, filename):
+		with open(filename, "w") as f:
+			f.write(self.gcode)
+
+class SprayPlan(object):
+	"""
+	Everything needed to produce the spray method for one set of parameters: a serpentine raster of lines "distance"
+	mm apart, sprayed "cycles" times from "height" mm with a feedrate of "speed" and "flow" ul/cm² of the given
+	"solution", pausing "delay" seconds between cycles. The cleanTemplate is appended as is at the end of the method.
+
+	Only the numbers are calculated up front, the gcode itself is produced cycle by cycle via iterChunks or iterLines,
+	so it can either be joined into a SprayMethod or streamed to the printer without ever being held in full.
+	"""
+
+	def __init__(self, distance, height, speed, flow, cycles, delay, solution, cleanTemplate=""):
+		self.cycles = cycles
+		self._cleanTemplate = cleanTemplate
+
+		# densitity in ul/mm
+		density = float(flow) / 100 * distance
+
+		lineCount = int((sp_y2 - sp_y1) / distance)
+		syringeTravel = (lineCount * (sp_x2 - sp_x1) + (sp_y2 - sp_y1)) * density / sp_syringe_volume_per_travel
+
+		syringeX = (sp_x2 - sp_x1) * density / sp_syringe_volume_per_travel * -1
+		syringeY = distance * density / sp_syringe_volume_per_travel * -1
+
+		# this is an intrinsic factor, test
+		self.feed = speed * 1.0
+
+		#~~ raster
+
+		# every cycle starts a bit further down, every line one distance further than the one before
+		self._cycleStartOffsets = [distance / lineCount * n + sp_y1 if lineCount > 0 else sp_y1 for n in range(cycles)]
+		yOffsets = numpy.empty((cycles, lineCount))
+		if lineCount > 0:
+			yOffsets[:, 0] = distance / lineCount * numpy.arange(cycles) + sp_y1
+			yOffsets[:, 1:] = distance
+			# cumsum adds up sequentially, so the offsets are exactly the same as when adding up line by line
+			yOffsets = numpy.cumsum(yOffsets, axis=1)
+		self._yOffsets = yOffsets
+
+		# each line consists of two moves, even lines start towards x2, odd lines towards x1
+		evenLines = (numpy.arange(lineCount) % 2 == 0)
+		x = numpy.empty((cycles, lineCount, 2))
+		x[:, :, 0] = numpy.where(evenLines, sp_x2, sp_x1)
+		x[:, :, 1] = numpy.where(evenLines, sp_x1, sp_x2)
+		y = numpy.repeat(yOffsets[:, :, numpy.newaxis], 2, axis=2)
+		p = numpy.empty((cycles, lineCount, 2))
+		p[:, :, 0] = syringeY
+		p[:, :, 1] = syringeX
+
+		self.x = x.reshape((cycles, lineCount * 2))
+		self.y = y.reshape((cycles, lineCount * 2))
+		self.p = p.reshape((cycles, lineCount * 2))
+
+		#~~ totals
+
+		# every cycle starts at x1 on its first line
+		if lineCount > 0:
+			# numpy.full needs numpy 1.8
+			cycleStarts = numpy.empty((cycles, 1))
+			cycleStarts.fill(sp_x1)
+			dx = numpy.diff(numpy.hstack([cycleStarts, self.x]), axis=1)
+			dy = numpy.diff(numpy.hstack([self.y[:, :1], self.y]), axis=1)
+			self.travelDistance = float(numpy.hypot(dx, dy).sum())
+		else:
+			self.travelDistance = 0.0
+		self.syringeVolume = float(-self.p.sum() * sp_syringe_volume_per_travel)
+		self.sprayTime = self.travelDistance / self.feed * 60.0 if self.feed > 0 else 0.0
+
+		#~~ gcode building blocks
+
+		#prime system
+		primeCycle = "G1 V{0}.5 F200\nG4 S1\nG1 P4.2 F200\nG4 S1\nG1 V{0} F200\nG4 S1\nG1 V0 F200\nG4 S1\nG1 P0 F100\nG4 S1\n".format(solution)
+		self._header = ";Spray file generated on the fly\n" \
+			+ ";start coating\n" \
+			+ sc_init \
+			+ sc_go_to_wash \
+			+ primeCycle * 5 \
+			+ sc_air_on \
+			+ sc_valve_pos.format(solution) \
+			+ sc_aspirate.format(2) \
+			+ sc_valve_spray + sc_speed.format(0.1) + sc_syringe_position.format(0)
+
+		self._cycleStart = sc_air_on \
+			+ sc_syringe_absolute \
+			+ sc_valve_pos.format(solution) \
+			+ sc_aspirate.format(syringeTravel + 2) \
+			+ sc_valve_spray \
+			+ sc_speed.format(0.1) + sc_syringe_position.format(syringeTravel) \
+			+ sc_move_fast_z.format(sp_wash_u)
+		self._cycleRasterStart = sc_move_fast_z.format(height - sp_top) + sc_syringe_relative
+		self._cycleEnd = "G1 Y{} Z{} F200\n".format(sp_y1, sp_wash_u) \
+			+ sc_go_to_wash \
+			+ sc_syringe_absolute \
+			+ sc_valve_waste + sc_empty \
+			+ sc_air_off \
+			+ sc_wait.format(delay)
+
+		# everything but the y offsets is the same for every line, so format it only once
+		evenLine = sc_spray.format(sp_x2, "%s", syringeY, self.feed) + sc_spray.format(sp_x1, "%s", syringeX, self.feed)
+		oddLine = sc_spray.format(sp_x1, "%s", syringeY, self.feed) + sc_spray.format(sp_x2, "%s", syringeX, self.feed)
+		self._lineTemplates = [evenLine if even else oddLine for even in evenLines.tolist()]
+
+		# the raster moves are all commands, everything else is counted once
+		self.commandCount = _countCommands(self._header) \
+			+ cycles * (_countCommands(self._cycleStart + sc_move_fast + self._cycleRasterStart + self._cycleEnd) + lineCount * 2) \
+			+ _countCommands(self._cleanTemplate)
+
+	def iterChunks(self):
+		"""
+		Yields the gcode of the method in chunks of complete lines, producing the raster of each cycle only when it's
+		asked for.
+		"""
+		yield self._header
+		for n in range(self.cycles):
+			# str of a float is what format used for the offsets before
+			offsets = map(str, self._yOffsets[n].tolist())
+
+			yield self._cycleStart \
+				+ sc_move_fast.format(sp_x1, self._cycleStartOffsets[n]) \
+				+ self._cycleRasterStart \
+				+ "".join([template % (offset, offset) for (template, offset) in zip(self._lineTemplates, offsets)]) \
+				+ self._cycleEnd
+
+		# now do the wash
+		yield self._cleanTemplate
+
+	def iterLines(self):
+		"""
+		Yields the gcode of the method line by line.
+		"""
+		for chunk in self.iterChunks():
+			for line in chunk.splitlines(True):
+				yield line
+
+def generateSprayMethod(distance, height, speed, flow, cycles, delay, solution, cleanTemplate=""):
+	"""
+	Generates the complete spray method for the given parameters, see SprayPlan for their meaning.
+
+	Returns a SprayMethod.
+	"""
+	plan = SprayPlan(distance, height, speed, flow, cycles, delay, solution, cleanTemplate=cleanTemplate)
+	return SprayMethod("".join(plan.iterChunks()), plan.x.ravel(), plan.y.ravel(), plan.p.ravel(), plan.feed, plan.travelDistance, plan.syringeVolume, plan.sprayTime)
+
+def _isKey(name):
+	"""
+	Whether the given name is a key of SprayMethodCache, i.e. a SHA1 hex digest.
+	"""
+	return len(name) == 40 and all(c in "0123456789abcdef" for c in name)
+
+def _countCommands(gcode):
+	"""
+	Counts the lines of the given gcode that are left over once comments and whitespace are stripped, the same way
+	the file information classes in octoprint.util.comm do it.
+	"""
+	count = 0
+	for line in gcode.splitlines():
+		if ";" in line:
+			line = line[0:line.find(";")]
+		if len(line.strip()) > 0:
+			count += 1
+	return count
+
+class SprayMethodCache(object):
+	"""
+	Cache of generated spray methods in the given folder, addressed by a hash of everything that goes into a method:
+	the normalized spray parameters, the generator version, all position and command constants and the clean
+	template. Each method gets its own file named after its hash, so concurrent requests never write to the same
+	file, and other files in the folder (like the clean method) are left alone. Once the methods and their compiled
+	versions take up more than maxSize bytes, the least recently used ones are removed. Temporary files left behind
+	by an interrupted generation are removed on startup.
+
+	Methods are either generated in full via getMethod or written to the cache while they are streamed to the printer
+	via iterLinesAndCache.
+	"""
+
+	def __init__(self, folder, maxSize=100 * 1024 * 1024):
+		self._logger = logging.getLogger(__name__)
+		self._folder = folder
+		self._maxSize = max(0, maxSize)
+		self._mutex = threading.Lock()
+
+		# least recently used first with their size on disk, initialized from the modification times which get
+		# bumped on every hit
+		self._entries = OrderedDict()
+		self._size = 0
+		entries = []
+		for filename in os.listdir(self._folder):
+			path = os.path.join(self._folder, filename)
+			if filename.endswith(".tmp"):
+				self._removeFile(path)
+			elif filename.endswith(".gcode") and _isKey(filename[:-len(".gcode")]):
+				entries.append((os.stat(path).st_mtime, filename[:-len(".gcode")]))
+		for (mtime, key) in sorted(entries):
+			self._addEntry(key)
+		with self._mutex:
+			self._evict()
+
+	def getKey(self, distance, height, speed, flow, cycles, delay, solution, cleanTemplate=""):
+		hash = hashlib.sha1()
+		hash.update(repr((GENERATOR_VERSION, float(distance), float(height), float(speed), float(flow), int(cycles), float(delay), str(solution).strip())))
+		hash.update(repr(sorted([(name, value) for (name, value) in globals().items() if name.startswith("sp_") or name.startswith("sc_")])))
+		hash.update(cleanTemplate)
+		return hash.hexdigest()
+
+	def getPath(self, key):
+		return os.path.join(self._folder, key + ".gcode")
+
+	def getCachedMethod(self, key):
+		"""
+		Returns the path of the cached spray method with the given key (see getKey) or None if it isn't cached.
+		"""
+		path = self.getPath(key)
+		with self._mutex:
+			if not key in self._entries or not os.path.isfile(path):
+				return None
+			self._logger.debug("Using cached spray method %s" % key)
+			# the method might have been compiled since it was last used, so its size is taken anew
+			self._addEntry(key)
+			os.utime(path, None)
+			return path
+
+	def getMethod(self, distance, height, speed, flow, cycles, delay, solution, cleanTemplate=""):
+		"""
+		Returns the path of the spray method for the given parameters, generating it first if it isn't cached yet.
+		"""
+		key = self.getKey(distance, height, speed, flow, cycles, delay, solution, cleanTemplate)
+		path = self.getCachedMethod(key)
+		if path is not None:
+			return path
+		path = self.getPath(key)
+
+		method = generateSprayMethod(float(distance), float(height), float(speed), float(flow), int(cycles), float(delay), str(solution).strip(), cleanTemplate=cleanTemplate)
+
+		# write to a file of our own first, so a concurrent request for the same method can't read a partial one
+		(handle, temporaryPath) = tempfile.mkstemp(suffix=".tmp", dir=self._folder)
+		os.close(handle)
+		method.save(temporaryPath)
+		os.rename(temporaryPath, path)
+		self._logger.debug("Generated spray method %s" % key)
+
+		with self._mutex:
+			self._addEntry(key)
+			self._evict()
+		return path
+
+	def iterLinesAndCache(self, key, plan):
+		"""
+		Yields the lines of the given SprayPlan like SprayPlan.iterLines and writes them to a temporary file along
+		the way, which becomes the cached method with the given key once all lines have been yielded. If the
+		iteration is abandoned, e.g. because the spray job got cancelled, the temporary file is removed.
+		"""
+		(handle, temporaryPath) = tempfile.mkstemp(suffix=".tmp", dir=self._folder)
+		complete = False
+		try:
+			with os.fdopen(handle, "w") as f:
+				for chunk in plan.iterChunks():
+					f.write(chunk)
+					for line in chunk.splitlines(True):
+						yield line
+			os.rename(temporaryPath, self.getPath(key))
+			complete = True
+			self._logger.debug("Cached streamed spray method %s" % key)
+
+			with self._mutex:
+				self._addEntry(key)
+				self._evict()
+		finally:
+			if not complete:
+				self._removeFile(temporaryPath)
+
+	def _addEntry(self, key):
+		"""
+		Adds the method with the given key as the most recently used one, or moves it there if it's already cached.
+		"""
+		if key in self._entries:
+			self._size -= self._entries.pop(key)
+
+		path = self.getPath(key)
+		size = 0
+		for entryPath in (path, gcodeCompiler.getCompiledPath(path)):
+			if os.path.isfile(entryPath):
+				size += os.stat(entryPath).st_size
+		self._entries[key] = size
+		self._size += size
+
+	def _evict(self):
+		"""
+		Removes the least recently used methods until the cache fits into maxSize again. The most recently used one,
+		which is about to be sprayed, is kept in any case.
+		"""
+		while self._size > self._maxSize and len(self._entries) > 1:
+			(key, size) = self._entries.popitem(last=False)
+			self._size -= size
+			path = self.getPath(key)
+			self._logger.debug("Evicting spray method %s from cache" % key)
+			self._removeFile(path)
+			self._removeFile(gcodeCompiler.getCompiledPath(path))
+
+	def _removeFile(self, path):
+		try:
+			if os.path.isfile(path):
+				os.remove(path)
+		except:
+			self._logger.exception("Could not remove %s from the spray method cache" % path)
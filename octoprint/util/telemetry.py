@@ -0,0 +1,361 @@
+# coding=utf-8
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+import os
+import time
+import yaml
+import Queue
+import logging
+import threading
+import numpy
+
+class TelemetryBuffer(object):
+	"""
+	Fixed size ring buffer of numeric samples, each a timestamp plus one value per column, kept in a single
+	preallocated float array. Once capacity rows are filled the oldest ones are overwritten.
+
+	Samples arriving less than interval seconds (in the unit of the timestamps, see timeScale) after the first one of
+	the current row are averaged into that row, so with an interval set the buffer covers capacity * interval at the
+	cost of resolution. Values of None are stored as NaN and don't count towards the averages.
+	"""
+
+	def __init__(self, columns, capacity, interval=0.0, timeScale=1.0):
+		self.columns = list(columns)
+		self.capacity = capacity
+		self._interval = interval * timeScale
+
+		self._data = numpy.zeros((capacity, len(self.columns) + 1), dtype=numpy.float64)
+		self._counts = numpy.zeros((capacity, len(self.columns)), dtype=numpy.int32)
+		self._start = 0
+		self._length = 0
+		self._mutex = threading.Lock()
+
+	def __len__(self):
+		return self._length
+
+	def append(self, timestamp, values):
+		values = numpy.array([value if value is not None else numpy.nan for value in values], dtype=numpy.float64)
+		valid = ~numpy.isnan(values)
+
+		with self._mutex:
+			if self._length > 0 and self._interval > 0:
+				last = (self._start + self._length - 1) % self.capacity
+				if timestamp - self._data[last, 0] < self._interval:
+					row = self._data[last, 1:]
+					counts = self._counts[last]
+					# running mean per column, columns without a value so far take the new one as is
+					counts[valid] += 1
+					row[valid] = numpy.where(counts[valid] == 1, values[valid], row[valid] + (values[valid] - row[valid]) / counts[valid])
+					return
+
+			if self._length < self.capacity:
+				index = (self._start + self._length) % self.capacity
+				self._length += 1
+			else:
+				index = self._start
+				self._start = (self._start + 1) % self.capacity
+
+			self._data[index, 0] = timestamp
+			self._data[index, 1:] = values
+			self._counts[index] = valid
+
+	def clear(self):
+		with self._mutex:
+			self._start = 0
+			self._length = 0
+
+	def getViews(self):
+		"""
+		Returns the rows in chronological order as up to two views into the buffer (timestamp in column 0), without
+		copying anything. The views change with further appends, use toArray for a stable copy.
+		"""
+		end = self._start + self._length
+		if end <= self.capacity:
+			return [self._data[self._start:end]]
+		return [self._data[self._start:], self._data[:end - self.capacity]]
+
+	def toArray(self):
+		"""
+		Returns a copy of the rows in chronological order, timestamp in column 0.
+		"""
+		with self._mutex:
+			views = self.getViews()
+			if len(views) == 1:
+				return views[0].copy()
+			return numpy.concatenate(views)
+
+	def toColumns(self):
+		"""
+		Returns a dict with a list of the timestamps ("time") and one list of values per column, NaN replaced by None.
+		The lists are filled straight from the views into the buffer (see getViews), one column at a time.
+		"""
+		result = dict((column, []) for column in ["time"] + self.columns)
+		with self._mutex:
+			for view in self.getViews():
+				for (index, column) in enumerate(["time"] + self.columns):
+					result[column].extend(_toList(view[:, index]))
+		return result
+
+#~~ persistent telemetry of print runs
+
+RECORD_TEMPERATURE = 0
+RECORD_PROGRESS = 1
+RECORD_Z = 2
+RECORD_STATE = 3
+
+# record type => (name, value columns)
+RECORD_TYPES = {
+	RECORD_TEMPERATURE: ("temperature", ["actual", "target", "actualBed", "targetBed"]),
+	RECORD_PROGRESS: ("progress", ["progress", "filepos", "printTime", "printTimeLeft"]),
+	RECORD_Z: ("z", ["z"]),
+	RECORD_STATE: ("state", ["state"])
+}
+
+# one record on disk: timestamp in seconds, record type and up to four values, unused ones NaN
+RECORD_DTYPE = numpy.dtype([("time", "<f8"), ("type", "<u1"), ("values", "<f8", (4,))])
+
+RUN_EXTENSION = ".telemetry"
+
+class TelemetryStore(object):
+	"""
+	Persists the telemetry of print runs: one append-only file of fixed size records (see RECORD_DTYPE) per run plus
+	a small index.yaml listing the runs with file, start, end and outcome.
+
+	startRun, endRun and record only queue their data, a background thread writes it in chunks at most every
+	flushInterval seconds, so callers like the serial loop never wait for the disk. Records arriving while no run is
+	active are dropped. Only the last maxRuns runs are kept.
+	"""
+
+	def __init__(self, folder, maxRuns=100, flushInterval=1.0):
+		self._logger = logging.getLogger(__name__)
+
+		self._folder = folder
+		self._indexPath = os.path.join(folder, "index.yaml")
+		self._maxRuns = maxRuns
+		self._flushInterval = flushInterval
+
+		self._runs = []
+		# a crash while saving on Windows may leave only the backup behind, see _saveIndex
+		indexPath = self._indexPath if os.path.isfile(self._indexPath) else self._indexPath + ".bak"
+		if os.path.isfile(indexPath):
+			try:
+				with open(indexPath, "r") as f:
+					self._runs = yaml.safe_load(f)
+			except:
+				self._logger.exception("Could not load telemetry index from %s, starting with an empty one" % indexPath)
+		if not isinstance(self._runs, list):
+			self._runs = []
+		self._runsMutex = threading.Lock()
+
+		self._active = False
+		self._currentRun = None
+		self._currentFile = None
+
+		self._queue = Queue.Queue()
+		self._worker = threading.Thread(target=self._work)
+		self._worker.daemon = True
+		self._worker.start()
+
+	#~~ recording, called from any thread
+
+	def startRun(self, filename):
+		self._active = True
+		self._queue.put(("start", time.time(), filename))
+
+	def endRun(self, success):
+		self._active = False
+		self._queue.put(("end", time.time(), success))
+
+	def record(self, recordType, values):
+		if not self._active:
+			return
+		self._queue.put(("record", time.time(), recordType, values))
+
+	#~~ queries
+
+	def getRuns(self, filename=None):
+		"""
+		Returns the recorded runs, newest first, optionally only those of the given file.
+		"""
+		with self._runsMutex:
+			runs = [dict(run) for run in self._runs if filename is None or run["filename"] == filename]
+		for run in runs:
+			path = self._getRunPath(run["id"])
+			run["records"] = os.stat(path).st_size // RECORD_DTYPE.itemsize if os.path.isfile(path) else 0
+		return list(reversed(runs))
+
+	def query(self, runId, start=None, end=None, maxPoints=500):
+		"""
+		Returns the telemetry of the given run between start and end (timestamps in seconds, defaulting to the whole
+		run) or None if there's no such run. Temperature, progress and z are returned as dicts of a "time" list and
+		one list per value column, reduced to at most maxPoints points by averaging, state changes as a list of
+		[time, state] pairs.
+		"""
+		with self._runsMutex:
+			runs = [dict(run) for run in self._runs if run["id"] == runId]
+		if len(runs) == 0:
+			return None
+
+		result = {"run": runs[0]}
+		records = self._loadRecords(runId)
+		times = records["time"]
+		first = numpy.searchsorted(times, start, "left") if start is not None else 0
+		last = numpy.searchsorted(times, end, "right") if end is not None else len(records)
+		records = records[first:last]
+
+		for (recordType, (name, columns)) in RECORD_TYPES.iteritems():
+			selected = records[records["type"] == recordType]
+			values = selected["values"][:, :len(columns)]
+			if recordType == RECORD_STATE:
+				result[name] = [[timestamp, int(state)] for (timestamp, state) in zip(selected["time"].tolist(), values[:, 0].tolist())]
+			else:
+				(sampleTimes, sampleValues) = _downsample(selected["time"], values, maxPoints)
+				series = {"time": sampleTimes.tolist()}
+				for (index, column) in enumerate(columns):
+					series[column] = _toList(sampleValues[:, index])
+				result[name] = series
+		return result
+
+	def _loadRecords(self, runId):
+		path = self._getRunPath(runId)
+		if not os.path.isfile(path):
+			return numpy.zeros(0, dtype=RECORD_DTYPE)
+
+		# a crash may have left a partial record at the end
+		count = os.stat(path).st_size // RECORD_DTYPE.itemsize
+		if count == 0:
+			return numpy.zeros(0, dtype=RECORD_DTYPE)
+		return numpy.memmap(path, dtype=RECORD_DTYPE, mode="r", shape=(count,))
+
+	def _getRunPath(self, runId):
+		return os.path.join(self._folder, runId + RUN_EXTENSION)
+
+	#~~ background writer
+
+	def _work(self):
+		pending = []
+		lastFlush = time.time()
+		while True:
+			try:
+				item = self._queue.get(timeout=self._flushInterval)
+			except Queue.Empty:
+				item = None
+
+			try:
+				if item is not None and item[0] == "record":
+					(timestamp, recordType, values) = item[1:]
+					values = [value if value is not None else numpy.nan for value in values]
+					pending.append((timestamp, recordType, values + [numpy.nan] * (4 - len(values))))
+				elif item is not None:
+					self._writeRecords(pending)
+					pending = []
+					if item[0] == "start":
+						self._startRun(item[1], item[2])
+					elif item[0] == "end":
+						self._endRun(item[1], item[2])
+
+				if len(pending) > 0 and time.time() - lastFlush >= self._flushInterval:
+					self._writeRecords(pending)
+					pending = []
+					lastFlush = time.time()
+			except:
+				self._logger.exception("Error while writing telemetry")
+				pending = []
+
+	def _writeRecords(self, records):
+		if self._currentFile is None or len(records) == 0:
+			return
+		self._currentFile.write(numpy.array(records, dtype=RECORD_DTYPE).tostring())
+		self._currentFile.flush()
+
+	def _startRun(self, timestamp, filename):
+		if self._currentRun is not None:
+			self._endRun(timestamp, False)
+
+		runId = time.strftime("%Y%m%d-%H%M%S", time.localtime(timestamp))
+		suffix = 1
+		while os.path.exists(self._getRunPath(runId)):
+			runId = "%s-%d" % (time.strftime("%Y%m%d-%H%M%S", time.localtime(timestamp)), suffix)
+			suffix += 1
+
+		self._currentRun = {
+			"id": runId,
+			"filename": filename,
+			"start": timestamp,
+			"end": None,
+			"success": None
+		}
+		self._currentFile = open(self._getRunPath(runId), "ab")
+
+		with self._runsMutex:
+			self._runs.append(self._currentRun)
+			removedRuns = self._runs[:max(0, len(self._runs) - self._maxRuns)]
+			self._runs = self._runs[len(removedRuns):]
+		for run in removedRuns:
+			path = self._getRunPath(run["id"])
+			if os.path.exists(path):
+				os.remove(path)
+		self._saveIndex()
+
+	def _endRun(self, timestamp, success):
+		if self._currentRun is None:
+			return
+
+		self._currentFile.close()
+		self._currentFile = None
+		with self._runsMutex:
+			self._currentRun["end"] = timestamp
+			self._currentRun["success"] = success
+		self._currentRun = None
+		self._saveIndex()
+
+	def _saveIndex(self):
+		with self._runsMutex:
+			runs = [dict(run) for run in self._runs]
+		with open(self._indexPath + ".tmp", "wb") as f:
+			yaml.safe_dump(runs, f, default_flow_style=False, indent="    ", allow_unicode=True)
+			f.flush()
+			os.fsync(f.fileno())
+
+		# renaming replaces the old index atomically on POSIX, Windows refuses to rename onto an existing file, so the
+		# old index is kept as backup until the new one is in place there
+		if os.name == "nt" and os.path.exists(self._indexPath):
+			if os.path.exists(self._indexPath + ".bak"):
+				os.remove(self._indexPath + ".bak")
+			os.rename(self._indexPath, self._indexPath + ".bak")
+		os.rename(self._indexPath + ".tmp", self._indexPath)
+		if os.path.exists(self._indexPath + ".bak"):
+			os.remove(self._indexPath + ".bak")
+
+def _downsample(times, values, maxPoints):
+	"""
+	Averages the given samples into at most maxPoints buckets of equal duration, ignoring NaN values. Returns the
+	mean time and the mean values of all non empty buckets.
+	"""
+	if len(times) <= maxPoints:
+		return (numpy.array(times), numpy.array(values))
+
+	edges = numpy.linspace(times[0], times[-1], maxPoints + 1)
+	buckets = numpy.clip(numpy.searchsorted(edges, times, "right") - 1, 0, maxPoints - 1)
+	counts = numpy.bincount(buckets, minlength=maxPoints)
+	nonEmpty = counts > 0
+
+	meanTimes = numpy.bincount(buckets, weights=times, minlength=maxPoints)[nonEmpty] / counts[nonEmpty]
+	meanValues = numpy.empty((nonEmpty.sum(), values.shape[1]), dtype=numpy.float64)
+	for column in range(values.shape[1]):
+		valid = ~numpy.isnan(values[:, column])
+		sums = numpy.bincount(buckets[valid], weights=values[valid, column], minlength=maxPoints)[nonEmpty]
+		validCounts = numpy.bincount(buckets[valid], minlength=maxPoints)[nonEmpty]
+		with numpy.errstate(invalid="ignore", divide="ignore"):
+			meanValues[:, column] = numpy.where(validCounts > 0, sums / validCounts, numpy.nan)
+	return (meanTimes, meanValues)
+
+def _toList(values):
+	"""
+	Converts the given float array to a list with None instead of NaN.
+	"""
+	if numpy.isnan(values).any():
+		values = values.astype(object)
+		values[numpy.isnan(values.astype(numpy.float64))] = None
+	return values.tolist()
@@ -1,5 +1,5 @@
-from __future__ import absolute_import
 # coding=utf-8
+from __future__ import absolute_import
 __author__ = "Gina Häußge <osd@foosel.net>"
 __license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
 
@@ -9,6 +9,7 @@ import os
 import re
 import threading
 import math
+import Queue as queue
 
 from octoprint.settings import settings
 
@@ -33,6 +34,16 @@ class VirtualPrinter():
 
 		self.currentLine = 0
 
+		# simulated one way latency of the serial line in seconds, lines written to the printer are only processed
+		# after it has passed
+		self._latency = settings().getFloat(["devel", "virtualPrinter", "latency"])
+		self._incoming = None
+		if self._latency:
+			self._incoming = queue.Queue()
+			latencyThread = threading.Thread(target=self._processDelayed)
+			latencyThread.daemon = True
+			latencyThread.start()
+
 		waitThread = threading.Thread(target=self._sendWaitAfterTimeout)
 		waitThread.start()
 
@@ -40,6 +51,23 @@ class VirtualPrinter():
 		if self.readList is None:
 			return
 
+		if self._incoming is not None:
+			self._incoming.put((time.time() + self._latency, data))
+		else:
+			self._processIncoming(data)
+
+	def _processDelayed(self):
+		while self.readList is not None:
+			(dueAt, data) = self._incoming.get()
+			delay = dueAt - time.time()
+			if delay > 0:
+				time.sleep(delay)
+			self._processIncoming(data)
+
+	def _processIncoming(self, data):
+		if self.readList is None:
+			return
+
 		# strip checksum
 		data = data.strip()
 		if "*" in data:
@@ -251,5 +279,6 @@ class VirtualPrinter():
 
 	def _sendWaitAfterTimeout(self, timeout=5):
 		time.sleep(timeout)
-		self.readList.append("wait")
+		if self.readList is not None:
+			self.readList.append("wait")
 
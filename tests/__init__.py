@@ -0,0 +1,13 @@
+# coding=utf-8
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+import tempfile
+
+from octoprint.settings import settings
+
+def initSettings():
+	"""
+	Initializes the settings singleton with a fresh temporary base folder, once for all tests.
+	"""
+	return settings(init=True, basedir=tempfile.mkdtemp(prefix="octoprint-tests-"))
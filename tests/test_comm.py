@@ -0,0 +1,333 @@
+# coding=utf-8
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+import os
+import re
+import Queue
+import shutil
+import operator
+import tempfile
+import threading
+import unittest
+
+from tests import initSettings
+from octoprint.settings import settings
+from octoprint.util import comm
+from octoprint.util import gcodeCompiler
+
+GCODE = "".join([
+	"; generated for the tests\n",
+	"G28\n",
+	"\n",
+	";TYPE:WALL-OUTER\n",
+	"G1 X10 Y10 F3000 ; first move\n",
+	"G1 X20 Y10\n",
+	"   \n",
+	";TYPE:FILL\n",
+	"G1 X20 Y20 P-0.5\n",
+	"M400\n",
+	"G1 X0 Y0"
+])
+
+EXPECTED_LINES = [
+	"M110 N0",
+	"G28",
+	("G1 X10 Y10 F3000", "WALL-OUTER"),
+	"G1 X20 Y10",
+	("G1 X20 Y20 P-0.5", "FILL"),
+	"M400",
+	"G1 X0 Y0"
+]
+
+def setUpModule():
+	initSettings()
+
+#~~ responses
+
+class ResponseTest(unittest.TestCase):
+	def test_classify(self):
+		self.assertEqual(comm.RESPONSE_OK, comm.classifyResponse("ok\n"))
+		self.assertEqual(comm.RESPONSE_TEMPERATURE, comm.classifyResponse("ok T:210.0 /210.0 B:60.0 /60.0 @:64\n"))
+		self.assertEqual(comm.RESPONSE_TEMPERATURE, comm.classifyResponse("T:21.5 E:0 W:?\n"))
+		self.assertEqual(comm.RESPONSE_SD_PRINTING_BYTE, comm.classifyResponse("SD printing byte 123/456\n"))
+		self.assertEqual(comm.RESPONSE_DONE_SPRAYING_FILE, comm.classifyResponse("Done spraying file\n"))
+		self.assertEqual(None, comm.classifyResponse("echo:busy processing\n"))
+		self.assertEqual(None, comm.classifyResponse(""))
+
+	def test_parseTemperature(self):
+		self.assertEqual((210.5, 60.0), comm.parseTemperatureResponse("ok T:210.5 /210.0 B:60.0 /60.0 @:64\n"))
+		self.assertEqual((-1.0, None), comm.parseTemperatureResponse("T:-1.0 E:0\n"))
+
+class PatternFilterTest(unittest.TestCase):
+	def test_matches(self):
+		patterns = [re.compile("^Fan"), re.compile("(a)\\1"), re.compile("volume", re.IGNORECASE), re.compile("(?P<name>x)"), re.compile("(?P<name>y)")]
+		patternFilter = comm.PatternFilter(patterns)
+
+		for line in ["Fan on", "baa", "VOLUME 3", "x", "y"]:
+			self.assertTrue(patternFilter.matches(line), line)
+		for line in ["ok", "The Fan", "ab", "z"]:
+			self.assertFalse(patternFilter.matches(line), line)
+
+	def test_backreferences(self):
+		self.assertTrue(comm._hasBackreferences("(a)\\1"))
+		self.assertTrue(comm._hasBackreferences("(?P<x>a)(?(x)b|c)"))
+		self.assertTrue(comm._hasBackreferences("(a"))
+		self.assertFalse(comm._hasBackreferences("(a)[\\1]b"))
+		self.assertFalse(comm._hasBackreferences("(?:a|b)+"))
+
+#~~ send window
+
+class SendWindowTest(unittest.TestCase):
+	def test_lineLimit(self):
+		window = comm.SendWindow(2, 1000)
+		window.push(10)
+		self.assertTrue(window.fits(10))
+		window.push(10)
+		self.assertFalse(window.fits(10))
+		self.assertEqual(2, len(window))
+
+		window.acknowledge()
+		self.assertEqual(1, len(window))
+		self.assertTrue(window.fits(10))
+
+	def test_byteLimit(self):
+		window = comm.SendWindow(10, 30)
+		window.push(20)
+		self.assertTrue(window.fits(10))
+		self.assertFalse(window.fits(11))
+
+		# the credit of the acknowledged line is freed, oldest first
+		window.push(10)
+		window.acknowledge()
+		self.assertTrue(window.fits(20))
+		self.assertFalse(window.fits(21))
+
+	def test_oversizedLineFitsEmptyWindow(self):
+		window = comm.SendWindow(4, 30)
+		self.assertTrue(window.fits(100))
+		window.push(100)
+		self.assertFalse(window.fits(1))
+
+	def test_acknowledgeEmpty(self):
+		window = comm.SendWindow(4, 30)
+		window.acknowledge()
+		self.assertEqual(0, len(window))
+		window.push(30)
+		self.assertFalse(window.fits(1))
+
+	def test_reset(self):
+		window = comm.SendWindow(2, 30)
+		window.push(15)
+		window.push(15)
+		window.reset()
+		self.assertEqual(0, len(window))
+		window.push(15)
+		self.assertTrue(window.fits(15))
+
+#~~ file informations
+
+class FileInformationTest(unittest.TestCase):
+	def setUp(self):
+		self._folder = tempfile.mkdtemp()
+		self._path = os.path.join(self._folder, "test.gcode")
+		with open(self._path, "w") as f:
+			f.write(GCODE)
+
+	def tearDown(self):
+		gcodeCompiler.removeCompiled(self._path)
+		shutil.rmtree(self._folder)
+
+	def _readAll(self, fileInformation):
+		fileInformation.start()
+		lines = []
+		while True:
+			line = fileInformation.getNext()
+			if line is None:
+				return lines
+			lines.append(line)
+
+	def _assertLines(self, fileInformation):
+		self.assertEqual(EXPECTED_LINES, self._readAll(fileInformation))
+		self.assertEqual(6, fileInformation.getCommandIndex())
+
+		# starting again rewinds to the first line
+		self.assertEqual(EXPECTED_LINES, self._readAll(fileInformation))
+
+	def test_plain(self):
+		fileInformation = comm.PrintingGcodeFileInformation(self._path)
+		self._assertLines(fileInformation)
+		self.assertEqual(len(GCODE), fileInformation.getFilepos())
+
+	def test_plainNotStarted(self):
+		fileInformation = comm.PrintingGcodeFileInformation(self._path)
+		self.assertRaises(ValueError, fileInformation.getNext)
+
+	def test_mapped(self):
+		fileInformation = comm.PrintingMappedGcodeFileInformation(self._path)
+		self._assertLines(fileInformation)
+		self.assertEqual(len(GCODE), fileInformation.getFilepos())
+
+	def test_mappedEmpty(self):
+		with open(self._path, "w"):
+			pass
+		fileInformation = comm.PrintingMappedGcodeFileInformation(self._path)
+		self.assertEqual(["M110 N0"], self._readAll(fileInformation))
+
+	def test_generated(self):
+		fileInformation = comm.PrintingGeneratedGcodeFileInformation("generated.gcode", lambda: GCODE.splitlines(True), 6)
+		self._assertLines(fileInformation)
+		self.assertEqual(len(GCODE), fileInformation.getFilepos())
+		self.assertEqual(1.0, fileInformation.getProgress())
+
+	def test_compiled(self):
+		fileInformation = comm.PrintingCompiledGcodeFileInformation(self._path, gcodeCompiler.loadCompiledGcode(self._path))
+		self._assertLines(fileInformation)
+		self.assertEqual(len(GCODE), fileInformation.getFilepos())
+
+		# framed lines are only handed out for the line number and command they were compiled for
+		self.assertEqual("N2 G1 X10 Y10 F3000*%d" % reduce(operator.xor, map(ord, "N2 G1 X10 Y10 F3000")), fileInformation.getFramedLine("G1 X10 Y10 F3000", 2))
+		self.assertEqual(None, fileInformation.getFramedLine("G1 X10 Y10 F3000", 3))
+		self.assertEqual(None, fileInformation.getFramedLine("M105", 2))
+		self.assertEqual(None, fileInformation.getFramedLine("M105", 100))
+
+#~~ sending and resending
+
+class StrictPrinter(object):
+	"""
+	Serial connection to a printer that checks line numbers and checksums like Marlin does. Every line wrongly numbered
+	is answered with an error and a resend request for the expected line, followed by an "ok" if okAfterResend is set.
+	Lines whose number is in corruptLines are treated as received with a wrong checksum the first time.
+	"""
+
+	def __init__(self, corruptLines, okAfterResend):
+		self.accepted = []
+		self.resendRequests = 0
+
+		self._corruptLines = set(corruptLines)
+		self._okAfterResend = okAfterResend
+		self._lastLine = 0
+		self._responses = Queue.Queue()
+		self._responses.put("start\n")
+
+	def write(self, data):
+		data = data.strip()
+		match = re.match("N([0-9]+) (.*)\*([0-9]+)$", data)
+		if match is None:
+			self._respond(data)
+			return
+
+		(lineNumber, command, checksum) = (int(match.group(1)), match.group(2), int(match.group(3)))
+		if checksum != reduce(operator.xor, map(ord, data[:data.rfind("*")])):
+			self._requestResend("checksum mismatch")
+		elif command.startswith("M110"):
+			self._lastLine = lineNumber
+			self._responses.put("ok\n")
+		elif lineNumber in self._corruptLines:
+			self._corruptLines.remove(lineNumber)
+			self._requestResend("checksum mismatch")
+		elif lineNumber != self._lastLine + 1:
+			self._requestResend("Line Number is not Last Line Number+1")
+		else:
+			self._lastLine = lineNumber
+			self.accepted.append(command)
+			self._respond(command)
+
+	def _respond(self, command):
+		if command.startswith("M105"):
+			self._responses.put("ok T:20.0 /0.0 B:20.0 /0.0 @:0\n")
+		else:
+			self._responses.put("ok\n")
+
+	def _requestResend(self, error):
+		self.resendRequests += 1
+		self._responses.put("Error:%s, Last Line: %d\n" % (error, self._lastLine))
+		self._responses.put("Resend: %d\n" % (self._lastLine + 1))
+		if self._okAfterResend:
+			self._responses.put("ok\n")
+
+	def readline(self):
+		try:
+			return self._responses.get(timeout=0.1)
+		except Queue.Empty:
+			return ""
+
+	def close(self):
+		pass
+
+class PrintCallback(comm.MachineComPrintCallback):
+	def __init__(self):
+		self.operational = threading.Event()
+		self.done = threading.Event()
+		self._printjobDone = False
+
+	def mcStateChange(self, state):
+		if state == comm.MachineCom.STATE_OPERATIONAL:
+			self.operational.set()
+			# the print job is reported done right before the state changes back
+			if self._printjobDone:
+				self.done.set()
+
+	def mcPrintjobDone(self):
+		self._printjobDone = True
+
+class ResendTest(unittest.TestCase):
+	COMMANDS = ["G1 X%d Y%d" % (i, i % 7) for i in range(200)]
+
+	def setUp(self):
+		self._folder = tempfile.mkdtemp()
+		self._path = os.path.join(self._folder, "test.gcode")
+		with open(self._path, "w") as f:
+			f.write("\n".join(self.COMMANDS))
+
+		self._virtualPrinter = comm.VirtualPrinter
+		self._comm = None
+
+	def tearDown(self):
+		if self._comm is not None:
+			self._comm.close()
+		comm.VirtualPrinter = self._virtualPrinter
+		settings().setBoolean(["serial", "sendWindow", "enabled"], False)
+		settings().setBoolean(["serial", "sendWindow", "okAfterResend"], False)
+		shutil.rmtree(self._folder)
+
+	def _print(self, corruptLines, sendWindow, okAfterResend=False):
+		settings().setBoolean(["serial", "sendWindow", "enabled"], sendWindow)
+		settings().setBoolean(["serial", "sendWindow", "okAfterResend"], okAfterResend)
+		printer = StrictPrinter(corruptLines, okAfterResend)
+		comm.VirtualPrinter = lambda: printer
+
+		callback = PrintCallback()
+		self._comm = comm.MachineCom("VIRTUAL", 115200, callback, False)
+		self.assertTrue(callback.operational.wait(5))
+
+		self._comm.selectFile(self._path, False)
+		self._comm.startPrint()
+		self.assertTrue(callback.done.wait(30))
+		self.assertEqual(comm.MachineCom.STATE_OPERATIONAL, self._comm.getState())
+		return printer
+
+	def test_noResends(self):
+		printer = self._print([], False)
+		self.assertEqual(self.COMMANDS, printer.accepted)
+		self.assertEqual(0, printer.resendRequests)
+
+	def test_resend(self):
+		printer = self._print([50, 120, 121, 200], False)
+		self.assertEqual(self.COMMANDS, printer.accepted)
+		self.assertEqual(4, printer.resendRequests)
+
+	def test_windowNoResends(self):
+		printer = self._print([], True)
+		self.assertEqual(self.COMMANDS, printer.accepted)
+		self.assertEqual(0, printer.resendRequests)
+
+	def test_windowResend(self):
+		printer = self._print([50, 120, 121, 200], True)
+		self.assertEqual(self.COMMANDS, printer.accepted)
+		# the lines in flight behind a broken one are rejected as well
+		self.assertTrue(printer.resendRequests > 4)
+
+	def test_windowResendWithOk(self):
+		printer = self._print([50, 120, 121, 200], True, True)
+		self.assertEqual(self.COMMANDS, printer.accepted)
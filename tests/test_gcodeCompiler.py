@@ -0,0 +1,123 @@
+# coding=utf-8
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+import os
+import time
+import shutil
+import operator
+import tempfile
+import unittest
+
+from tests import initSettings
+from octoprint.util import gcodeCompiler
+
+GCODE = "".join([
+	"; generated for the tests\n",
+	"G28\n",
+	"\n",
+	";TYPE:WALL-OUTER\n",
+	"G1 X10 Y10 F3000 ; first move\n",
+	"G1 X20 Y10\n",
+	"   \n",
+	";TYPE:FILL\n",
+	"G1 X20 Y20 P-0.5\n",
+	"M400\n",
+	"G1 X0 Y0"
+])
+
+def setUpModule():
+	initSettings()
+
+def _frame(command, lineNumber):
+	line = "N%d %s" % (lineNumber, command)
+	return "%s*%d" % (line, reduce(operator.xor, map(ord, line)))
+
+class ChecksumsTest(unittest.TestCase):
+	def test_matchesReduce(self):
+		lines = ["N1 G28", "N2 G1 X10 Y10 F3000", "M", "N123456 G1 X-1.234 Y5.678 P-0.0001"]
+		expected = [reduce(operator.xor, map(ord, line), 0) for line in lines]
+		self.assertEqual(expected, gcodeCompiler._checksums(lines))
+
+	def test_empty(self):
+		self.assertEqual([], gcodeCompiler._checksums([]))
+
+class CompileGcodeTest(unittest.TestCase):
+	def setUp(self):
+		self._folder = tempfile.mkdtemp()
+		self._path = os.path.join(self._folder, "test.gcode")
+		with open(self._path, "w") as f:
+			f.write(GCODE)
+
+	def tearDown(self):
+		gcodeCompiler.removeCompiled(self._path)
+		shutil.rmtree(self._folder)
+
+	def test_framing(self):
+		compiled = gcodeCompiler.loadCompiledGcode(self._path)
+
+		commands = ["G28", "G1 X10 Y10 F3000", "G1 X20 Y10", "G1 X20 Y20 P-0.5", "M400", "G1 X0 Y0"]
+		self.assertEqual(len(commands), len(compiled))
+		for (index, command) in enumerate(commands):
+			self.assertEqual(command, compiled.getCommand(index))
+			# numbered from 1, right after the "M110 N0" every job starts with
+			self.assertEqual(_frame(command, index + 1), compiled.getFramedLine(index))
+
+	def test_sections(self):
+		compiled = gcodeCompiler.loadCompiledGcode(self._path)
+
+		self.assertEqual(None, compiled.getSection(0))
+		self.assertEqual("WALL-OUTER", compiled.getSection(1))
+		self.assertEqual(None, compiled.getSection(2))
+		self.assertEqual("FILL", compiled.getSection(3))
+		self.assertEqual(None, compiled.getSection(4))
+
+	def test_filepos(self):
+		compiled = gcodeCompiler.loadCompiledGcode(self._path)
+
+		self.assertEqual(len("; generated for the tests\nG28\n"), compiled.getFilepos(0))
+		self.assertEqual(len(GCODE), compiled.getFilepos(len(compiled) - 1))
+		self.assertEqual(len(GCODE), compiled.sourceSize)
+
+	def test_batches(self):
+		# batches must continue the line numbering and the offsets of the previous ones
+		batchSize = gcodeCompiler.COMPILE_BATCH
+		gcodeCompiler.COMPILE_BATCH = 2
+		try:
+			compiled = gcodeCompiler.loadCompiledGcode(self._path)
+		finally:
+			gcodeCompiler.COMPILE_BATCH = batchSize
+
+		self.assertEqual(6, len(compiled))
+		self.assertEqual(_frame("G1 X20 Y20 P-0.5", 4), compiled.getFramedLine(3))
+		self.assertEqual(_frame("G1 X0 Y0", 6), compiled.getFramedLine(5))
+		self.assertEqual("FILL", compiled.getSection(3))
+
+	def test_stale(self):
+		self.assertFalse(gcodeCompiler.isCompiled(self._path))
+		self.assertEqual(None, gcodeCompiler.loadCompiledGcode(self._path, compileIfStale=False))
+
+		gcodeCompiler.compileGcode(self._path)
+		self.assertTrue(gcodeCompiler.isCompiled(self._path))
+
+		with open(self._path, "a") as f:
+			f.write("\nM84\n")
+		os.utime(self._path, (time.time() + 10, time.time() + 10))
+		self.assertFalse(gcodeCompiler.isCompiled(self._path))
+
+		compiled = gcodeCompiler.loadCompiledGcode(self._path)
+		self.assertEqual(_frame("M84", 7), compiled.getFramedLine(6))
+
+	def test_empty(self):
+		with open(self._path, "w") as f:
+			f.write("; nothing but comments\n\n")
+		compiled = gcodeCompiler.loadCompiledGcode(self._path)
+		self.assertEqual(0, len(compiled))
+
+	def test_compiledPathPerFolder(self):
+		otherFolder = tempfile.mkdtemp()
+		try:
+			otherPath = os.path.join(otherFolder, "test.gcode")
+			self.assertNotEqual(gcodeCompiler.getCompiledPath(self._path), gcodeCompiler.getCompiledPath(otherPath))
+		finally:
+			shutil.rmtree(otherFolder)
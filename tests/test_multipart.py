@@ -0,0 +1,77 @@
+# coding=utf-8
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+import unittest
+
+from octoprint.util.multipart import MultipartParser, getBoundary
+
+BOUNDARY = "----boundary"
+
+BODY = "\r\n".join([
+	"preamble",
+	"--" + BOUNDARY,
+	'Content-Disposition: form-data; name="select"',
+	"",
+	"true",
+	"--" + BOUNDARY,
+	'Content-Disposition: form-data; name="file"; filename="test.gcode"',
+	"Content-Type: application/octet-stream",
+	"",
+	"G28\r\nG1 X10\r\n--" + BOUNDARY[:-1] + "\r\nM400",
+	"--" + BOUNDARY + "--",
+	"epilogue"
+])
+
+class Part(object):
+	def __init__(self, name, filename, contentType):
+		self.name = name
+		self.filename = filename
+		self.contentType = contentType
+		self.data = []
+
+	def write(self, data):
+		self.data.append(data)
+
+class MultipartParserTest(unittest.TestCase):
+	def _parse(self, body, chunkSize, maxFieldSize=64 * 1024):
+		parts = []
+		def createPart(name, filename, contentType):
+			if filename is None:
+				return None
+			parts.append(Part(name, filename, contentType))
+			return parts[-1]
+
+		parser = MultipartParser(BOUNDARY, createPart, maxFieldSize)
+		for start in range(0, len(body), chunkSize):
+			parser.feed(body[start:start + chunkSize])
+		parser.finish()
+		return (parser.fields, parts)
+
+	def test_chunks(self):
+		# the delimiter may be split anywhere between two chunks
+		for chunkSize in range(1, len(BODY) + 1):
+			(fields, parts) = self._parse(BODY, chunkSize)
+
+			self.assertEqual([("select", "true")], fields)
+			self.assertEqual(1, len(parts))
+			self.assertEqual(("file", "test.gcode", "application/octet-stream"), (parts[0].name, parts[0].filename, parts[0].contentType))
+			self.assertEqual("G28\r\nG1 X10\r\n--" + BOUNDARY[:-1] + "\r\nM400", "".join(parts[0].data))
+
+	def test_fieldTooLong(self):
+		self.assertRaises(ValueError, self._parse, BODY, 10, 3)
+
+	def test_incomplete(self):
+		self.assertRaises(ValueError, self._parse, BODY[:BODY.rfind("--" + BOUNDARY)], 10)
+
+	def test_malformed(self):
+		self.assertRaises(ValueError, self._parse, "--" + BOUNDARY + "xx\r\n", 10)
+		self.assertRaises(ValueError, self._parse, "--" + BOUNDARY + "\r\nno header\r\n\r\n", 10)
+		self.assertRaises(ValueError, self._parse, "--" + BOUNDARY + "\r\nContent-Disposition: attachment\r\n\r\n", 10)
+
+	def test_getBoundary(self):
+		self.assertEqual(BOUNDARY, getBoundary("multipart/form-data; boundary=" + BOUNDARY))
+		self.assertEqual("a b", getBoundary('multipart/form-data; boundary="a b"'))
+		self.assertEqual(None, getBoundary("multipart/form-data"))
+		self.assertEqual(None, getBoundary("application/json"))
+		self.assertEqual(None, getBoundary(None))
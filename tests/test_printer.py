@@ -0,0 +1,64 @@
+# coding=utf-8
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+import Queue
+import unittest
+
+from tests import initSettings
+from octoprint.printer import StateMonitor
+
+def setUpModule():
+	initSettings()
+
+class StateMonitorTest(unittest.TestCase):
+	def setUp(self):
+		self._updates = Queue.Queue()
+		self._logs = []
+		self._monitor = StateMonitor(0.2, self._onUpdate, lambda temperature: None, self._logs.append, lambda message: None, logInterval=0.05)
+
+	def _onUpdate(self, sequence, changes):
+		self._updates.put((sequence, changes))
+
+	def _nextUpdate(self):
+		return self._updates.get(timeout=2)
+
+	def test_deltas(self):
+		self._monitor.setState("Operational")
+		self.assertEqual((1, {"state": "Operational", "job": None, "currentZ": None, "progress": None}), self._nextUpdate())
+
+		# only what changed
+		self._monitor.setProgress({"progress": 0.5})
+		self._monitor.setCurrentZ(1.2)
+		self.assertEqual((2, {"progress": {"progress": 0.5}, "currentZ": 1.2}), self._nextUpdate())
+
+		self._monitor.setState("Spraying")
+		self.assertEqual((3, {"state": "Spraying"}), self._nextUpdate())
+
+	def test_snapshot(self):
+		self.assertEqual((0, {"state": None, "job": None, "currentZ": None, "progress": None}), self._monitor.getSnapshot())
+
+		self._monitor.setState("Operational")
+		self._nextUpdate()
+		self.assertEqual((1, {"state": "Operational", "job": None, "currentZ": None, "progress": None}), self._monitor.getSnapshot())
+
+		# the snapshot is the state as of the last update, not any later change
+		progress = {"progress": 0.2}
+		self._monitor.setProgress(progress)
+		self.assertEqual((2, {"progress": {"progress": 0.2}}), self._nextUpdate())
+		progress["progress"] = 0.3
+		self.assertEqual((2, {"state": "Operational", "job": None, "currentZ": None, "progress": {"progress": 0.2}}), self._monitor.getSnapshot())
+
+	def test_batchedLogs(self):
+		self._monitor.setState("Operational")
+		self._nextUpdate()
+
+		self._monitor.addLog("Send: M105")
+		self._monitor.addLog("Recv: ok")
+		self.assertEqual((2, {}), self._nextUpdate())
+		self.assertEqual(["Send: M105", "Recv: ok"], self._logs)
+		self.assertTrue(self._updates.empty())
+
+		metrics = self._monitor.getMetrics()
+		self.assertEqual(2, metrics["pushes"])
+		self.assertEqual(3, metrics["changes"])
@@ -0,0 +1,180 @@
+# coding=utf-8
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+import json
+import unittest
+from collections import deque
+
+from tests import initSettings
+from octoprint import server
+
+def setUpModule():
+	initSettings()
+
+class DrainTest(unittest.TestCase):
+	def test_drain(self):
+		queue = deque([1, 2, 3])
+		self.assertEqual([1, 2, 3], server._drain(queue))
+		self.assertEqual(0, len(queue))
+		self.assertEqual([], server._drain(queue))
+
+	def test_bounded(self):
+		queue = deque([], 2)
+		queue.extend([1, 2, 3])
+		self.assertEqual([2, 3], server._drain(queue))
+
+#~~ log subscriptions
+
+class LogSubscriptionTest(unittest.TestCase):
+	def test_apply(self):
+		subscription = server.LogSubscription(["^Recv: ok", "M105"], 1)
+		lines = [(0, "Send: N1 G28*18"), (1, "Recv: ok"), (2, "Send: M105"), (3, "Recv: wait")]
+		self.assertEqual(["Send: N1 G28*18", "Recv: wait"], subscription.apply(lines))
+
+	def test_sample(self):
+		subscription = server.LogSubscription([], 2)
+		lines = [(number, "line %d" % number) for number in range(5, 10)]
+		self.assertEqual(["line 6", "line 8"], subscription.apply(lines))
+		# the sampling goes by the line numbers, not by the position in the given lines
+		self.assertEqual(["line 7"], server.LogSubscription([], 7).apply(lines))
+
+	def test_key(self):
+		self.assertEqual(server.LogSubscription(["a"], 0).key, server.LogSubscription(["a"], 1).key)
+		self.assertNotEqual(server.LogSubscription(["a"], 1).key, server.LogSubscription(["b"], 1).key)
+
+	def test_valid(self):
+		for pattern in ["^Recv: ok", "T:[0-9.]+", "(?:ok|wait)$", "a+b*c?", "(abc){2,5}", "(?=Send)"]:
+			server.LogSubscription([pattern])
+
+	def test_invalid(self):
+		invalid = [
+			"(a",                           # no valid regex
+			"(a)\\1",                       # backreference
+			"(?P<x>a)(?(x)b|c)",            # conditional backreference
+			"(a+)+",                        # nested repetition
+			"(a*b?)*",
+			"((a){2})*",
+			"(a|aa)*",                      # repeated alternative
+			"(?:x(ab|cd))+",
+			"a" * (server.LogSubscription.MAX_FILTER_LENGTH + 1),
+			5
+		]
+		for pattern in invalid:
+			self.assertRaises(ValueError, server.LogSubscription, [pattern])
+
+	def test_tooManyFilters(self):
+		self.assertRaises(ValueError, server.LogSubscription, ["a"] * (server.LogSubscription.MAX_FILTERS + 1))
+
+#~~ state broadcasts
+
+class DummyPrinter(object):
+	def __init__(self):
+		self.snapshot = (0, {})
+
+	def registerCallback(self, callback):
+		pass
+
+	def sendInitialStateUpdate(self, connection):
+		pass
+
+	def setSerialLogging(self, enabled):
+		pass
+
+	def getStateSnapshot(self):
+		(sequence, data) = self.snapshot
+		return (sequence, dict(data))
+
+class DummyEventManager(object):
+	def subscribe(self, event, callback):
+		pass
+
+	def fire(self, event, payload=None):
+		pass
+
+class DummySession(object):
+	def __init__(self):
+		self.send_queue = []
+
+class RecordingConnection(server.PrinterStateConnection):
+	"""
+	Connection that records the events sent to it instead of handing them to the socket.io session.
+	"""
+
+	def __init__(self, broadcaster):
+		server.PrinterStateConnection.__init__(self, None, None, DummyEventManager(), broadcaster, DummySession())
+		self.backlogged = False
+		self.events = []
+
+	def isBacklogged(self):
+		return self.backlogged
+
+	def sendEncoded(self, message):
+		event = json.loads(message.split(":", 3)[3])
+		self.events.append((event["name"], event["args"][0]))
+
+class StateBroadcasterTest(unittest.TestCase):
+	def setUp(self):
+		self._printer = DummyPrinter()
+		self._broadcaster = server.StateBroadcaster(self._printer, self._printer, DummyEventManager())
+		self._connection = RecordingConnection(self._broadcaster)
+		self._broadcaster.addConnection(self._connection)
+
+	def test_delta(self):
+		self._broadcaster.addTemperature({"time": 1})
+		self._broadcaster.addMessage("hello")
+		self._broadcaster.sendCurrentData(1, {"progress": 0.5})
+		self._broadcaster.sendCurrentData(2, {})
+
+		self.assertEqual([
+			("delta", {"seq": 1, "changes": {"progress": 0.5}, "temperatures": [{"time": 1}], "messages": ["hello"]}),
+			("delta", {"seq": 2, "changes": {}})
+		], self._connection.events)
+
+	def test_logsForSubscribersOnly(self):
+		other = RecordingConnection(self._broadcaster)
+		self._broadcaster.addConnection(other)
+		self._broadcaster.subscribeLog(self._connection, ["M105"], 1)
+
+		for line in ["Send: G28", "Send: M105", "Recv: ok"]:
+			self._broadcaster.addLog(line)
+		self._broadcaster.sendCurrentData(1, {})
+
+		self.assertEqual([("delta", {"seq": 1, "changes": {}, "logs": ["Send: G28", "Recv: ok"]})], self._connection.events)
+		self.assertEqual([("delta", {"seq": 1, "changes": {}})], other.events)
+
+	def test_snapshotAfterBacklog(self):
+		self._broadcaster.subscribeLog(self._connection)
+		self._connection.backlogged = True
+		for sequence in (1, 2):
+			self._broadcaster.addTemperature({"time": sequence})
+			self._broadcaster.addLog("line %d" % sequence)
+			self._broadcaster.sendCurrentData(sequence, {"progress": sequence})
+		self.assertEqual([], self._connection.events)
+
+		# once caught up the connection gets a snapshot with everything it missed, including the current update's
+		self._connection.backlogged = False
+		self._printer.snapshot = (3, {"progress": 3})
+		self._broadcaster.addTemperature({"time": 3})
+		self._broadcaster.addMessage("hello")
+		self._broadcaster.sendCurrentData(3, {"progress": 3})
+
+		self.assertEqual([("snapshot", {
+			"seq": 3,
+			"progress": 3,
+			"temperatures": [{"time": 1}, {"time": 2}, {"time": 3}],
+			"logs": ["line 1", "line 2"],
+			"messages": ["hello"]
+		})], self._connection.events)
+
+		# and deltas again afterwards
+		self._broadcaster.sendCurrentData(4, {})
+		self.assertEqual(("delta", {"seq": 4, "changes": {}}), self._connection.events[-1])
+
+	def test_missedBounded(self):
+		self._connection.addMissed(range(server.PrinterStateConnection.MAX_MISSED + 10), [], ["hello"])
+		missed = self._connection.drainMissed()
+
+		self.assertEqual(["messages", "temperatures"], sorted(missed.keys()))
+		self.assertEqual(range(10, server.PrinterStateConnection.MAX_MISSED + 10), missed["temperatures"])
+		self.assertEqual({}, self._connection.drainMissed())
@@ -0,0 +1,76 @@
+# coding=utf-8
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+import math
+import unittest
+
+from octoprint.util.sprayEstimator import SprayTimeEstimator
+from octoprint.util.sprayPath import sp_syringe_volume_per_travel
+
+FEEDRATES = {"x": 100, "y": 100, "z": 100, "p": 10, "v": 10}
+
+class SprayTimeEstimatorTest(unittest.TestCase):
+	def test_feedrate(self):
+		estimate = SprayTimeEstimator(FEEDRATES, {}, 50).estimate([
+			"G1 X30 Y40 F600 ; 50mm at 10mm/s",
+			"",
+			"; just a comment",
+			"G1 X30 Y40",
+			"G1 X130 Y40 F60000"
+		])
+
+		# comments and empty lines don't count as commands, moves to where the head already is take no time
+		self.assertEqual([5.0, 5.0, 6.0], list(estimate.cumulativeTimes))
+		self.assertEqual(6.0, estimate.totalTime)
+
+	def test_axisLimits(self):
+		# only the syringe moves, so the feedrate applies to it and is capped by its limit
+		estimate = SprayTimeEstimator(FEEDRATES, {}, 50).estimate(["G1 P20 F6000"])
+		self.assertEqual(2.0, estimate.totalTime)
+
+	def test_acceleration(self):
+		estimator = SprayTimeEstimator(FEEDRATES, {"x": 100}, 50)
+
+		# long enough to reach full speed: accelerating and decelerating take speed / acceleration in total
+		self.assertAlmostEqual(10.1, estimator.estimate(["G1 X100 F600"]).totalTime)
+		# too short, it has to brake before reaching full speed
+		self.assertAlmostEqual(2.0 * math.sqrt(0.5 / 100), estimator.estimate(["G1 X0.5 F600"]).totalTime)
+
+	def test_dwellAndHoming(self):
+		estimate = SprayTimeEstimator(FEEDRATES, {}, 50).estimate([
+			"G1 X40 F6000",
+			"G4 S2",
+			"G4 P500",
+			"G28"
+		])
+		self.assertEqual([0.4, 2.4, 2.9, 3.7], [round(time, 6) for time in estimate.cumulativeTimes])
+
+	def test_relative(self):
+		estimate = SprayTimeEstimator(FEEDRATES, {}, 50).estimate(["G91", "G1 X10 F600", "G1 X10", "G90", "G1 X10"])
+		self.assertEqual([0.0, 1.0, 2.0, 2.0, 3.0], list(estimate.cumulativeTimes))
+
+	def test_volumes(self):
+		estimate = SprayTimeEstimator(FEEDRATES, {}, 50).estimate([
+			"G1 P10 F600",
+			"G1 V1",
+			"G1 P8",
+			"G1 V0",
+			"M83",
+			"G1 P-3"
+		])
+		self.assertAlmostEqual(5 * sp_syringe_volume_per_travel, estimate.syringeVolume)
+		self.assertAlmostEqual(2 * sp_syringe_volume_per_travel, estimate.sprayVolume)
+
+	def test_remainingTime(self):
+		estimate = SprayTimeEstimator(FEEDRATES, {}, 50).estimate(["G4 S1", "G4 S2", "G4 S3"])
+		self.assertEqual(6.0, estimate.getRemainingTime(0))
+		self.assertEqual(5.0, estimate.getRemainingTime(1))
+		self.assertEqual(3.0, estimate.getRemainingTime(2))
+		self.assertEqual(0.0, estimate.getRemainingTime(3))
+		self.assertEqual(0.0, estimate.getRemainingTime(10))
+
+	def test_empty(self):
+		estimate = SprayTimeEstimator(FEEDRATES, {}, 50).estimate([])
+		self.assertEqual(0, len(estimate))
+		self.assertEqual(0.0, estimate.totalTime)
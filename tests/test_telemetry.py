@@ -0,0 +1,64 @@
+# coding=utf-8
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+import numpy
+import unittest
+
+from octoprint.util import telemetry
+from octoprint.util.telemetry import TelemetryBuffer
+
+class TelemetryBufferTest(unittest.TestCase):
+	def test_append(self):
+		buffer = TelemetryBuffer(["actual", "target"], 3)
+		buffer.append(1.0, [20.0, None])
+		buffer.append(2.0, [21.0, 200.0])
+
+		self.assertEqual(2, len(buffer))
+		self.assertEqual({"time": [1.0, 2.0], "actual": [20.0, 21.0], "target": [None, 200.0]}, buffer.toColumns())
+
+	def test_wrapAround(self):
+		buffer = TelemetryBuffer(["actual"], 3)
+		for timestamp in range(5):
+			buffer.append(timestamp, [timestamp * 10])
+
+		self.assertEqual(3, len(buffer))
+		self.assertEqual(2, len(buffer.getViews()))
+		self.assertEqual([[2.0, 20.0], [3.0, 30.0], [4.0, 40.0]], buffer.toArray().tolist())
+		self.assertEqual({"time": [2.0, 3.0, 4.0], "actual": [20.0, 30.0, 40.0]}, buffer.toColumns())
+
+		buffer.clear()
+		self.assertEqual(0, len(buffer))
+		self.assertEqual({"time": [], "actual": []}, buffer.toColumns())
+
+	def test_averaging(self):
+		buffer = TelemetryBuffer(["actual", "target"], 3, interval=1.0)
+		buffer.append(0.0, [10.0, None])
+		buffer.append(0.5, [20.0, 200.0])
+		buffer.append(0.9, [30.0, None])
+		buffer.append(1.0, [40.0, 210.0])
+
+		# averaged per column over the samples that had a value
+		self.assertEqual({"time": [0.0, 1.0], "actual": [20.0, 40.0], "target": [200.0, 210.0]}, buffer.toColumns())
+
+	def test_timeScale(self):
+		buffer = TelemetryBuffer(["actual"], 3, interval=1.0, timeScale=1000.0)
+		buffer.append(0, [10.0])
+		buffer.append(999, [20.0])
+		buffer.append(1000, [30.0])
+		self.assertEqual([[0.0, 15.0], [1000.0, 30.0]], buffer.toArray().tolist())
+
+class DownsampleTest(unittest.TestCase):
+	def test_small(self):
+		(times, values) = telemetry._downsample([1.0, 2.0], numpy.array([[1.0], [2.0]]), 10)
+		self.assertEqual([1.0, 2.0], times.tolist())
+
+	def test_buckets(self):
+		times = numpy.arange(10, dtype=numpy.float64)
+		values = numpy.array([[value, numpy.nan if value < 5 else value] for value in range(10)], dtype=numpy.float64)
+		(meanTimes, meanValues) = telemetry._downsample(times, values, 2)
+
+		self.assertEqual([2.0, 7.0], meanTimes.tolist())
+		self.assertEqual(2.0, meanValues[0, 0])
+		self.assertTrue(numpy.isnan(meanValues[0, 1]))
+		self.assertEqual([7.0, 7.0], meanValues[1].tolist())